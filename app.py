@@ -1,5 +1,24 @@
+import math
+import tempfile
+from pathlib import Path
+
 import streamlit as st
-from nl_to_sql import get_table_metadata, process_question
+from nl_to_sql import (
+    cache_translation,
+    chart_data,
+    count_rows,
+    export_result,
+    fetch_page,
+    generate_sql_stream,
+    get_engine,
+    get_table_metadata,
+    run_with_repair,
+)
+from struct_llm.errors import QueryError
+from struct_llm.export import EXTENSIONS, FILE_MEDIA_TYPES
+from struct_llm.metrics import Trace
+
+PAGE_SIZE = 100
 
 # Streamlit app
 st.title("Natural Language to SQL Converter")
@@ -10,20 +29,189 @@ st.write("This application converts natural language queries into SQL using Open
 user_question = st.text_input("Ask a question about your data:", placeholder="e.g., What is the total premium amount for all active policies?")
 
 if user_question:
+    # A new question is traced until its first page is shown
+    new_question = st.session_state.get("question") != user_question
+    trace = Trace(user_question) if new_question else None
     try:
-        # Process the question and get results
-        sql, result = process_question(user_question)
+        st.subheader("Generated SQL")
+        sql_placeholder = st.empty()
+        query_status = st.empty()
+        
+        def still_running():
+            # Called while a query runs in a worker process (QUERY_PROCESSES).
+            # Streamlit stops the script of a user who moved on at its next
+            # write, which cancels the query
+            query_status.caption("Running query...")
+        
+        # Generate the SQL and count its rows once per question; pages are
+        # fetched lazily
+        if trace is not None:
+            stats = {}
+            # Show the SQL as it is generated; the stream stops as soon as the
+            # statement is complete
+            stream = generate_sql_stream(user_question, stats, trace)
+            streamed = ""
+            for chunk in stream:
+                streamed += chunk
+                sql_placeholder.code(streamed, language="sql")
+            sql, cached = stream.sql, stream.cached
+            
+            def count(candidate_sql):
+                with trace.stage("count"):
+                    return count_rows(candidate_sql, on_wait=still_running)
+            # Rejected SQL is repaired before it is cached or paged through
+            sql, total_rows = run_with_repair(user_question, sql, count, trace)
+            if not cached:
+                cache_translation(user_question, sql)
+            # A chart of the full result, reduced to a few thousand points by DuckDB
+            try:
+                with trace.stage("chart"):
+                    chart = None
+                    if total_rows > 1:
+                        chart = chart_data(sql, on_wait=still_running)
+            except QueryError:
+                chart = None
+            st.session_state.question = user_question
+            st.session_state.sql = sql
+            st.session_state.stats = stats
+            st.session_state.total_rows = total_rows
+            st.session_state.page = 1
+            st.session_state.chart = chart
+            st.session_state.pop("export_path", None)
+        
+        sql = st.session_state.sql
+        stats = st.session_state.stats
+        total_rows = st.session_state.total_rows
+        max_result_rows = get_engine().settings.max_result_rows
         
         # Display SQL
-        st.subheader("Generated SQL")
-        st.code(sql, language="sql")
+        sql_placeholder.code(sql, language="sql")
+        if stats:
+            st.caption(
+                f"Prompt: ~{stats['prompt_tokens']} tokens "
+                f"(full schema: ~{stats['full_schema_prompt_tokens']}) "
+                f"using tables: {', '.join(stats['tables'])}"
+            )
         
-        # Execute and display results
+        # Display one page of results
         st.subheader("Query Results")
+        visible_rows = min(total_rows, max_result_rows)
+        page_count = max(1, math.ceil(visible_rows / PAGE_SIZE))
+        page = st.number_input(
+            "Page", min_value=1, max_value=page_count, step=1, key="page"
+        )
+        result = fetch_page(
+            sql, page - 1, PAGE_SIZE, max_result_rows, trace, on_wait=still_running
+        )
+        query_status.empty()
         st.dataframe(result)
         
+        first_row = (page - 1) * PAGE_SIZE
+        first_shown = first_row + 1 if result.height else 0
+        caption = (
+            f"Rows {first_shown}-{first_row + result.height} of {total_rows:,}"
+        )
+        if total_rows > max_result_rows:
+            caption += (
+                f" (browsing limited to the first {max_result_rows:,}; "
+                "download for the full result)"
+            )
+        st.caption(caption)
+        
+        chart = st.session_state.chart
+        if chart is not None:
+            st.subheader("Chart")
+            if chart.kind == "line":
+                st.line_chart(chart.data, x=chart.x, y=chart.y, color=chart.color)
+            elif chart.kind == "scatter":
+                st.scatter_chart(chart.data, x=chart.x, y=chart.y)
+            else:
+                st.bar_chart(chart.data, x=chart.x, y=chart.y)
+            st.caption(f"{chart.data.height:,} points drawn for {total_rows:,} rows")
+        
+        # The full result is written to a file by DuckDB rather than rendered
+        export_format = st.selectbox(
+            "Download format", list(FILE_MEDIA_TYPES), format_func=str.upper
+        )
+        if st.button("Prepare full result download"):
+            file_name = f"result{EXTENSIONS[export_format]}"
+            export_path = Path(tempfile.mkdtemp()) / file_name
+            export_bar = st.progress(0.0, text="Exporting...")
+            
+            def show_progress(progress):
+                # Also where Streamlit stops the script of a user who moved on,
+                # cancelling the export
+                written = progress.bytes_written / (1 << 20)
+                export_bar.progress(
+                    min(progress.percent or 0.0, 100.0) / 100,
+                    text=f"Exporting... {written:,.1f} MB written",
+                )
+            export_result(sql, export_path, export_format, progress=show_progress)
+            export_bar.empty()
+            st.session_state.export_path = str(export_path)
+            st.session_state.export_format = export_format
+        if st.session_state.get("export_path"):
+            export_format = st.session_state.export_format
+            with open(st.session_state.export_path, "rb") as f:
+                st.download_button(
+                    f"Download {export_format.upper()}", f,
+                    file_name=Path(st.session_state.export_path).name,
+                    mime=FILE_MEDIA_TYPES[export_format],
+                )
+        
     except Exception as e:
         st.error(str(e))
+    finally:
+        if trace is not None:
+            get_engine().metrics.record(trace)
+            st.session_state.trace = trace
+
+# Performance panel: where the time of the last question went, and totals for
+# this server
+with st.sidebar:
+    if st.checkbox("Show performance"):
+        metrics = get_engine().metrics
+        last_trace = st.session_state.get("trace")
+        if last_trace is not None:
+            st.subheader("Last question")
+            st.table({
+                "stage": list(last_trace.stages),
+                "ms": [
+                    round(seconds * 1000, 1) for seconds in last_trace.stages.values()
+                ],
+            })
+            if last_trace.cache_hit is not None:
+                st.caption(
+                    "Translation cache hit" if last_trace.cache_hit
+                    else "Translation cache miss"
+                )
+            if last_trace.prompt_tokens is not None:
+                st.caption(
+                    f"Tokens: {last_trace.prompt_tokens} prompt, "
+                    f"{last_trace.completion_tokens} completion"
+                )
+            if last_trace.rows is not None:
+                st.caption(
+                    f"First page: {last_trace.rows:,} rows, "
+                    f"{last_trace.result_bytes:,} bytes"
+                )
+            if last_trace.error is not None:
+                st.caption(
+                    f"Failed in {last_trace.error_stage}: {last_trace.error_type}"
+                )
+        
+        snapshot = metrics.snapshot()
+        st.subheader(f"All questions ({snapshot['questions']})")
+        if snapshot["stages"]:
+            st.table({
+                "stage": list(snapshot["stages"]),
+                "p50 ms": [round(s["p50_ms"], 1) for s in snapshot["stages"].values()],
+                "p95 ms": [round(s["p95_ms"], 1) for s in snapshot["stages"].values()],
+            })
+        st.download_button("Prometheus metrics", metrics.to_prometheus(),
+                           file_name="metrics.prom", mime="text/plain")
+        st.download_button("JSON metrics", metrics.to_json(),
+                           file_name="metrics.json", mime="application/json")
 
 # Database Schema section
 st.header("Database Schema")
@@ -35,7 +223,7 @@ col1, col2, col3 = st.columns(3)
 # Display tables in columns
 for i, (table_name, info) in enumerate(metadata.items()):
     # Assign to appropriate column
-    col = [col1, col2, col3][i]
+    col = [col1, col2, col3][i % 3]
     
     with col:
         with st.expander(f"📊 {table_name}", expanded=False):  # Start collapsed
@@ -46,4 +234,4 @@ for i, (table_name, info) in enumerate(metadata.items()):
             if info['columns']:
                 st.markdown("**Columns:**")
                 for col_name, col_desc in info['columns']:
-                    st.markdown(f"- **{col_name}**: {col_desc}") 
\ No newline at end of file
+                    st.markdown(f"- **{col_name}**: {col_desc}")
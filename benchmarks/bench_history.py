@@ -0,0 +1,85 @@
+"""
+Lookup latency of the query history index at a given number of entries.
+
+Fills a HistoryIndex with synthetic questions built from the vocabulary of
+the benchmark corpus, then times searches for questions that are in the index
+and for new questions, and reports latency percentiles. It also checks that
+every indexed question is found as its own nearest neighbour.
+
+Usage:
+    python benchmarks/bench_history.py --entries 1000000 --lookups 1000
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+for path in (ROOT / "src", ROOT):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+CORPUS_PATH = Path(__file__).resolve().parent / "corpus.json"
+PERCENTILES = [50, 90, 99]
+
+def synthetic_questions(count: int, seed: int):
+    """Distinct questions of 4-10 words from the corpus vocabulary.
+
+    Each question ends in a number.
+    """
+    corpus = json.loads(CORPUS_PATH.read_text())
+    words = sorted({word for item in corpus for word in item["question"].split()})
+    rng = random.Random(seed)
+    return [
+        f"{' '.join(rng.choices(words, k=rng.randint(4, 10)))} {i}"
+        for i in range(count)
+    ]
+
+def main():
+    from struct_llm.history import LOAD_CHUNK_SIZE, HistoryIndex
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=1_000_000,
+                        help="Questions in the index")
+    parser.add_argument("--lookups", type=int, default=1000,
+                        help="Searches per kind of question")
+    parser.add_argument("--k", type=int, default=3, help="Matches returned per search")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    questions = synthetic_questions(args.entries + args.lookups, args.seed)
+    indexed, new = questions[:args.entries], questions[args.entries:]
+    index = HistoryIndex()
+    started = time.perf_counter()
+    for start in range(0, len(indexed), LOAD_CHUNK_SIZE):
+        chunk = indexed[start:start + LOAD_CHUNK_SIZE]
+        index.add_many(
+            (question, f"SELECT {i}") for i, question in enumerate(chunk, start)
+        )
+    print(f"Indexed {len(index):,} questions in {time.perf_counter() - started:.1f} s")
+
+    rng = random.Random(args.seed)
+    known = rng.sample(indexed, min(args.lookups, len(indexed)))
+    for kind, sample in (("indexed", known), ("new", new)):
+        latencies, misses = [], 0
+        for question in sample:
+            started = time.perf_counter()
+            matches = index.search(question, args.k)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if kind == "indexed" and (not matches or matches[0].question != question):
+                misses += 1
+        percentiles = np.percentile(latencies, PERCENTILES)
+        summary = "  ".join(
+            f"p{p} {value:.2f} ms" for p, value in zip(PERCENTILES, percentiles)
+        )
+        if kind == "indexed":
+            summary += f"  ({misses} not found)"
+        print(f"{kind:>8} questions: {summary}")
+
+if __name__ == "__main__":
+    main()
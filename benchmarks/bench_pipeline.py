@@ -0,0 +1,284 @@
+"""
+End-to-end benchmark of the NL->SQL pipeline with a fake LLM backend.
+
+Runs the question corpus in benchmarks/corpus.json through process_question
+at each dataset scale factor and reports latency percentiles of the stages
+its metrics.Trace records, throughput and peak RSS. The LLM is the deterministic
+FakeOpenAIClient from benchmarks/fake_llm.py with a configurable injected
+latency, called in-process or, with --llm-server, over HTTP through the
+OpenAI-compatible stand-in server in benchmarks/llm_server.py. Translation
+and result caching are disabled so every question pays every stage.
+
+Datasets are generated with data/generate_sample_data.py and loaded with
+data/update_database.py into --work-dir, and reused across runs. Each scale
+factor runs in its own process so that peak RSS is measured per scale factor.
+
+Usage:
+    python benchmarks/bench_pipeline.py --sf 1 10 100 --iterations 5 \\
+        --llm-latency 0.5 --output bench.json
+    python benchmarks/bench_pipeline.py --compare before.json after.json
+"""
+
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+for path in (ROOT / "data", ROOT / "src", ROOT):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+CORPUS_PATH = Path(__file__).resolve().parent / "corpus.json"
+
+PERCENTILES = [50, 90, 95, 99]
+
+def prepare_database(sf: float, seed: int, work_dir: Path) -> Path:
+    """Generate and load the dataset for a scale factor.
+
+    An existing dataset is reused.
+    """
+    import duckdb
+    from generate_sample_data import generate
+    from update_database import load_sources, write_schema_metadata
+
+    from struct_llm.profiling import profile_database
+
+    data_dir = work_dir / f"sf{sf:g}-seed{seed}"
+    db_path = data_dir / "database.db"
+    if db_path.exists():
+        return db_path
+
+    generate(sf, seed, data_dir, "parquet", 500_000, np.datetime64("2024-01-01"))
+    conn = duckdb.connect(str(db_path))
+    load_sources(conn, data_dir=data_dir)
+    write_schema_metadata(conn)
+    profile_database(conn)
+    conn.close()
+    return db_path
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds."""
+    values = np.array(samples) * 1000
+    summary = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    summary["mean"] = float(values.mean())
+    summary["max"] = float(values.max())
+    return summary
+
+def run_scale_factor(sf: float, args) -> Dict:
+    """Run the corpus against one scale factor in this process.
+
+    Stages are reported in the order they first ran; a question that skipped
+    a stage (e.g. repair) counts as 0 ms for it.
+    """
+    from fake_llm import FakeOpenAIClient
+
+    import nl_to_sql
+    from struct_llm.cache import TranslationCache
+    from struct_llm.database import ConnectionManager
+    from struct_llm.metrics import Trace
+
+    db_path = prepare_database(sf, args.seed, args.work_dir)
+    corpus = json.loads(CORPUS_PATH.read_text())
+    client = FakeOpenAIClient(
+        {item["question"]: item["sql"] for item in corpus},
+        latency=args.llm_latency, jitter=args.llm_jitter, seed=args.seed
+    )
+    server = None
+    # Without the query history and the result cache, repeated questions
+    # aren't answered from earlier passes
+    options = dict(openai_api_key="benchmark", query_history=False,
+                   result_cache_memory_bytes=0, result_cache_disk_bytes=0)
+    if args.llm_server:
+        from llm_server import start_server
+        server = start_server(client)
+        settings = nl_to_sql.Settings(
+            **options, llm_backend="http", llm_base_url=server.base_url
+        )
+        client = None
+    else:
+        settings = nl_to_sql.Settings(**options)
+    engine = nl_to_sql.Engine(
+        settings=settings,
+        client=client,
+        conn=ConnectionManager(db_path=db_path, threads=args.threads),
+        # max_entries=0 never keeps an entry, so every question reaches the LLM
+        translation_cache=TranslationCache(db_path=None, max_entries=0),
+    )
+    nl_to_sql.set_engine(engine)
+
+    traces: List[Trace] = []
+    rows_returned = 0
+    started = None
+    for iteration in range(args.warmup + args.iterations):
+        if iteration == args.warmup:
+            started = time.perf_counter()
+        for item in corpus:
+            trace = Trace(item["question"])
+            _, result = nl_to_sql.process_question(item["question"], trace=trace)
+            if iteration >= args.warmup:
+                traces.append(trace)
+                rows_returned += result.height
+    wall_time = time.perf_counter() - started
+    questions = len(corpus) * args.iterations
+    if server is not None:
+        server.shutdown()
+
+    stages = list(dict.fromkeys(stage for trace in traces for stage in trace.stages))
+
+    return {
+        "sf": sf,
+        "orders": engine.conn.execute("SELECT count(*) FROM orders").fetchone()[0],
+        "questions": questions,
+        "rows_returned": rows_returned,
+        "wall_time_s": wall_time,
+        "throughput_qps": questions / wall_time,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                       / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "stages_ms": {
+            stage: summarize([trace.stages.get(stage, 0.0) for trace in traces])
+            for stage in stages
+        },
+    }
+
+def run_isolated(sf: float, args) -> Dict:
+    """Run one scale factor in a fresh interpreter."""
+    with tempfile.TemporaryDirectory() as tmp:
+        output = Path(tmp) / "result.json"
+        command = [
+            sys.executable, __file__, "--worker", "--sf", f"{sf:g}",
+            "--output", str(output),
+            "--iterations", str(args.iterations), "--warmup", str(args.warmup),
+            "--llm-latency", str(args.llm_latency),
+            "--llm-jitter", str(args.llm_jitter),
+            "--seed", str(args.seed), "--work-dir", str(args.work_dir),
+            "--threads", str(args.threads),
+        ] + (["--llm-server"] if args.llm_server else [])
+        subprocess.run(command, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        return json.loads(output.read_text())
+
+def environment() -> Dict:
+    import duckdb
+    import polars
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True,
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "duckdb": duckdb.__version__,
+        "polars": polars.__version__,
+        "platform": platform.platform(),
+    }
+
+def print_report(report: Dict):
+    for result in report["results"]:
+        print(f"\nsf={result['sf']:g} ({result['orders']:,} orders): "
+              f"{result['throughput_qps']:.1f} questions/s, "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB")
+        header = "".join(f"{f'p{p}':>10}" for p in PERCENTILES)
+        print(f"  {'stage':<14}{header}{'mean':>10}")
+        for stage, stats in result["stages_ms"].items():
+            values = "".join(f"{stats[f'p{p}']:>10.2f}" for p in PERCENTILES)
+            print(f"  {stage:<14}{values}{stats['mean']:>10.2f}")
+
+def compare(before_path: Path, after_path: Path):
+    """Print the change in p50/p95 latency and throughput between two result files."""
+    before_results = json.loads(before_path.read_text())["results"]
+    after_results = json.loads(after_path.read_text())["results"]
+    before = {result["sf"]: result for result in before_results}
+    after = {result["sf"]: result for result in after_results}
+
+    def change(old: float, new: float) -> str:
+        return f"{(new - old) / old:+.1%}" if old else "n/a"
+
+    for sf in sorted(set(before) & set(after)):
+        old, new = before[sf], after[sf]
+        print(f"\nsf={sf:g}: throughput {old['throughput_qps']:.1f} -> "
+              f"{new['throughput_qps']:.1f} "
+              f"({change(old['throughput_qps'], new['throughput_qps'])}), peak RSS "
+              f"{old['peak_rss_mb']:.0f} -> {new['peak_rss_mb']:.0f} MB")
+        # Result files from before a stage existed don't have it
+        for stage in [stage for stage in new["stages_ms"] if stage in old["stages_ms"]]:
+            for p in ("p50", "p95"):
+                o, n = old["stages_ms"][stage][p], new["stages_ms"][stage][p]
+                print(f"  {stage:<14} {p}: {o:>9.2f} -> {n:>9.2f} ms ({change(o, n)})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sf", type=float, nargs="+", default=[1.0, 10.0],
+                        help="Scale factors to run")
+    parser.add_argument("--iterations", type=int, default=5,
+                        help="Passes over the corpus per scale factor")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="Untimed passes before measuring")
+    parser.add_argument("--llm-latency", type=float, default=0.0,
+                        help="Injected LLM latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.0,
+                        help="Extra random LLM latency, up to this many seconds")
+    parser.add_argument("--llm-server", action="store_true",
+                        help="Call the fake LLM over HTTP through "
+                             "benchmarks/llm_server.py")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--threads", type=int, default=0,
+                        help="DuckDB threads (0 = DuckDB default)")
+    parser.add_argument("--work-dir", type=Path, default=ROOT / "benchmarks" / ".data",
+                        help="Where generated datasets are kept between runs")
+    parser.add_argument("--output", type=Path,
+                        help="Write machine-readable results to this JSON file")
+    parser.add_argument("--no-isolate", action="store_true",
+                        help="Run all scale factors in this process")
+    parser.add_argument("--compare", type=Path, nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="Compare two result files instead of running")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    if args.worker:
+        args.output.write_text(json.dumps(run_scale_factor(args.sf[0], args)))
+        return
+
+    results = [
+        run_scale_factor(sf, args) if args.no_isolate else run_isolated(sf, args)
+        for sf in args.sf
+    ]
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "environment": environment(),
+        "config": {
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "llm_latency_s": args.llm_latency,
+            "llm_jitter_s": args.llm_jitter,
+            "seed": args.seed,
+            "threads": args.threads,
+            "corpus_size": len(json.loads(CORPUS_PATH.read_text())),
+        },
+        "results": results,
+    }
+    print_report(report)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Deterministic stand-in for the OpenAI client used by benchmarks.
+
+FakeOpenAIClient answers chat completions from a fixed question -> SQL
+mapping, after an injected latency, and reports token usage like the real
+API. It implements the part of the client interface nl_to_sql uses:
+client.chat.completions.create(model=..., messages=..., temperature=...),
+with stream=True returning the SQL in word-sized chunks.
+"""
+
+import random
+import re
+import time
+from types import SimpleNamespace
+from typing import Dict, Optional
+
+from struct_llm.cache import normalize_question
+from struct_llm.retrieval import count_tokens
+
+QUESTION_PATTERN = re.compile(r"^User Question: (.*)$", re.MULTILINE)
+
+class FakeCompletions:
+    def __init__(self, client: "FakeOpenAIClient"):
+        self._client = client
+
+    def create(self, model: str, messages, temperature: Optional[float] = None,
+               stream: bool = False, **kwargs):
+        if stream:
+            return self._client.stream(messages)
+        return self._client.complete(messages)
+
+class FakeOpenAIClient:
+    """Answer prompts from canned question -> SQL pairs.
+
+    latency is the fixed delay per call in seconds, plus a uniform random
+    jitter of up to `jitter` seconds drawn from a seeded generator.
+    """
+
+    def __init__(self, responses: Dict[str, str], latency: float = 0.0,
+                 jitter: float = 0.0, seed: int = 0, default_sql: str = "SELECT 1"):
+        self.responses = {
+            normalize_question(question): sql for question, sql in responses.items()
+        }
+        self.latency = latency
+        self.jitter = jitter
+        self.default_sql = default_sql
+        self.calls = 0
+        self._random = random.Random(seed)
+        self.chat = SimpleNamespace(completions=FakeCompletions(self))
+
+    def answer(self, prompt: str) -> str:
+        """The canned SQL for the question in a prompt."""
+        match = QUESTION_PATTERN.search(prompt)
+        question = match.group(1) if match else prompt
+        return self.responses.get(normalize_question(question), self.default_sql)
+
+    def stream(self, messages):
+        """Yield the response of complete() as one-word chunks, then a usage chunk."""
+        response = self.complete(messages)
+        for word in re.findall(r"\S+\s*", response.choices[0].message.content):
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(
+                    delta=SimpleNamespace(content=word), finish_reason=None
+                )],
+                usage=None,
+            )
+        yield SimpleNamespace(choices=[], usage=response.usage)
+
+    def complete(self, messages):
+        self.calls += 1
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        prompt = messages[-1]["content"]
+        sql = self.answer(prompt)
+        prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+        completion_tokens = count_tokens(sql)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(
+                message=SimpleNamespace(content=sql), finish_reason="stop"
+            )],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
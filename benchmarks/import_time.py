@@ -0,0 +1,103 @@
+"""
+Import-time budget check for nl_to_sql.
+
+Imports the module in a fresh interpreter with `python -X importtime` and
+fails if any heavy dependency was imported eagerly, or if the project's own
+modules (nl_to_sql and struct_llm) take longer than the budget to import. The
+stdlib modules they import are reported but not counted: their cost is mostly
+interpreter startup, and varies too much between machines to budget. The
+bytecode cache is warmed first, so compiling doesn't count either.
+
+The budget is about 2.5x the 5-6 ms measured on a development machine.
+
+Usage:
+    python benchmarks/import_time.py [--budget-ms 15] [--module nl_to_sql]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Dependencies that must only be imported on first use
+HEAVY_MODULES = [
+    "openai", "polars", "pyarrow", "pandas", "duckdb", "requests", "dotenv",
+]
+
+# The project's modules, whose own import time is budgeted
+PROJECT_PACKAGES = ("nl_to_sql", "struct_llm")
+
+def _is_project_module(name: str) -> bool:
+    return any(
+        name == package or name.startswith(package + ".")
+        for package in PROJECT_PACKAGES
+    )
+
+def measure(module: str):
+    """Import module in a fresh interpreter.
+
+    Returns (microseconds spent in the project's own modules, cumulative
+    microseconds of the import including the stdlib, heavy modules imported).
+    """
+    check = (
+        f"import sys, {module}; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    env = dict(os.environ)
+    paths = [str(ROOT / "src"), str(ROOT), env.get("PYTHONPATH")]
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, paths))
+    # Write the bytecode cache, so that only the first run compiles
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", check],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+
+    # Each line is "import time: self [us] | cumulative [us] | imported package".
+    # The self times of the project's modules exclude the modules they import;
+    # the cumulative time of the module's own line covers everything
+    project_us = total_us = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        if _is_project_module(name.strip()):
+            project_us += int(self_us)
+        if name.strip() == module and not name[1:].startswith(" "):
+            total_us = int(cumulative)
+    heavy = [m for m in proc.stdout.strip().split(",") if m]
+    return project_us, total_us, heavy
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", default="nl_to_sql")
+    parser.add_argument("--budget-ms", type=float, default=15.0,
+                        help="Budget of the import time of the project's own modules")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Report the best of this many runs")
+    args = parser.parse_args()
+
+    # A first run writes the bytecode cache
+    measure(args.module)
+    results = [measure(args.module) for _ in range(args.runs)]
+    best_us = min(project_us for project_us, _, _ in results)
+    best_total_us = min(total_us for _, total_us, _ in results)
+    heavy = results[0][2]
+
+    print(f"import {args.module}: {best_us / 1000:.1f} ms in nl_to_sql and struct_llm "
+          f"(budget {args.budget_ms:.0f} ms), "
+          f"{best_total_us / 1000:.1f} ms with the stdlib modules they import")
+    failed = False
+    if heavy:
+        print(f"FAIL: heavy modules imported eagerly: {', '.join(heavy)}")
+        failed = True
+    if best_us / 1000 > args.budget_ms:
+        print("FAIL: import time over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+OpenAI-compatible stand-in server for tests and benchmarks.
+
+Serves POST /v1/chat/completions (plain and streamed as server-sent events)
+and GET /v1/models over HTTP/1.1 keep-alive, answering from the canned
+question -> SQL pairs of a FakeOpenAIClient (benchmarks/fake_llm.py), with its
+injected latency. A fraction of requests can be failed with 429 or 503 to
+exercise retries. Point the pipeline at it with
+OPENAI_BASE_URL=http://127.0.0.1:8765/v1 and any OPENAI_API_KEY.
+
+Usage:
+    python benchmarks/llm_server.py --port 8765 --latency 0.2 [--error-rate 0.05]
+
+In-process, start_server() runs it on a free port in a background thread.
+"""
+
+import argparse
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+for path in (ROOT / "src", Path(__file__).resolve().parent):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+# fake_llm is found through the path set up above, so it is imported where it is used
+if TYPE_CHECKING:
+    from fake_llm import FakeOpenAIClient
+
+CORPUS_PATH = Path(__file__).resolve().parent / "corpus.json"
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Room for many clients connecting at once
+    request_queue_size = 1024
+
+    def __init__(self, address: Tuple[str, int], client: "FakeOpenAIClient",
+                 error_rate: float = 0.0, seed: int = 0):
+        super().__init__(address, StandInHandler)
+        self.client = client
+        self.error_rate = error_rate
+        self.requests = 0
+        self.connections = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            return self._random.random() < self.error_rate
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server._lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload, headers: Optional[dict] = None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, {
+                "object": "list", "data": [{"id": "stand-in", "object": "model"}],
+            })
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        if self.server.should_fail():
+            status = self.server._random.choice([429, 503])
+            self._send_json(
+                status, {"error": {"message": "Injected failure"}}, {"Retry-After": "0"}
+            )
+            return
+        model = request.get("model", "stand-in")
+        response = self.server.client.complete(request["messages"])
+        sql = response.choices[0].message.content
+        usage = vars(response.usage)
+        created = int(time.time())
+        if not request.get("stream"):
+            self._send_json(200, {
+                "id": "chatcmpl-stand-in", "object": "chat.completion",
+                "created": created, "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": sql},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for word in sql.split(" "):
+                chunk = {
+                    "id": "chatcmpl-stand-in", "object": "chat.completion.chunk",
+                    "created": created, "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"content": word + " "},
+                        "finish_reason": None,
+                    }],
+                }
+                self._send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            if request.get("stream_options", {}).get("include_usage"):
+                chunk = {
+                    "id": "chatcmpl-stand-in", "object": "chat.completion.chunk",
+                    "created": created, "model": model, "choices": [], "usage": usage,
+                }
+                self._send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            self._send_chunk(b"data: [DONE]\n\n")
+            self._send_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading, as the pipeline does once the SQL is
+            # complete
+            self.close_connection = True
+
+def start_server(client: "FakeOpenAIClient", host: str = "127.0.0.1", port: int = 0,
+                 error_rate: float = 0.0, seed: int = 0) -> StandInServer:
+    """Serve in a daemon thread; port 0 picks a free port.
+
+    Stop with server.shutdown().
+    """
+    server = StandInServer((host, port), client, error_rate, seed)
+    threading.Thread(
+        target=server.serve_forever, name="llm-stand-in", daemon=True
+    ).start()
+    return server
+
+def main():
+    from fake_llm import FakeOpenAIClient
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Delay per completion in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Extra random delay, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests failed with 429/503")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = json.loads(CORPUS_PATH.read_text())
+    client = FakeOpenAIClient({item["question"]: item["sql"] for item in corpus},
+                              latency=args.latency, jitter=args.jitter, seed=args.seed)
+    server = StandInServer((args.host, args.port), client, args.error_rate, args.seed)
+    print(f"Serving {len(corpus)} canned answers on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
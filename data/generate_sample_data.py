@@ -1,90 +1,236 @@
-import pandas as pd
+"""
+Generate the sample life insurance dataset at a given scale factor.
+
+Scale factor 1 matches the original sample: 10 products, 100 customers and 1-5
+orders per day over 2023 (~1,100 orders). Customers and orders grow linearly
+with --sf. Rows are sampled with NumPy in chunks and written as Parquet
+row groups (or CSV), so memory stays bounded at any scale. String columns
+are drawn from pools of pre-generated Faker values, and a fixed --seed gives
+identical output.
+
+Usage:
+    python data/generate_sample_data.py --sf 1000 --seed 42
+"""
+
+import argparse
+from datetime import date
+from pathlib import Path
+
 import numpy as np
-from datetime import datetime, timedelta
-import random
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from faker import Faker
 
-# Initialize Faker for generating realistic names and addresses
-fake = Faker()
-
-# Generate products data
-products = [
-    {
-        'product_id': f'PROD{i:03d}',
-        'product_name': name,
-        'coverage_type': coverage,
-        'term_length_years': term,
-        'base_premium': round(random.uniform(50, 500), 2),
-        'max_coverage_amount': round(random.uniform(100000, 1000000), 2)
-    }
-    for i, (name, coverage, term) in enumerate([
-        ('Term Life Basic', 'Term Life', 10),
-        ('Term Life Plus', 'Term Life', 20),
-        ('Whole Life Standard', 'Whole Life', None),
-        ('Whole Life Premium', 'Whole Life', None),
-        ('Universal Life Flex', 'Universal Life', None),
-        ('Universal Life Plus', 'Universal Life', None),
-        ('Variable Life Growth', 'Variable Life', None),
-        ('Variable Life Balanced', 'Variable Life', None),
-        ('Indexed Universal Life', 'Indexed Universal Life', None),
-        ('Final Expense', 'Whole Life', None)
-    ])
+# Number of distinct Faker values generated per string column
+POOL_SIZE = 2000
+
+START_DATE = np.datetime64('2023-01-01')
+END_DATE = np.datetime64('2023-12-31')
+
+PRODUCTS = [
+    ('Term Life Basic', 'Term Life', 10),
+    ('Term Life Plus', 'Term Life', 20),
+    ('Whole Life Standard', 'Whole Life', None),
+    ('Whole Life Premium', 'Whole Life', None),
+    ('Universal Life Flex', 'Universal Life', None),
+    ('Universal Life Plus', 'Universal Life', None),
+    ('Variable Life Growth', 'Variable Life', None),
+    ('Variable Life Balanced', 'Variable Life', None),
+    ('Indexed Universal Life', 'Indexed Universal Life', None),
+    ('Final Expense', 'Whole Life', None),
 ]
 
-# Generate customers data
-customers = []
-for i in range(100):
-    birth_date = fake.date_of_birth(minimum_age=25, maximum_age=75)
-    customers.append({
-        'customer_id': f'CUST{i:03d}',
-        'first_name': fake.first_name(),
-        'last_name': fake.last_name(),
-        'email': fake.email(),
-        'phone': fake.phone_number(),
-        'address': fake.street_address(),
-        'city': fake.city(),
-        'state': fake.state_abbr(),
-        'zip_code': fake.zipcode(),
-        'date_of_birth': birth_date,
-        'age': (datetime.now().date() - birth_date).days // 365
+PAYMENT_STATUSES = np.array(['Paid', 'Pending', 'Failed'])
+POLICY_STATUSES = np.array(['Active', 'Pending', 'Cancelled'])
+
+def format_ids(prefix: str, numbers: np.ndarray, width: int) -> pa.Array:
+    """Format integers as zero-padded ids, e.g. CUST007."""
+    digits = pc.utf8_lpad(
+        pc.cast(pa.array(numbers), pa.string()), width=width, padding='0'
+    )
+    return pc.binary_join_element_wise(prefix, digits, '')
+
+def id_width(count: int, minimum: int) -> int:
+    return max(minimum, len(str(max(count - 1, 0))))
+
+class TableWriter:
+    """Write a table chunk by chunk as Parquet row groups or CSV."""
+
+    def __init__(self, path: Path, schema: pa.Schema, file_format: str):
+        self.path = path.with_suffix(f'.{file_format}')
+        if file_format == 'parquet':
+            self._writer = pq.ParquetWriter(str(self.path), schema, compression='zstd')
+        else:
+            self._writer = pa_csv.CSVWriter(str(self.path), schema)
+        self.rows = 0
+
+    def write(self, table: pa.Table):
+        self._writer.write_table(table)
+        self.rows += table.num_rows
+
+    def close(self):
+        self._writer.close()
+
+def make_pools(fake: Faker) -> dict:
+    """Pre-generate pools of realistic string values with Faker."""
+    return {
+        'first_name': np.array([fake.first_name() for _ in range(POOL_SIZE)]),
+        'last_name': np.array([fake.last_name() for _ in range(POOL_SIZE)]),
+        'email_user': np.array([fake.user_name() for _ in range(POOL_SIZE)]),
+        'email_domain': np.array([fake.free_email_domain() for _ in range(50)]),
+        'phone': np.array([fake.phone_number() for _ in range(POOL_SIZE)]),
+        'address': np.array([fake.street_address() for _ in range(POOL_SIZE)]),
+        'city': np.array([fake.city() for _ in range(POOL_SIZE)]),
+        'state': np.array([fake.state_abbr() for _ in range(POOL_SIZE)]),
+        'zip_code': np.array([fake.zipcode() for _ in range(POOL_SIZE)]),
+    }
+
+def generate_products(rng: np.random.Generator) -> pa.Table:
+    count = len(PRODUCTS)
+    return pa.table({
+        'product_id': format_ids('PROD', np.arange(count), 3),
+        'product_name': [name for name, _, _ in PRODUCTS],
+        'coverage_type': [coverage for _, coverage, _ in PRODUCTS],
+        'term_length_years': pa.array([term for _, _, term in PRODUCTS], pa.float64()),
+        'base_premium': np.round(rng.uniform(50, 500, count), 2),
+        'max_coverage_amount': np.round(rng.uniform(100000, 1000000, count), 2),
+    })
+
+def generate_customers(rng: np.random.Generator, pools: dict, start: int, count: int,
+                       total: int, as_of: np.datetime64) -> pa.Table:
+    """Generate customers start..start+count-1."""
+    def sample(pool: str) -> np.ndarray:
+        return pools[pool][rng.integers(0, len(pools[pool]), count)]
+
+    # Birth dates uniformly between 75 and 25 years before as_of
+    youngest = as_of - np.timedelta64(25 * 365, 'D')
+    oldest = as_of - np.timedelta64(75 * 365, 'D')
+    offsets = rng.integers(0, (youngest - oldest).astype(int) + 1, count)
+    date_of_birth = oldest + offsets.astype('timedelta64[D]')
+    age = ((as_of - date_of_birth).astype(int) // 365).astype(np.int32)
+
+    numbers = np.arange(start, start + count)
+    return pa.table({
+        'customer_id': format_ids('CUST', numbers, id_width(total, 3)),
+        'first_name': sample('first_name'),
+        'last_name': sample('last_name'),
+        # Suffixing the customer number keeps emails unique
+        'email': pc.binary_join_element_wise(
+            sample('email_user'), pa.array(numbers.astype(str)), '@',
+            sample('email_domain'), ''
+        ),
+        'phone': sample('phone'),
+        'address': sample('address'),
+        'city': sample('city'),
+        'state': sample('state'),
+        'zip_code': sample('zip_code'),
+        'date_of_birth': pa.array(date_of_birth, pa.date32()),
+        'age': age,
+    })
+
+def generate_orders(rng: np.random.Generator, start: int, order_dates: np.ndarray,
+                    total: int, customer_ages: np.ndarray,
+                    products: pa.Table) -> pa.Table:
+    """Generate the orders numbered start.. for the given order dates."""
+    count = len(order_dates)
+    customer_idx = rng.integers(0, len(customer_ages), count)
+    product_idx = rng.integers(0, products.num_rows, count)
+    ages = customer_ages[customer_idx]
+    base_premium = products['base_premium'].to_numpy()[product_idx]
+    max_coverage = products['max_coverage_amount'].to_numpy()[product_idx]
+
+    # Adjust premium based on age: 2% increase per year over 40
+    premium = np.round(base_premium * (1 + (ages - 40) * 0.02), 2)
+    # Adjust coverage based on age: 1% decrease per year over 40
+    coverage = np.round(max_coverage * (1 - (ages - 40) * 0.01), 2)
+
+    return pa.table({
+        'order_id': format_ids(
+            'ORD', np.arange(start, start + count), id_width(total, 6)
+        ),
+        'customer_id': format_ids(
+            'CUST', customer_idx, id_width(len(customer_ages), 3)
+        ),
+        'product_id': pc.take(products['product_id'], pa.array(product_idx)),
+        'order_date': pa.array(order_dates, pa.date32()),
+        'premium_amount': premium,
+        'coverage_amount': coverage,
+        'payment_status':
+            PAYMENT_STATUSES[rng.integers(0, len(PAYMENT_STATUSES), count)],
+        'policy_status': POLICY_STATUSES[rng.integers(0, len(POLICY_STATUSES), count)],
     })
 
-# Generate orders data
-orders = []
-start_date = datetime(2023, 1, 1)
-end_date = datetime(2023, 12, 31)
-
-for day in range((end_date - start_date).days + 1):
-    current_date = start_date + timedelta(days=day)
-    # Generate 1-5 orders per day
-    num_orders = random.randint(1, 5)
-    
-    for _ in range(num_orders):
-        customer = random.choice(customers)
-        product = random.choice(products)
-        
-        # Adjust premium based on age
-        age_factor = 1 + (customer['age'] - 40) * 0.02  # 2% increase per year over 40
-        premium = round(product['base_premium'] * age_factor, 2)
-        
-        # Adjust coverage based on age and product
-        coverage_factor = 1 - (customer['age'] - 40) * 0.01  # 1% decrease per year over 40
-        coverage_amount = round(product['max_coverage_amount'] * coverage_factor, 2)
-        
-        orders.append({
-            'order_id': f'ORD{len(orders):06d}',
-            'customer_id': customer['customer_id'],
-            'product_id': product['product_id'],
-            'order_date': current_date.date(),
-            'premium_amount': premium,
-            'coverage_amount': coverage_amount,
-            'payment_status': random.choice(['Paid', 'Pending', 'Failed']),
-            'policy_status': random.choice(['Active', 'Pending', 'Cancelled'])
-        })
-
-# Convert to DataFrames and save as CSV
-pd.DataFrame(products).to_csv('data/products.csv', index=False)
-pd.DataFrame(customers).to_csv('data/customers.csv', index=False)
-pd.DataFrame(orders).to_csv('data/orders.csv', index=False)
-
-print("Sample data generated successfully!") 
\ No newline at end of file
+def generate(sf: float, seed: int, output_dir: Path, file_format: str, chunk_size: int,
+             as_of: np.datetime64) -> dict:
+    """Generate all tables. Returns the number of rows written per table."""
+    rng = np.random.default_rng(seed)
+    fake = Faker()
+    Faker.seed(seed)
+    pools = make_pools(fake)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    products = generate_products(rng)
+    writer = TableWriter(output_dir / 'products', products.schema, file_format)
+    writer.write(products)
+    writer.close()
+    rows = {'products': writer.rows}
+
+    # Customers: ages are kept to compute order premiums (4 bytes per customer)
+    customer_count = max(1, round(100 * sf))
+    customer_ages = np.empty(customer_count, dtype=np.int32)
+    writer = None
+    for start in range(0, customer_count, chunk_size):
+        count = min(chunk_size, customer_count - start)
+        chunk = generate_customers(rng, pools, start, count, customer_count, as_of)
+        customer_ages[start:start + count] = chunk['age'].to_numpy()
+        if writer is None:
+            writer = TableWriter(output_dir / 'customers', chunk.schema, file_format)
+        writer.write(chunk)
+    writer.close()
+    rows['customers'] = writer.rows
+
+    # Orders: 1-5 per day at scale factor 1, scaled linearly
+    days = np.arange(START_DATE, END_DATE + np.timedelta64(1, 'D'))
+    orders_per_day = rng.integers(
+        max(1, round(sf)), max(1, round(5 * sf)) + 1, len(days)
+    )
+    order_count = int(orders_per_day.sum())
+    day_ends = np.cumsum(orders_per_day)
+    writer = None
+    for start in range(0, order_count, chunk_size):
+        count = min(chunk_size, order_count - start)
+        order_numbers = np.arange(start, start + count)
+        order_dates = days[np.searchsorted(day_ends, order_numbers, side='right')]
+        chunk = generate_orders(
+            rng, start, order_dates, order_count, customer_ages, products
+        )
+        if writer is None:
+            writer = TableWriter(output_dir / 'orders', chunk.schema, file_format)
+        writer.write(chunk)
+    writer.close()
+    rows['orders'] = writer.rows
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate the sample dataset at a given scale factor."
+    )
+    parser.add_argument("--sf", type=float, default=1.0,
+                        help="Scale factor (1 = 100 customers, ~1,100 orders)")
+    parser.add_argument("--seed", type=int, default=42,
+                        help="Random seed for reproducible output")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--output-dir", type=Path, default=Path("data"))
+    parser.add_argument("--chunk-size", type=int, default=500_000,
+                        help="Rows generated and written at a time")
+    parser.add_argument("--as-of", type=date.fromisoformat, default=date(2024, 1, 1),
+                        help="Date customer ages are computed against")
+    args = parser.parse_args()
+
+    rows = generate(args.sf, args.seed, args.output_dir, args.format, args.chunk_size,
+                    np.datetime64(args.as_of, 'D'))
+    for table_name, count in rows.items():
+        print(f"{table_name}: {count:,} rows")
+    print("Sample data generated successfully!")
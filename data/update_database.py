@@ -1,95 +1,372 @@
-import duckdb
-import polars as pl
+import hashlib
+import os
+import shutil
 from pathlib import Path
+from typing import Optional
+
+import duckdb
+
+from struct_llm.database import bump_table_versions, track_table_versions
+from struct_llm.partitions import is_partitioned, partitioned_table, store_partitioned
+from struct_llm.profiling import profile_database, quote_identifier
+from struct_llm.rollup import refresh_rollups
 
 # Set up the database connection
 DB_PATH = Path("data/database.db")
-conn = duckdb.connect(str(DB_PATH))
-
-# Drop existing tables in the correct order (child tables first)
-conn.execute("DROP TABLE IF EXISTS orders")
-conn.execute("DROP TABLE IF EXISTS customers")
-conn.execute("DROP TABLE IF EXISTS products")
-conn.execute("DROP TABLE IF EXISTS schema_metadata")
-
-# Create tables with proper schema and constraints
-conn.execute("""
-CREATE TABLE products AS
-SELECT * FROM read_csv_auto('data/products.csv')
-""")
-
-conn.execute("""
-CREATE TABLE customers AS
-SELECT * FROM read_csv_auto('data/customers.csv')
-""")
-
-# Create orders table with foreign key references
-conn.execute("""
-CREATE TABLE orders AS
-SELECT 
-    o.*,
-    c.customer_id as _check_customer,
-    p.product_id as _check_product
-FROM read_csv_auto('data/orders.csv') o
-JOIN customers c ON o.customer_id = c.customer_id
-JOIN products p ON o.product_id = p.product_id
-""")
-
-# Create schema metadata table
-conn.execute("""
-CREATE TABLE schema_metadata (
-    table_name VARCHAR,
-    column_name VARCHAR,
-    description VARCHAR
-)
-""")
-
-# Insert schema metadata
-conn.execute("""
-INSERT INTO schema_metadata VALUES
-    ('products', NULL, 'Life insurance products available for purchase'),
-    ('products', 'product_id', 'Unique identifier for the product'),
-    ('products', 'product_name', 'Name of the insurance product'),
-    ('products', 'coverage_type', 'Type of life insurance coverage'),
-    ('products', 'term_length_years', 'Length of term for term life insurance (NULL for permanent policies)'),
-    ('products', 'base_premium', 'Base monthly premium amount'),
-    ('products', 'max_coverage_amount', 'Maximum coverage amount available'),
-    
-    ('customers', NULL, 'Customer information'),
-    ('customers', 'customer_id', 'Unique identifier for the customer'),
-    ('customers', 'first_name', 'Customer first name'),
-    ('customers', 'last_name', 'Customer last name'),
-    ('customers', 'email', 'Customer email address'),
-    ('customers', 'phone', 'Customer phone number'),
-    ('customers', 'address', 'Customer street address'),
-    ('customers', 'city', 'Customer city'),
-    ('customers', 'state', 'Customer state'),
-    ('customers', 'zip_code', 'Customer zip code'),
-    ('customers', 'date_of_birth', 'Customer date of birth'),
-    ('customers', 'age', 'Customer age in years'),
-    
-    ('orders', NULL, 'Insurance policy orders'),
-    ('orders', 'order_id', 'Unique identifier for the order'),
-    ('orders', 'customer_id', 'ID of the customer who placed the order'),
-    ('orders', 'product_id', 'ID of the product ordered'),
-    ('orders', 'order_date', 'Date the order was placed'),
-    ('orders', 'premium_amount', 'Monthly premium amount for the policy'),
-    ('orders', 'coverage_amount', 'Coverage amount for the policy'),
-    ('orders', 'payment_status', 'Status of the payment (Paid, Pending, Failed)'),
-    ('orders', 'policy_status', 'Status of the policy (Active, Pending, Cancelled)')
-""")
-
-# Verify the data was loaded correctly
-print("Products table:")
-print(conn.execute("SELECT * FROM products LIMIT 5").pl())
-
-print("\nCustomers table:")
-print(conn.execute("SELECT * FROM customers LIMIT 5").pl())
-
-print("\nOrders table:")
-print(conn.execute("SELECT * FROM orders LIMIT 5").pl())
-
-# Close the connection
-conn.close()
-
-print("\nDatabase updated successfully!") 
\ No newline at end of file
+
+# Directory holding the source files
+DATA_DIR = Path("data")
+
+# Source files in load order (parents before children), with their primary key.
+# <table>.parquet (see generate_sample_data.py) is preferred over <table>.csv
+SOURCES = [
+    ('products', 'products', 'product_id'),
+    ('customers', 'customers', 'customer_id'),
+    ('orders', 'orders', 'order_id'),
+]
+
+# Foreign keys as table -> [(column, referenced table, referenced column)]
+FOREIGN_KEYS = {
+    'orders': [
+        ('customer_id', 'customers', 'customer_id'),
+        ('product_id', 'products', 'product_id'),
+    ],
+}
+
+def ensure_load_state(conn):
+    """Create the table recording which version of each source file was loaded."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS _load_state (
+        table_name VARCHAR PRIMARY KEY,
+        source_path VARCHAR NOT NULL,
+        mtime DOUBLE NOT NULL,
+        size BIGINT NOT NULL,
+        sha256 VARCHAR NOT NULL,
+        loaded_at TIMESTAMP NOT NULL
+    )
+    """)
+
+def source_path(data_dir: Path, name: str) -> str:
+    """Pick the Parquet or CSV file for a source."""
+    parquet_path = data_dir / f"{name}.parquet"
+    return str(parquet_path if parquet_path.exists() else data_dir / f"{name}.csv")
+
+def read_function(path: str) -> str:
+    return "read_parquet" if path.endswith(".parquet") else "read_csv_auto"
+
+def file_sha256(path: str) -> str:
+    """Hash a file in 1MB chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def source_changed(conn, table_name: str, path: str):
+    """Check a source file against the recorded load state.
+
+    Files whose mtime and size are unchanged are skipped without reading them;
+    otherwise the content hash decides. Returns (changed, (mtime, size,
+    sha256)).
+    """
+    stat = os.stat(path)
+    row = conn.execute(
+        "SELECT source_path, mtime, size, sha256 FROM _load_state "
+        "WHERE table_name = ?",
+        [table_name],
+    ).fetchone()
+    if (row is not None and row[0] == path and row[1] == stat.st_mtime
+            and row[2] == stat.st_size):
+        return False, (stat.st_mtime, stat.st_size, row[3])
+    sha256 = file_sha256(path)
+    changed = row is None or row[0] != path or row[3] != sha256
+    return changed, (stat.st_mtime, stat.st_size, sha256)
+
+def record_load_state(conn, table_name: str, path: str, state):
+    conn.execute(
+        "INSERT OR REPLACE INTO _load_state VALUES (?, ?, ?, ?, ?, current_timestamp)",
+        [table_name, path, *state]
+    )
+
+def column_types(conn, table_name: str):
+    return conn.execute("""
+    SELECT column_name, data_type
+    FROM information_schema.columns
+    WHERE table_schema IN ('main', 'temp') AND table_name = ?
+    ORDER BY ordinal_position
+    """, [table_name]).fetchall()
+
+def table_exists(conn, table_name: str) -> bool:
+    return conn.execute(
+        "SELECT count(*) FROM information_schema.tables "
+        "WHERE table_schema = 'main' AND table_name = ?",
+        [table_name],
+    ).fetchone()[0] > 0
+
+def table_storage(conn, table_name: str, storage: Optional[str] = None) -> str:
+    """The storage layout to load a table into: "parquet" or "table".
+
+    See struct_llm.partitions for "parquet". Without a requested layout, a
+    table keeps the one it has. Only tables
+    with a partitioning can be stored as Parquet.
+    """
+    table = partitioned_table(table_name)
+    if table is None:
+        return "table"
+    if storage is None:
+        return "parquet" if is_partitioned(conn, table) else "table"
+    return storage
+
+def reject_orphans(conn, table_name: str) -> int:
+    """Delete staged rows whose foreign keys have no parent row (an anti-join).
+
+    Returns the count.
+    """
+    rejected = 0
+    for column, parent, parent_column in FOREIGN_KEYS.get(table_name, []):
+        col = quote_identifier(column)
+        parent_col = quote_identifier(parent_column)
+        rejected += conn.execute(f"""
+        DELETE FROM _staging s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {quote_identifier(parent)} p WHERE p.{parent_col} = s.{col}
+        )
+        """).fetchone()[0]
+    return rejected
+
+def load_table(conn, table_name: str, path: str, key: str, storage: str = "table",
+               data_dir: Path = DATA_DIR):
+    """Load a source file into its table, upserting only new or changed rows.
+
+    The file is staged in a temp table, rows violating foreign keys are rejected
+    with an anti-join, and the remaining new or changed rows replace the
+    existing ones by primary key. If the table doesn't exist or its columns
+    changed, it is rebuilt from the staged rows instead. Either way the change
+    is applied in a single transaction. With the "parquet" storage layout
+    the rows are written to the table's partitions under data_dir instead
+    (see struct_llm.partitions), rewriting only the months they change.
+    Returns (rows upserted, rows rejected, rebuilt).
+    """
+    table = quote_identifier(table_name)
+    key_col = quote_identifier(key)
+    partitioning = partitioned_table(table_name)
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        conn.execute(
+            "CREATE OR REPLACE TEMP TABLE _staging AS "
+            f"SELECT * FROM {read_function(path)}(?)",
+            [path],
+        )
+        rejected = reject_orphans(conn, table_name)
+
+        if storage == "parquet":
+            partition_columns = (partitioning.year_column, partitioning.month_column)
+            stored_types = [
+                column for column in column_types(conn, table_name)
+                if column[0] not in partition_columns
+            ]
+            rebuild = (not is_partitioned(conn, partitioning)
+                       or stored_types != column_types(conn, '_staging'))
+            upserted, _ = store_partitioned(
+                conn, partitioning, '_staging', key, data_dir / table_name, rebuild
+            )
+            conn.execute("DROP TABLE _staging")
+            conn.execute("COMMIT")
+            return upserted, rejected, rebuild
+        # Back from the Parquet storage layout
+        unpartitioned = partitioning is not None and is_partitioned(conn, partitioning)
+        if unpartitioned:
+            conn.execute(f"DROP VIEW {table}")
+
+        rebuild = (not table_exists(conn, table_name)
+                   or column_types(conn, table_name) != column_types(conn, '_staging'))
+        if rebuild:
+            conn.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM _staging")
+            upserted = conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+        else:
+            conn.execute(f"""
+            CREATE OR REPLACE TEMP TABLE _changes AS
+            SELECT * FROM _staging
+            EXCEPT
+            SELECT * FROM {table}
+            """)
+            conn.execute(
+                f"DELETE FROM {table} "
+                f"WHERE {key_col} IN (SELECT {key_col} FROM _changes)"
+            )
+            upserted = conn.execute(
+                f"INSERT INTO {table} SELECT * FROM _changes"
+            ).fetchone()[0]
+            conn.execute("DROP TABLE _changes")
+        conn.execute("DROP TABLE _staging")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if unpartitioned:
+        shutil.rmtree(data_dir / table_name, ignore_errors=True)
+    return upserted, rejected, rebuild
+
+def load_sources(conn, force: bool = False, data_dir: Path = DATA_DIR,
+                 storage: Optional[str] = None):
+    """Load every source file that changed since the last run.
+
+    Returns the names of the changed tables.
+
+    storage ("table" or "parquet") changes the storage layout of the tables
+    that can be partitioned, reloading them; by default they keep theirs.
+    """
+    ensure_load_state(conn)
+    changed_tables = []
+    for table_name, name, key in SOURCES:
+        path = source_path(data_dir, name)
+        changed, state = source_changed(conn, table_name, path)
+        # Rows rejected for a missing parent may be valid once the parent table
+        # changed
+        parent_changed = any(
+            parent in changed_tables
+            for _, parent, _ in FOREIGN_KEYS.get(table_name, [])
+        )
+        layout = table_storage(conn, table_name, storage)
+        layout_changed = layout != table_storage(conn, table_name)
+        if not (force or changed or parent_changed or layout_changed
+                or not table_exists(conn, table_name)):
+            record_load_state(conn, table_name, path, state)
+            print(f"{table_name}: unchanged")
+            continue
+
+        upserted, rejected, rebuilt = load_table(
+            conn, table_name, path, key, layout, data_dir
+        )
+        record_load_state(conn, table_name, path, state)
+        action = "rebuilt with" if rebuilt else "upserted"
+        print(f"{table_name}: {action} {upserted} row(s), "
+              f"rejected {rejected} with missing foreign keys")
+        if upserted or rebuilt:
+            changed_tables.append(table_name)
+    # Invalidates results cached for queries over the changed tables
+    bump_table_versions(conn, changed_tables)
+    track_table_versions(conn, [table_name for table_name, _, _ in SOURCES])
+    return changed_tables
+
+def append_rows(conn, table_name: str, path: str, data_dir: Path = DATA_DIR) -> int:
+    """Upsert the rows of an extra file, such as a day of new orders, into a table.
+
+    The table keeps its storage layout; stored as Parquet, rows of months
+    that have no changed rows are written as new files only. Returns the rows
+    upserted.
+    """
+    key = next(key for source_table, _, key in SOURCES if source_table == table_name)
+    upserted, rejected, _ = load_table(
+        conn, table_name, path, key, table_storage(conn, table_name), data_dir
+    )
+    print(f"{table_name}: appended {upserted} row(s), "
+          f"rejected {rejected} with missing foreign keys")
+    if upserted:
+        bump_table_versions(conn, [table_name])
+    return upserted
+
+def write_schema_metadata(conn):
+    """Replace the schema metadata table."""
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        conn.execute("DROP TABLE IF EXISTS schema_metadata")
+
+        # Create schema metadata table
+        conn.execute("""
+        CREATE TABLE schema_metadata (
+            table_name VARCHAR,
+            column_name VARCHAR,
+            description VARCHAR
+        )
+        """)
+
+        # Insert schema metadata
+        conn.execute("""
+        INSERT INTO schema_metadata VALUES
+            ('products', NULL, 'Life insurance products available for purchase'),
+            ('products', 'product_id', 'Unique identifier for the product'),
+            ('products', 'product_name', 'Name of the insurance product'),
+            ('products', 'coverage_type', 'Type of life insurance coverage'),
+            ('products', 'term_length_years', 'Length of term for term life insurance (NULL for permanent policies)'),
+            ('products', 'base_premium', 'Base monthly premium amount'),
+            ('products', 'max_coverage_amount', 'Maximum coverage amount available'),
+
+            ('customers', NULL, 'Customer information'),
+            ('customers', 'customer_id', 'Unique identifier for the customer'),
+            ('customers', 'first_name', 'Customer first name'),
+            ('customers', 'last_name', 'Customer last name'),
+            ('customers', 'email', 'Customer email address'),
+            ('customers', 'phone', 'Customer phone number'),
+            ('customers', 'address', 'Customer street address'),
+            ('customers', 'city', 'Customer city'),
+            ('customers', 'state', 'Customer state'),
+            ('customers', 'zip_code', 'Customer zip code'),
+            ('customers', 'date_of_birth', 'Customer date of birth'),
+            ('customers', 'age', 'Customer age in years'),
+
+            ('orders', NULL, 'Insurance policy orders'),
+            ('orders', 'order_id', 'Unique identifier for the order'),
+            ('orders', 'customer_id', 'ID of the customer who placed the order'),
+            ('orders', 'product_id', 'ID of the product ordered'),
+            ('orders', 'order_date', 'Date the order was placed'),
+            ('orders', 'premium_amount', 'Monthly premium amount for the policy'),
+            ('orders', 'coverage_amount', 'Coverage amount for the policy'),
+            ('orders', 'payment_status',
+             'Status of the payment (Paid, Pending, Failed)'),
+            ('orders', 'policy_status',
+             'Status of the policy (Active, Pending, Cancelled)')
+        """)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Load changed CSV/Parquet sources into the database."
+    )
+    parser.add_argument("--force", action="store_true",
+                        help="Reload every source even if unchanged")
+    parser.add_argument("--storage", choices=["table", "parquet"],
+                        help="Store orders in the database or as Parquet "
+                             "partitioned by month (default: unchanged)")
+    parser.add_argument("--append", nargs=2, metavar=("TABLE", "FILE"),
+                        help="Upsert the rows of an extra CSV/Parquet file into "
+                             "a table instead of loading the sources")
+    args = parser.parse_args()
+
+    conn = duckdb.connect(str(DB_PATH))
+
+    if args.append:
+        append_rows(conn, args.append[0], args.append[1])
+    else:
+        load_sources(conn, force=args.force, storage=args.storage)
+    write_schema_metadata(conn)
+
+    # Verify the data was loaded correctly
+    print("\nProducts table:")
+    print(conn.execute("SELECT * FROM products LIMIT 5").pl())
+
+    print("\nCustomers table:")
+    print(conn.execute("SELECT * FROM customers LIMIT 5").pl())
+
+    print("\nOrders table:")
+    print(conn.execute("SELECT * FROM orders LIMIT 5").pl())
+
+    # Refresh column profiles of the tables whose data changed
+    profiled = profile_database(conn)
+    print(f"\nProfiled {len(profiled)} changed table(s): "
+          f"{', '.join(profiled) or 'none'}")
+
+    # Bring the rollup tables up to date with the changed tables
+    refreshed = refresh_rollups(conn, force=args.force)
+    for rollup_name, action in refreshed.items():
+        print(f"{rollup_name}: {action}")
+
+    # Close the connection
+    conn.close()
+
+    print("\nDatabase updated successfully!")
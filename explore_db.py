@@ -5,15 +5,13 @@
 
 # %%
 # Import required libraries
-import duckdb
 import polars as pl
-from pathlib import Path
 import matplotlib.pyplot as plt
 import seaborn as sns
+from struct_llm.database import get_connection_manager
 
-# Set up the database connection
-DB_PATH = Path("data/database.db")
-conn = duckdb.connect(str(DB_PATH))
+# Share the read-only database with the rest of the app
+conn = get_connection_manager()
 
 # %% [markdown]
 # ## Database Schema
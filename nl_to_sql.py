@@ -1,71 +1,444 @@
-import json
+from __future__ import annotations
+
 import os
+import threading
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
-import duckdb
-import polars as pl
-import requests
-from dotenv import load_dotenv
-from openai import OpenAI
+from struct_llm.errors import ConfigurationError, LLMError, QueryError
+from struct_llm.retrieval import count_tokens
 
-# Load environment variables
-load_dotenv()
+# openai, polars, pyarrow, duckdb, dotenv, asyncio and the metrics and repair
+# modules are imported on first use, so that importing this module stays cheap
+# for Streamlit workers, tests and tooling
+if TYPE_CHECKING:
+    import polars as pl
+    import pyarrow as pa
 
-# Set up OpenAI client
-api_key = os.getenv('OPENAI_API_KEY')
-if not api_key:
-    raise ValueError("OPENAI_API_KEY not found in environment variables")
-client = OpenAI(api_key=api_key)
+    from struct_llm.charts import Chart
+    from struct_llm.export import ExportProgress, ExportStream
+    from struct_llm.metrics import Trace
+    from struct_llm.streaming import SqlStream
 
-# Set up the database connection
-DB_PATH = Path("data/database.db")
-conn = duckdb.connect(str(DB_PATH))
+T = TypeVar("T")
 
-def get_table_metadata() -> Dict:
-    """Get metadata about all tables and their columns from DuckDB using our schema_metadata table."""
-    metadata_query = """
-    SELECT 
-        table_name,
-        column_name,
-        description
-    FROM schema_metadata
-    ORDER BY 
-        table_name,
-        column_name IS NOT NULL,
-        column_name
-    """
-    metadata_rows = conn.execute(metadata_query).fetchall()
-    
-    # Organize metadata by table
-    tables = {}
-    for table_name, column_name, description in metadata_rows:
-        if table_name not in tables:
-            tables[table_name] = {
-                'description': None,
-                'columns': []
-            }
-        if column_name is None:
-            tables[table_name]['description'] = description
-        else:
-            tables[table_name]['columns'].append((column_name, description))
+SYSTEM_PROMPT = (
+    "You are a SQL expert. "
+    "Generate only the SQL query without any explanation or markdown formatting."
+)
+
+@dataclass
+class Settings:
+    """Configuration of the pipeline. from_env() reads it from the environment."""
+    openai_api_key: Optional[str] = None
+    model: str = "gpt-3.5-turbo"
+    # Low temperature for more deterministic SQL generation
+    temperature: float = 0.1
+    # "openai" for the OpenAI SDK, "http" for a requests session to an
+    # OpenAI-compatible endpoint
+    llm_backend: str = "openai"
+    llm_base_url: str = "https://api.openai.com/v1"
+    llm_connect_timeout: float = 5.0
+    llm_timeout: float = 60.0
+    # Retries of rate limited, failed or dropped LLM requests
+    llm_retries: int = 2
+    # Keep-alive connections kept open to the LLM endpoint by the "http" backend
+    llm_pool_size: int = 8
+    # Cheaper model for short prompts over few tables, see struct_llm.llm.RoutingBackend
+    small_model: Optional[str] = None
+    small_model_max_tokens: int = 1500
+    small_model_max_tables: int = 2
+    # Number of tables the schema retrieval stage puts in the prompt
+    schema_top_k: int = 8
+    # Hard cap on the rows the UI will page through for a single result
+    max_result_rows: int = 100_000
+    # Points per chart of a result, however many rows it has; see struct_llm.charts
+    chart_max_points: int = 2000
+    # Generated SQL whose plan has an operator estimated to produce more rows is
+    # rejected before it runs; 0 disables the check
+    max_estimated_rows: int = 100_000_000
+    # Generated SQL running longer than this many seconds is interrupted; 0
+    # disables the timeout
+    query_timeout: float = 30.0
+    # Run generated SQL in this many worker processes, see struct_llm.workers; 0
+    # runs it in-process
+    query_processes: int = 0
+    # DuckDB memory limit of each query worker process, e.g. "2GB"; a worker runs
+    # one query at a time
+    query_memory_limit: Optional[str] = None
+    # Byte budgets of the result cache's memory and disk tiers; 0 disables a tier
+    result_cache_memory_bytes: int = 256 << 20
+    result_cache_disk_bytes: int = 1 << 30
+    # LLM calls made to repair SQL that DuckDB rejects and no local fix applies to
+    sql_repair_attempts: int = 1
+    # Answer aggregate queries from the pre-aggregated rollup tables where possible
+    use_rollups: bool = True
+    # Add the partition filters implied by date filters on partitioned Parquet
+    # views, see struct_llm.partitions
+    prune_partitions: bool = True
+    # Log every question to the query history and use it for the two settings below
+    query_history: bool = True
+    # Similar past questions put in the prompt as examples, with their SQL; 0 disables
+    history_examples: int = 3
+    # Reuse the SQL of a past question that is the same after normalization,
+    # without calling the LLM
+    history_reuse_sql: bool = True
+    # Append every question's trace to this JSON-lines file
+    metrics_log: Optional[str] = None
     
-    return tables
+    @classmethod
+    def from_env(cls) -> Settings:
+        from dotenv import load_dotenv
+        load_dotenv()
+        return cls(
+            openai_api_key=os.getenv('OPENAI_API_KEY'),
+            model=os.getenv('OPENAI_MODEL', cls.model),
+            llm_backend=os.getenv('LLM_BACKEND', cls.llm_backend),
+            llm_base_url=os.getenv('OPENAI_BASE_URL', cls.llm_base_url),
+            llm_connect_timeout=float(
+                os.getenv('LLM_CONNECT_TIMEOUT_SECONDS', str(cls.llm_connect_timeout))
+            ),
+            llm_timeout=float(os.getenv('LLM_TIMEOUT_SECONDS', str(cls.llm_timeout))),
+            llm_retries=int(os.getenv('LLM_RETRIES', str(cls.llm_retries))),
+            llm_pool_size=int(os.getenv('LLM_POOL_SIZE', str(cls.llm_pool_size))),
+            small_model=os.getenv('OPENAI_SMALL_MODEL') or None,
+            small_model_max_tokens=int(
+                os.getenv('SMALL_MODEL_MAX_TOKENS', str(cls.small_model_max_tokens))
+            ),
+            small_model_max_tables=int(
+                os.getenv('SMALL_MODEL_MAX_TABLES', str(cls.small_model_max_tables))
+            ),
+            schema_top_k=int(os.getenv('SCHEMA_TOP_K', str(cls.schema_top_k))),
+            max_result_rows=int(os.getenv('MAX_RESULT_ROWS', str(cls.max_result_rows))),
+            chart_max_points=int(
+                os.getenv('CHART_MAX_POINTS', str(cls.chart_max_points))
+            ),
+            max_estimated_rows=int(
+                os.getenv('MAX_ESTIMATED_ROWS', str(cls.max_estimated_rows))
+            ),
+            query_timeout=float(
+                os.getenv('QUERY_TIMEOUT_SECONDS', str(cls.query_timeout))
+            ),
+            query_processes=int(os.getenv('QUERY_PROCESSES', str(cls.query_processes))),
+            query_memory_limit=os.getenv('QUERY_MEMORY_LIMIT') or None,
+            sql_repair_attempts=int(
+                os.getenv('SQL_REPAIR_ATTEMPTS', str(cls.sql_repair_attempts))
+            ),
+            use_rollups=os.getenv('USE_ROLLUPS', '1') != '0',
+            prune_partitions=os.getenv('PRUNE_PARTITIONS', '1') != '0',
+            query_history=os.getenv('QUERY_HISTORY', '1') != '0',
+            history_examples=int(
+                os.getenv('HISTORY_EXAMPLES', str(cls.history_examples))
+            ),
+            history_reuse_sql=os.getenv('HISTORY_REUSE_SQL', '1') != '0',
+            result_cache_memory_bytes=int(
+                float(os.getenv('RESULT_CACHE_MEMORY_MB', '256')) * (1 << 20)
+            ),
+            result_cache_disk_bytes=int(
+                float(os.getenv('RESULT_CACHE_DISK_MB', '1024')) * (1 << 20)
+            ),
+            metrics_log=os.getenv('METRICS_LOG') or None,
+        )
 
-def create_prompt(user_question: str, metadata: Dict) -> str:
-    """Create a prompt for the LLM that includes database schema and user question."""
-    # Convert metadata dict to string format
-    metadata_str = "\n\n".join([
-        f"Table: {table_name}\nDescription: {info['description']}\nColumns:\n" + 
-        "\n".join([f"- {col_name}: {col_desc}" for col_name, col_desc in info['columns']])
-        for table_name, info in metadata.items()
-    ])
+class Engine:
+    """The pipeline's settings, LLM, database, schema catalog, caches, history, metrics.
+    
+    Each is created on first use. Pass any of them in to replace the default,
+    e.g. a fake client or an in-memory database.
+    """
+    
+    def __init__(self, settings: Optional[Settings] = None, client=None,
+                 async_client=None, conn=None, catalog=None, translation_cache=None,
+                 metrics=None, result_cache=None, history=None, llm=None,
+                 query_pool=None):
+        self._settings = settings
+        self._client = client
+        self._async_client = async_client
+        self._llm = llm
+        self._conn = conn
+        self._catalog = catalog
+        self._translation_cache = translation_cache
+        self._metrics = metrics
+        self._guard = None
+        self._rollup_rewriter = None
+        self._partition_pruner = None
+        self._result_cache = result_cache
+        self._history = history
+        self._query_pool = query_pool
+        self._lock = threading.RLock()
+    
+    def _get(self, name: str, factory: Callable[[], Any]) -> Any:
+        value = getattr(self, name)
+        if value is None:
+            with self._lock:
+                value = getattr(self, name)
+                if value is None:
+                    value = factory()
+                    setattr(self, name, value)
+        return value
+    
+    @property
+    def settings(self) -> Settings:
+        return self._get('_settings', Settings.from_env)
+    
+    def _api_key(self) -> str:
+        api_key = self.settings.openai_api_key
+        if not api_key:
+            raise ConfigurationError(
+                "OPENAI_API_KEY not found in environment variables"
+            )
+        return api_key
+    
+    @property
+    def llm(self):
+        """Backend the prompts are sent to, see struct_llm.llm.
+        
+        An OpenAI client passed to the engine is used as is; otherwise the
+        llm_backend setting picks the OpenAI SDK or a requests session, and
+        small_model routes simple prompts to a cheaper model.
+        """
+        def create():
+            from struct_llm.llm import HTTPBackend, OpenAIClientBackend, RoutingBackend
+            settings = self.settings
+            
+            def backend(model: str):
+                if self._client is not None:
+                    # An injected client only runs asynchronously next to an injected
+                    # async client
+                    return OpenAIClientBackend(
+                        self._client, model, settings.temperature, self._async_client
+                    )
+                if settings.llm_backend == 'openai':
+                    return OpenAIClientBackend(
+                        self.client, model, settings.temperature,
+                        async_client_factory=lambda: self.async_client,
+                    )
+                if settings.llm_backend != 'http':
+                    raise ConfigurationError(
+                        f"Unknown LLM_BACKEND {settings.llm_backend!r}, "
+                        "expected 'openai' or 'http'"
+                    )
+                return HTTPBackend(
+                    self._api_key(), model, settings.llm_base_url,
+                    settings.temperature, settings.llm_connect_timeout,
+                    settings.llm_timeout, settings.llm_retries,
+                    pool_size=settings.llm_pool_size,
+                )
+            if settings.small_model:
+                return RoutingBackend(
+                    backend(settings.small_model), backend(settings.model),
+                    settings.small_model_max_tokens, settings.small_model_max_tables,
+                )
+            return backend(settings.model)
+        return self._get('_llm', create)
+    
+    @property
+    def client(self):
+        """OpenAI client, used when the llm_backend setting is "openai"."""
+        def create():
+            from openai import OpenAI
+            return OpenAI(**self._client_options())
+        return self._get('_client', create)
+    
+    @property
+    def async_client(self):
+        """Async OpenAI client."""
+        def create():
+            from openai import AsyncOpenAI
+            return AsyncOpenAI(**self._client_options())
+        return self._get('_async_client', create)
+    
+    def _client_options(self) -> Dict[str, Any]:
+        """Endpoint, timeouts and retries of the OpenAI clients, from the settings."""
+        from openai import Timeout
+        settings = self.settings
+        return dict(
+            api_key=self._api_key(),
+            base_url=settings.llm_base_url,
+            timeout=Timeout(settings.llm_timeout, connect=settings.llm_connect_timeout),
+            max_retries=settings.llm_retries,
+        )
+    
+    @property
+    def conn(self):
+        """Shared read-only database; each thread queries on a cursor of its own."""
+        def create():
+            from struct_llm.database import get_connection_manager
+            return get_connection_manager()
+        return self._get('_conn', create)
+    
+    @property
+    def query_pool(self):
+        """Worker processes generated SQL runs in, or None to run it in-process.
+        
+        See struct_llm.workers.
+        """
+        if self._query_pool is None and not self.settings.query_processes:
+            return None
+        def create():
+            from struct_llm.workers import QueryProcessPool
+            settings = self.settings
+            return QueryProcessPool(
+                processes=settings.query_processes,
+                memory_limit=settings.query_memory_limit,
+                temp_directory=os.getenv('DUCKDB_TEMP_DIRECTORY'),
+            )
+        return self._get('_query_pool', create)
+    
+    @property
+    def catalog(self):
+        """Schema metadata, reloaded only when schema_metadata changes."""
+        def create():
+            from struct_llm.catalog import SchemaCatalog
+            return SchemaCatalog(self.conn)
+        return self._get('_catalog', create)
+    
+    @property
+    def translation_cache(self):
+        """Cache of question -> SQL translations, persisted across restarts."""
+        def create():
+            from struct_llm.cache import TranslationCache
+            return TranslationCache()
+        return self._get('_translation_cache', create)
+    
+    @property
+    def result_cache(self):
+        """Cache of query results, invalidated when the tables they read reload."""
+        def create():
+            from struct_llm.result_cache import ResultCache
+            settings = self.settings
+            return ResultCache(
+                settings.result_cache_memory_bytes, settings.result_cache_disk_bytes
+            )
+        return self._get('_result_cache', create)
+    
+    @property
+    def guard(self):
+        """Pre-flight cost check and timeout applied to generated SQL."""
+        def create():
+            from struct_llm.guard import QueryGuard
+            settings = self.settings
+            return QueryGuard(
+                settings.max_estimated_rows, settings.max_result_rows,
+                settings.query_timeout,
+            )
+        return self._get('_guard', create)
+    
+    @property
+    def rollup_rewriter(self):
+        """Rewrite of aggregate queries to read rollup tables, see struct_llm.rollup."""
+        def create():
+            from struct_llm.rollup import RollupRewriter
+            return RollupRewriter(None if self.settings.use_rollups else [])
+        return self._get('_rollup_rewriter', create)
+    
+    @property
+    def partition_pruner(self):
+        """Adds partition filters to queries over partitioned Parquet views.
+        
+        See struct_llm.partitions.
+        """
+        def create():
+            from struct_llm.partitions import PartitionPruner
+            return PartitionPruner(None if self.settings.prune_partitions else [])
+        return self._get('_partition_pruner', create)
+    
+    @property
+    def history(self):
+        """Log of the questions processed, searched for similar past questions.
+        
+        See struct_llm.history.
+        """
+        def create():
+            from struct_llm.history import QueryHistory
+            return QueryHistory()
+        return self._get('_history', create)
+    
+    @property
+    def metrics(self):
+        """Aggregated traces of the questions processed, see struct_llm.metrics.
+        
+        Every recorded trace is also logged to the query history, unless it is
+        disabled.
+        """
+        def create():
+            from struct_llm.metrics import MetricsRegistry, jsonl_hook
+            registry = MetricsRegistry()
+            if self.settings.metrics_log:
+                registry.add_hook(jsonl_hook(self.settings.metrics_log))
+            if self.settings.query_history:
+                registry.add_hook(self.history.record)
+            return registry
+        return self._get('_metrics', create)
+
+_engine: Optional[Engine] = None
+_engine_lock = threading.Lock()
+
+def get_engine() -> Engine:
+    """The engine of the module-level functions, created from the environment."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = Engine()
+        return _engine
+
+def set_engine(engine: Engine):
+    """Replace the engine used by the module-level functions."""
+    global _engine
+    with _engine_lock:
+        _engine = engine
+
+def __getattr__(name: str):
+    # Module attributes from before initialization was made lazy
+    if name in ('client', 'async_client', 'llm', 'conn', 'catalog',
+                'translation_cache', 'result_cache', 'metrics', 'history'):
+        return getattr(get_engine(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get_table_metadata() -> Dict:
+    """Get metadata about all tables and their columns, reloaded on changes only."""
+    catalog = get_engine().catalog
+    catalog.refresh()
+    return catalog.tables
+
+def create_prompt(user_question: str, metadata: Dict,
+                  schema_block: Optional[str] = None,
+                  examples: Iterable[Tuple[str, str]] = ()) -> str:
+    """Create a prompt for the LLM that includes database schema and user question.
+    
+    Pass a precompiled schema_block (see SchemaCatalog) to skip rendering the
+    metadata dict. examples are (question, SQL) pairs answered before, shown
+    to the LLM as few-shot examples.
+    """
+    if schema_block is None:
+        from struct_llm.catalog import render_schema
+        schema_block = render_schema(metadata)
+    metadata_str = schema_block
+    examples_str = "".join(
+        f"\nQuestion: {question}\nSQL: {sql}\n" for question, sql in examples
+    )
+    if examples_str:
+        examples_str = f"\nQuestions answered correctly before:\n{examples_str}"
     
     prompt = f"""You are a SQL expert. Given the following database schema and user question, generate a SQL query.
 
 Database Schema:
 {metadata_str}
-
+{examples_str}
 User Question: {user_question}
 
 Generate a SQL query that answers the user's question. Return ONLY the raw SQL query without any explanation, markdown formatting, or code blocks.
@@ -85,38 +458,726 @@ Example of correct column references:
 """
     return prompt
 
-def get_sql_from_openai(prompt: str) -> str:
-    """Send prompt to OpenAI API and get SQL query response."""
+def create_repair_prompt(user_question: str, schema_block: str, sql: str,
+                         error: str) -> str:
+    """Create a prompt asking the LLM to fix SQL that DuckDB rejected."""
+    return f"""You are a SQL expert. The following DuckDB SQL query was generated
+to answer the user's question, but DuckDB rejected it.
+
+Database Schema:
+{schema_block}
+
+User Question: {user_question}
+
+SQL Query:
+{sql}
+
+DuckDB Error:
+{error}
+
+Return ONLY the corrected raw SQL query without any explanation, markdown
+formatting, or code blocks.
+Prefix every column name with its table name or alias.
+"""
+
+def prepare_prompt(user_question: str,
+                   examples: Iterable[Tuple[str, str]] = ()) -> Tuple[str, Dict]:
+    """Build the prompt from the tables relevant to the question and the examples.
+    
+    Returns the prompt and prompt statistics: the selected tables and the
+    approximate token count of the prompt versus one with the full schema.
+    Uses the catalog as of its last refresh.
+    """
+    engine = get_engine()
+    catalog = engine.catalog
+    table_names = catalog.select_tables(user_question, engine.settings.schema_top_k)
+    schema_block = catalog.schema_block_for(table_names)
+    prompt = create_prompt(user_question, catalog.tables, schema_block, examples)
+    prompt_tokens = count_tokens(prompt)
+    stats = {
+        'tables': table_names,
+        'prompt_tokens': prompt_tokens,
+        'full_schema_prompt_tokens': (
+            prompt_tokens - count_tokens(schema_block) + catalog.schema_tokens
+        ),
+    }
+    return prompt, stats
+
+def _messages(prompt: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def get_sql_from_openai(prompt: str, trace: Optional[Trace] = None) -> str:
+    """Send prompt to the engine's LLM backend and get SQL query response.
+    
+    If a trace is passed, the model and token usage of the response are added to it.
+    """
+    engine = get_engine()
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a SQL expert. Generate only the SQL query without any explanation or markdown formatting."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1  # Low temperature for more deterministic SQL generation
-        )
+        return engine.llm.complete(_messages(prompt), trace).strip()
+    except ConfigurationError:
+        raise
+    except Exception as e:
+        raise LLMError(f"Error from OpenAI API: {str(e)}") from e
+
+def stream_sql_from_openai(prompt: str, trace: Optional[Trace] = None) -> Iterator[str]:
+    """Send prompt to the engine's LLM backend and yield the response as it comes.
+    
+    Closing the iterator early closes the HTTP stream, which stops the
+    generation. If a trace is passed, the token usage is added to it when the
+    API reports it at the end of the stream.
+    """
+    engine = get_engine()
+    deltas = None
+    try:
+        deltas = engine.llm.stream(_messages(prompt), trace)
+        yield from deltas
+    except ConfigurationError:
+        raise
+    except Exception as e:
+        raise LLMError(f"Error from OpenAI API: {str(e)}") from e
+    finally:
+        if deltas is not None:
+            deltas.close()
+
+async def get_sql_from_openai_async(prompt: str, trace: Optional[Trace] = None) -> str:
+    """Async variant of get_sql_from_openai.
+    
+    API errors are raised unwrapped so callers can inspect their status code and retry.
+    """
+    engine = get_engine()
+    return (await engine.llm.complete_async(_messages(prompt), trace)).strip()
+
+def _new_trace(question: str) -> Trace:
+    from struct_llm.metrics import Trace
+    return Trace(question)
+
+def _query_cursor(connection=None):
+    """The given connection or cursor, else the calling thread's shared cursor.
+    
+    Interrupting it stops only the query of the calling thread.
+    """
+    conn = connection or get_engine().conn
+    thread_cursor = getattr(conn, 'thread_cursor', None)
+    return thread_cursor() if thread_cursor is not None else conn
+
+def _use_rollups(cursor, sql: str, trace: Optional[Trace] = None) -> str:
+    """Rewrite a query to read the rollup tables that can answer it, if any.
+    
+    The rollups read are recorded in the trace.
+    """
+    rewritten = get_engine().rollup_rewriter.rewrite(cursor, sql)
+    if rewritten is None:
+        return sql
+    sql, rollups = rewritten
+    if trace is not None:
+        trace.rollups = rollups
+    return sql
+
+def _prune_partitions(cursor, sql: str) -> str:
+    """Add the partition filters implied by date filters on partitioned views."""
+    pruned = get_engine().partition_pruner.prune(cursor, sql)
+    return sql if pruned is None else pruned
+
+def execute_query(sql: str, connection=None, trace: Optional[Trace] = None,
+                  on_wait: Optional[Callable[[], None]] = None,
+                  auto_limit: bool = True) -> pl.DataFrame:
+    """Execute SQL query and return results as a Polars DataFrame.
+    
+    Runs on the shared connection unless another connection or cursor is given.
+    With the query_processes setting, the query itself runs in the engine's
+    worker processes instead (see struct_llm.workers); on_wait is then called
+    while it runs, and an exception it raises cancels the query.
+    Results are handed from DuckDB to Polars as Arrow, without going through
+    pandas. Results are served from and stored in the engine's result cache,
+    which is invalidated when any table the query reads is reloaded.
+    On a cache miss, aggregate queries a rollup table can answer are rewritten
+    to read it (see struct_llm.rollup), and date filters on partitioned views
+    get the matching partition filters (see struct_llm.partitions). Then the
+    engine's guard checks the plan: too expensive queries raise
+    QueryRejectedError, large results are limited to max_result_rows unless
+    auto_limit is off, and queries running past the timeout raise
+    QueryTimeoutError. If a trace is passed, the rewrites, guard, query
+    execution and conversion to Polars are timed as the rollup, partitions,
+    guard, execute and fetch stages, and the result size is recorded.
+    """
+    engine = get_engine()
+    guard = engine.guard
+    result_cache = engine.result_cache
+    trace = trace if trace is not None else _new_trace(sql)
+    cursor = _query_cursor(connection)
+    watchdog = guard.watchdog(cursor)
+    try:
+        with trace.stage("result_cache"):
+            cache_key = result_cache.key(cursor, sql)
+            cached = result_cache.get(cache_key) if cache_key is not None else None
+        if cache_key is not None:
+            trace.result_cache_hit = cached is not None
+        if cached is not None:
+            import polars as pl
+            result = pl.from_arrow(cached)
+            trace.record_result(result)
+            return result
         
-        return response.choices[0].message.content.strip()
+        with trace.stage("rollup"):
+            sql = _use_rollups(cursor, sql, trace)
+        with trace.stage("partitions"):
+            sql = _prune_partitions(cursor, sql)
+        with trace.stage("guard"):
+            guarded_sql, estimate = guard.check(cursor, sql, auto_limit)
+        if estimate is not None:
+            trace.estimated_rows = estimate.output_rows
+            trace.limited = guarded_sql != sql
+        sql = guarded_sql
+        query_pool = engine.query_pool if connection is None else None
+        if query_pool is not None:
+            with trace.stage("execute"):
+                table = query_pool.run(sql, guard.timeout, on_wait)
+            with trace.stage("fetch"):
+                import polars as pl
+                result = pl.from_arrow(table)
+        else:
+            with trace.stage("execute"), watchdog:
+                relation = cursor.execute(sql)
+            with trace.stage("fetch"), watchdog:
+                result = relation.pl()
+    except QueryError:
+        raise
     except Exception as e:
-        raise Exception(f"Error from OpenAI API: {str(e)}")
+        raise QueryError(f"Error executing query: {str(e)}") from e
+    finally:
+        watchdog.cancel()
+    if cache_key is not None:
+        result_cache.put(cache_key, result.to_arrow())
+    trace.record_result(result)
+    return result
 
-def execute_query(sql: str) -> pl.DataFrame:
-    """Execute SQL query and return results as a Polars DataFrame."""
+def _full_result_cursor(sql: str) -> Tuple[Any, str]:
+    """A cursor of its own for reading the full result of a query.
+    
+    Returned with the query as checked by the guard.
+    """
+    engine = get_engine()
+    cursor = engine.conn.cursor()
     try:
-        result = conn.execute(sql).fetchdf()
-        return pl.from_pandas(result)
+        sql = _prune_partitions(cursor, _use_rollups(cursor, sql))
+        # Full results are wanted here, so the guard only rejects, never limits
+        sql, _ = engine.guard.check(cursor, sql, auto_limit=False)
     except Exception as e:
-        raise Exception(f"Error executing query: {str(e)}")
+        cursor.close()
+        if isinstance(e, QueryError):
+            raise
+        raise QueryError(f"Error executing query: {str(e)}") from e
+    return cursor, sql
 
-def process_question(user_question: str) -> tuple[str, pl.DataFrame]:
-    """Process a user question and return the generated SQL and results."""
-    metadata = get_table_metadata()
-    prompt = create_prompt(user_question, metadata)
-    sql = get_sql_from_openai(prompt)
-    result = execute_query(sql)
+def stream_query(sql: str, batch_size: int = 100_000) -> Iterator[pa.RecordBatch]:
+    """Execute SQL query and yield the results as Arrow record batches.
+    
+    Batches hold up to batch_size rows. Only one batch is materialized at a
+    time, so large results can be processed with bounded memory. The query
+    runs on a cursor of its own, which stays open until the iterator is
+    exhausted or closed.
+    """
+    cursor, sql = _full_result_cursor(sql)
+    try:
+        try:
+            reader = cursor.execute(sql).fetch_record_batch(batch_size)
+        except Exception as e:
+            raise QueryError(f"Error executing query: {str(e)}") from e
+        for batch in reader:
+            yield batch
+    finally:
+        cursor.close()
+
+def _search_history(user_question: str,
+                    trace: Trace) -> Tuple[Optional[str], List[Tuple[str, str]]]:
+    """Look the question up in the query history, for the catalog's current schema.
+    
+    Returns the SQL of a past question that is the same after normalization,
+    to be reused as is, or else the (question, SQL) pairs of similar ones to
+    put in the prompt as examples. Similar questions are never answered
+    directly: "paid orders" and "unpaid orders" share most of their n-grams.
+    """
+    from struct_llm.cache import normalize_question
+    
+    engine = get_engine()
+    settings = engine.settings
+    if not settings.query_history:
+        return None, []
+    with trace.stage("history"):
+        matches = engine.history.lookup(user_question, engine.catalog.fingerprint,
+                                        max(1, settings.history_examples))
+    if (matches and settings.history_reuse_sql
+            and normalize_question(matches[0].question)
+            == normalize_question(user_question)):
+        trace.history = "answered"
+        trace.sql = matches[0].sql
+        return matches[0].sql, []
+    examples = [
+        (match.question, match.sql)
+        for match in matches[:settings.history_examples]
+    ]
+    if examples:
+        trace.history = "examples"
+    return None, examples
+
+def _reuse_or_prompt(user_question: str, stats: Optional[Dict],
+                     trace: Trace) -> Tuple[Optional[str], Optional[str]]:
+    """The stages before the LLM: metadata, cache, history and prompt.
+    
+    Returns the SQL to reuse from the translation cache or the query history,
+    or else the prompt to send to the LLM.
+    """
+    engine = get_engine()
+    with trace.stage("metadata"):
+        engine.catalog.refresh()
+    trace.schema_fingerprint = engine.catalog.fingerprint
+    with trace.stage("cache"):
+        cached_sql = engine.translation_cache.get(
+            user_question, engine.catalog.fingerprint
+        )
+    trace.cache_hit = cached_sql is not None
+    if cached_sql is not None:
+        trace.sql = cached_sql
+        return cached_sql, None
+    past_sql, examples = _search_history(user_question, trace)
+    if past_sql is not None:
+        return past_sql, None
+    
+    with trace.stage("prompt"):
+        prompt, prompt_stats = prepare_prompt(user_question, examples)
+    if stats is not None:
+        stats.update(prompt_stats)
+    return None, prompt
+
+def generate_sql(user_question: str, stats: Optional[Dict] = None,
+                 trace: Optional[Trace] = None) -> Tuple[str, bool]:
+    """Translate a question to SQL, from the cache, the query history or the LLM.
+    
+    Returns the SQL and whether it was reused rather than generated: from the
+    cache, or from a past question in the history that is the same.
+    Otherwise similar past questions are given to the LLM as examples. If a
+    stats dict is passed, it is filled with the prompt statistics from
+    prepare_prompt. If a trace is passed, the metadata, cache, history, prompt
+    and llm stages are timed in it.
+    """
+    trace = trace if trace is not None else _new_trace(user_question)
+    reused_sql, prompt = _reuse_or_prompt(user_question, stats, trace)
+    if reused_sql is not None:
+        return reused_sql, True
+    with trace.stage("llm"):
+        response = get_sql_from_openai(prompt, trace)
+    with trace.stage("repair"):
+        from struct_llm.repair import clean_sql
+        trace.sql = clean_sql(response)
+    return trace.sql, False
+
+async def generate_sql_async(user_question: str, stats: Optional[Dict] = None,
+                             trace: Optional[Trace] = None, executor=None,
+                             semaphore=None) -> Tuple[str, bool]:
+    """Async variant of generate_sql, for servers running many questions on a loop.
+    
+    The stages before the LLM read DuckDB and run in executor (default: the
+    loop's default executor); the LLM call is awaited without holding a thread
+    when the backend supports it, after acquiring semaphore if one is given.
+    The llm stage includes the wait. LLM errors are raised as LLMError.
+    """
+    import asyncio
+    
+    trace = trace if trace is not None else _new_trace(user_question)
+    loop = asyncio.get_running_loop()
+    reused_sql, prompt = await loop.run_in_executor(
+        executor, _reuse_or_prompt, user_question, stats, trace
+    )
+    if reused_sql is not None:
+        return reused_sql, True
+    with trace.stage("llm"):
+        try:
+            if semaphore is None:
+                response = await get_sql_from_openai_async(prompt, trace)
+            else:
+                async with semaphore:
+                    response = await get_sql_from_openai_async(prompt, trace)
+        except ConfigurationError:
+            raise
+        except Exception as e:
+            raise LLMError(f"Error from OpenAI API: {str(e)}") from e
+    with trace.stage("repair"):
+        from struct_llm.repair import clean_sql
+        trace.sql = clean_sql(response)
+    return trace.sql, False
+
+def generate_sql_stream(user_question: str, stats: Optional[Dict] = None,
+                        trace: Optional[Trace] = None) -> SqlStream:
+    """Translate a question to SQL like generate_sql, streaming it as it is written.
+    
+    Iterating the returned SqlStream yields the SQL text as it arrives; once
+    the statement is complete (a `;` or closing code fence) or the model
+    moves on to prose the LLM stream is closed, so the SQL can be checked
+    and run without waiting for the rest of the response. Afterwards its sql
+    and cached attributes hold the cleaned SQL and whether it was reused from
+    the translation cache or the query history. Reused SQL is returned as a
+    stream of one chunk.
+    """
+    from struct_llm.streaming import SqlStream
+    
+    trace = trace if trace is not None else _new_trace(user_question)
+    reused_sql, prompt = _reuse_or_prompt(user_question, stats, trace)
+    if reused_sql is not None:
+        return SqlStream.of(reused_sql, trace, cached=True)
+    
+    def deltas() -> Iterator[str]:
+        with trace.stage("llm"):
+            yield from stream_sql_from_openai(prompt, trace)
+    return SqlStream(deltas(), trace)
+
+def cache_translation(user_question: str, sql: str):
+    """Remember SQL that executed successfully for the question."""
+    engine = get_engine()
+    engine.translation_cache.put(user_question, engine.catalog.fingerprint, sql)
+
+def _is_repairable(error: Exception) -> bool:
+    """True for errors DuckDB raises for a bad query, not limits, timeouts or I/O."""
+    import duckdb
+    return isinstance(error.__cause__, (
+        duckdb.BinderException, duckdb.ParserException, duckdb.CatalogException,
+        duckdb.ConversionException,
+    ))
+
+def run_with_repair(user_question: str, sql: str, run: Callable[[str], T],
+                    trace: Optional[Trace] = None,
+                    llm_attempts: Optional[int] = None) -> Tuple[str, T]:
+    """Run generated SQL with run(sql), repairing it when DuckDB rejects it.
+    
+    Each rejection is first fixed locally from the binder error and the known
+    schema (see struct_llm.repair), which takes microseconds. Only when no local
+    fix applies is the LLM asked to correct the query, at most llm_attempts
+    times (default: the sql_repair_attempts setting). Returns the SQL that ran
+    and run's result; the last error is raised if the query can't be repaired.
+    """
+    from struct_llm.repair import (
+        MAX_LOCAL_REPAIRS,
+        clean_sql,
+        repair_sql,
+        schema_columns,
+    )
+    
+    engine = get_engine()
+    trace = trace if trace is not None else _new_trace(user_question)
+    if llm_attempts is None:
+        llm_attempts = engine.settings.sql_repair_attempts
+    local_repairs = 0
+    while True:
+        try:
+            result = run(sql)
+        except QueryError as e:
+            if not _is_repairable(e):
+                raise
+            error = str(e.__cause__)
+            fixed = None
+            if local_repairs < MAX_LOCAL_REPAIRS:
+                with trace.stage("repair"):
+                    fixed = repair_sql(
+                        engine.conn, sql, error, schema_columns(engine.catalog.tables)
+                    )
+            if fixed is not None and fixed != sql:
+                local_repairs += 1
+                trace.repairs.append("local")
+            elif llm_attempts > 0:
+                llm_attempts -= 1
+                trace.repairs.append("llm")
+                catalog = engine.catalog
+                schema_block = catalog.schema_block_for(
+                    catalog.select_tables(user_question, engine.settings.schema_top_k)
+                )
+                with trace.stage("llm"):
+                    prompt = create_repair_prompt(
+                        user_question, schema_block, sql, error
+                    )
+                    response = get_sql_from_openai(prompt, trace)
+                with trace.stage("repair"):
+                    fixed = clean_sql(response)
+            else:
+                raise
+            sql = trace.sql = fixed
+            continue
+        if trace.repairs:
+            # The errors before the repair were dealt with
+            trace.clear_error()
+        return sql, result
+
+def process_question(user_question: str, stats: Optional[Dict] = None,
+                     trace: Optional[Trace] = None) -> tuple[str, pl.DataFrame]:
+    """Process a user question and return the generated SQL and results.
+    
+    If a stats dict is passed, it is filled with the prompt statistics from
+    prepare_prompt. SQL that DuckDB rejects is repaired locally or, failing
+    that, by the LLM.
+    The question is traced stage by stage and recorded in the engine's metrics,
+    whether it succeeds or fails; pass a Trace to inspect it afterwards.
+    """
+    trace = trace if trace is not None else _new_trace(user_question)
+    try:
+        with trace.stage("total"):
+            sql, cached = generate_sql(user_question, stats, trace)
+            sql, result = run_with_repair(
+                user_question, sql,
+                lambda candidate: execute_query(candidate, trace=trace), trace,
+            )
+            # Only cache translations that executed successfully
+            if not cached:
+                cache_translation(user_question, sql)
+    finally:
+        get_engine().metrics.record(trace)
     return sql, result
 
+def _as_subquery(sql: str) -> str:
+    """Strip a trailing semicolon so the query can be wrapped in a subquery."""
+    return sql.strip().rstrip(";")
+
+def count_rows(sql: str, on_wait: Optional[Callable[[], None]] = None) -> int:
+    """Count the rows a query returns without materializing them, under the guard.
+    
+    Counts are kept in the result cache like query results, and answered from
+    the rollup tables where possible. Like execute_query, the count runs in
+    the engine's worker processes if there are any.
+    """
+    import pyarrow as pa
+    
+    engine = get_engine()
+    guard = engine.guard
+    result_cache = engine.result_cache
+    cursor = _query_cursor()
+    watchdog = guard.watchdog(cursor)
+    count_sql = f"SELECT count(*) FROM ({_as_subquery(sql)})"
+    try:
+        cache_key = result_cache.key(cursor, count_sql)
+        cached = result_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            return cached.column(0)[0].as_py()
+        
+        rewritten_sql = _prune_partitions(cursor, _use_rollups(cursor, count_sql))
+        guarded_sql, _ = guard.check(cursor, rewritten_sql, auto_limit=False)
+        query_pool = engine.query_pool
+        if query_pool is not None:
+            table = query_pool.run(guarded_sql, guard.timeout, on_wait)
+            count = table.column(0)[0].as_py()
+        else:
+            with watchdog:
+                count = cursor.execute(guarded_sql).fetchone()[0]
+        if cache_key is not None:
+            result_cache.put(cache_key, pa.table({'count': [count]}))
+        return count
+    except QueryError:
+        raise
+    except Exception as e:
+        raise QueryError(f"Error executing query: {str(e)}") from e
+    finally:
+        watchdog.cancel()
+
+def fetch_page(sql: str, page: int, page_size: int, max_rows: Optional[int] = None,
+               trace: Optional[Trace] = None,
+               on_wait: Optional[Callable[[], None]] = None) -> pl.DataFrame:
+    """Fetch one zero-based page of a query's results, never reading past max_rows.
+    
+    The page's LIMIT bounds the result, so the guard only rejects the query,
+    and a page of max_result_rows + 1 rows tells whether a result has more.
+    """
+    offset = page * page_size
+    if max_rows is None:
+        limit = page_size
+    else:
+        limit = max(0, min(page_size, max_rows - offset))
+    return execute_query(
+        f"SELECT * FROM ({_as_subquery(sql)}) LIMIT {limit} OFFSET {offset}",
+        trace=trace, on_wait=on_wait, auto_limit=False,
+    )
+
+def chart_data(sql: str,
+               on_wait: Optional[Callable[[], None]] = None) -> Optional[Chart]:
+    """Chart the full result of a query from at most chart_max_points points.
+    
+    Returns None if no chart fits. The chart type follows the result's column
+    types, and DuckDB reduces the result to the points drawn (see
+    struct_llm.charts). The reducing queries
+    run like any other through execute_query, so they are guarded, cached and
+    run in the worker processes if there are any.
+    """
+    from struct_llm.charts import build_chart
+    
+    sql = _as_subquery(sql)
+    try:
+        description = _query_cursor().execute(f"DESCRIBE {sql}").fetchall()
+    except Exception as e:
+        raise QueryError(f"Error executing query: {str(e)}") from e
+    columns = [(row[0], row[1]) for row in description]
+    return build_chart(
+        sql, columns, lambda chart_sql: execute_query(chart_sql, on_wait=on_wait),
+        get_engine().settings.chart_max_points,
+    )
+
+def export_result(sql: str, path: Path, format: str = "csv", compression: str = "zstd",
+                  row_group_size: Optional[int] = None,
+                  progress: Optional[Callable[[ExportProgress], None]] = None) -> int:
+    """Write the full result of a query to a file and return the number of rows written.
+    
+    format is "csv", "parquet" or "arrow" (an Arrow IPC file); compression and
+    row_group_size apply to Parquet. DuckDB writes the file itself (see
+    struct_llm.export), so the rows never pass through Python. progress is
+    called with an ExportProgress while the export runs and when it is done;
+    an exception it raises cancels the export.
+    Exports run in this process on a cursor of their own, even with
+    query_processes, and are not subject to the query timeout.
+    """
+    from struct_llm.export import ExportOptions, export_file
+    
+    options = ExportOptions(format, compression, row_group_size)
+    cursor, sql = _full_result_cursor(sql)
+    try:
+        return export_file(cursor, sql, path, options, progress)
+    finally:
+        cursor.close()
+
+def stream_export(sql: str, format: str = "csv", compression: str = "zstd",
+                  row_group_size: Optional[int] = None,
+                  progress: Optional[Callable[[ExportProgress], None]] = None
+                  ) -> ExportStream:
+    """Export the full result of a query as an iterator of byte chunks.
+    
+    Meant for e.g. an HTTP response: the chunks are read as DuckDB writes
+    them, so at most one chunk is held in memory. Like export_result, but
+    errors in the query surface while iterating; closing the stream early
+    cancels the export.
+    """
+    from struct_llm.export import ExportOptions, ExportStream
+    
+    options = ExportOptions(format, compression, row_group_size)
+    cursor, sql = _full_result_cursor(sql)
+    return ExportStream(cursor, sql, options, progress)
+
+def export_csv(sql: str, path: Path) -> int:
+    """Write the full result of a query to a CSV file. Returns the rows written."""
+    return export_result(sql, path, "csv")
+
+@dataclass
+class BatchResult:
+    """Outcome of one question from process_questions_batch."""
+    question: str
+    sql: Optional[str] = None
+    result: Optional[pl.DataFrame] = None
+    error: Optional[str] = None
+    cached: bool = False
+    trace: Optional[Trace] = None
+
+async def process_questions_batch(
+    questions: Iterable[str],
+    concurrency: int = 8,
+    requests_per_second: float = 10.0,
+    retries: int = 4,
+    complete: Optional[Callable[[str], Awaitable[str]]] = None,
+) -> AsyncIterator[BatchResult]:
+    """Process many questions concurrently, yielding results as they complete.
+    
+    At most `concurrency` LLM calls are in flight, rate limited to
+    `requests_per_second`. The engine's LLM backend retries 429/5xx errors
+    and connection failures itself (the llm_retries setting); errors of a
+    `complete` function are retried with backoff up to `retries` times.
+    Identical questions that are in flight at the same time share one LLM call
+    and query, and one trace. Queries run in worker threads, each on its own
+    cursor. Every trace is recorded in the engine's metrics. SQL that DuckDB
+    rejects is only repaired locally, without further LLM calls.
+    
+    `complete` is the async prompt -> SQL function to use instead of the OpenAI
+    API, e.g. a fake backend for tests.
+    """
+    import asyncio
+    
+    from struct_llm.batch import SingleFlight, TokenBucket, retry_with_backoff
+    from struct_llm.cache import normalize_question
+    from struct_llm.repair import clean_sql
+    
+    engine = get_engine()
+    translation_cache = engine.translation_cache
+    metrics = engine.metrics
+    engine.catalog.refresh()
+    fingerprint = engine.catalog.fingerprint
+    semaphore = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(requests_per_second, capacity=concurrency)
+    flights = SingleFlight()
+    
+    async def answer(question: str) -> Tuple[str, pl.DataFrame, bool, Trace]:
+        trace = _new_trace(question)
+        trace.schema_fingerprint = fingerprint
+        try:
+            with trace.stage("cache"):
+                cached_sql = translation_cache.get(question, fingerprint)
+            trace.cache_hit = cached_sql is not None
+            if cached_sql is None:
+                cached_sql, examples = _search_history(question, trace)
+            if cached_sql is not None:
+                trace.sql = cached_sql
+                result = await asyncio.to_thread(execute_query, cached_sql, None, trace)
+                return cached_sql, result, True, trace
+            
+            with trace.stage("prompt"):
+                prompt, _ = prepare_prompt(question, examples)
+            
+            async def call_llm() -> str:
+                await bucket.acquire()
+                if complete is None:
+                    return await get_sql_from_openai_async(prompt, trace)
+                return await complete(prompt)
+            
+            # Includes waiting for a slot and for the rate limiter
+            with trace.stage("llm"):
+                async with semaphore:
+                    try:
+                        if complete is None:
+                            # The backend retries; retrying here too would
+                            # multiply the attempts
+                            response = await call_llm()
+                        else:
+                            response = await retry_with_backoff(call_llm, retries)
+                    except Exception as e:
+                        raise LLMError(f"Error from OpenAI API: {str(e)}") from e
+            with trace.stage("repair"):
+                trace.sql = clean_sql(response)
+            sql, result = await asyncio.to_thread(
+                run_with_repair, question, trace.sql,
+                lambda candidate: execute_query(candidate, None, trace), trace, 0
+            )
+            translation_cache.put(question, fingerprint, sql)
+            return sql, result, False, trace
+        finally:
+            metrics.record(trace)
+    
+    async def run(question: str) -> BatchResult:
+        try:
+            sql, result, cached, trace = await flights.do(
+                normalize_question(question), lambda: answer(question)
+            )
+            return BatchResult(question, sql, result, cached=cached, trace=trace)
+        except Exception as e:
+            return BatchResult(question, error=str(e))
+    
+    tasks = [asyncio.ensure_future(run(question)) for question in questions]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def run_questions_batch(questions: Iterable[str], **kwargs) -> List[BatchResult]:
+    """Blocking wrapper around process_questions_batch, in completion order."""
+    import asyncio
+    
+    async def collect() -> List[BatchResult]:
+        return [result async for result in process_questions_batch(questions, **kwargs)]
+    return asyncio.run(collect())
+
 if __name__ == "__main__":
     print("\n=== Starting Natural Language to SQL Converter ===")
     metadata = get_table_metadata()
@@ -131,11 +1192,21 @@ if __name__ == "__main__":
             break
             
         try:
-            sql, result = process_question(user_question)
+            stats = {}
+            trace = _new_trace(user_question)
+            sql, result = process_question(user_question, stats, trace)
             print("\nGenerated SQL:")
             print(sql)
+            if stats:
+                print(f"\nPrompt: ~{stats['prompt_tokens']} tokens "
+                      f"(full schema: ~{stats['full_schema_prompt_tokens']}), "
+                      f"tables: {', '.join(stats['tables'])}")
             print("\nQuery Results:")
             print(result)
+            print("\nTimings: " + ", ".join(
+                f"{stage} {seconds * 1000:.0f} ms"
+                for stage, seconds in trace.stages.items()
+            ))
             
         except Exception as e:
             print(f"\nError: {str(e)}") 
\ No newline at end of file
@@ -0,0 +1,550 @@
+"""
+Headless HTTP/JSON service for the NL->SQL pipeline.
+
+Endpoints:
+    POST /ask     {"question": ..., "max_rows": 1000, "format": "json" | "arrow"}
+                  Translate the question, run the SQL and return the rows. With
+                  "format": "arrow" (or Accept: application/vnd.apache.arrow.stream)
+                  the rows are an Arrow IPC stream and the SQL is in the X-SQL
+                  header, percent-encoded.
+    POST /sql     {"question": ...}  Translate the question without running it.
+    POST /export  {"question": ..., "format": "csv" | "parquet" | "arrow",
+                   "compression": "zstd", "row_group_size": ...}
+                  Translate the question and stream the full result, as DuckDB
+                  writes it, with chunked transfer encoding. The SQL is in the
+                  X-SQL header; an error past the first chunk closes the
+                  connection before the terminating chunk.
+    GET  /schema  Tables and columns as described in schema_metadata.
+    GET  /metrics Prometheus text of the engine's metrics.
+    GET  /health
+
+Requests are served on one asyncio event loop. LLM calls are awaited as
+async I/O, at most --llm-concurrency at a time; DuckDB work runs in a pool of
+--query-workers threads. At most --max-pending /ask and /sql requests are
+admitted at once (an /export until its first chunk); beyond that the service
+answers 503 with Retry-After, so clients back off instead of queueing without
+bound. As in batch processing,
+SQL that DuckDB rejects is only repaired locally, without further LLM calls.
+
+Usage:
+    python service.py --host 127.0.0.1 --port 8000
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Optional, Tuple
+
+import nl_to_sql
+from struct_llm.errors import (
+    ConfigurationError,
+    LLMError,
+    PipelineError,
+    QueryTimeoutError,
+)
+from struct_llm.export import EXTENSIONS, ExportOptions
+from struct_llm.metrics import Trace
+
+logger = logging.getLogger(__name__)
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+# Request head and body limits
+MAX_HEADER_LINES = 100
+MAX_LINE_BYTES = 8192
+
+class HTTPError(Exception):
+    """An error answered with the given status."""
+
+    def __init__(self, status: int, message: str,
+                 headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+@dataclass
+class Response:
+    status: int
+    body: bytes = b""
+    content_type: str = "application/json"
+    headers: Dict[str, str] = field(default_factory=dict)
+    # The rest of the body, from a blocking iterator, sent after body with chunked
+    # transfer encoding
+    chunks: Optional[Iterator[bytes]] = None
+
+    @classmethod
+    def json(cls, payload, status: int = 200,
+             headers: Optional[Dict[str, str]] = None) -> "Response":
+        body = json.dumps(payload, default=str).encode()
+        return cls(status, body, headers=headers or {})
+
+REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    413: "Payload Too Large", 422: "Unprocessable Entity",
+    500: "Internal Server Error", 502: "Bad Gateway",
+    503: "Service Unavailable", 504: "Gateway Timeout",
+}
+
+def error_status(error: PipelineError) -> int:
+    """The HTTP status of a pipeline error."""
+    if isinstance(error, ConfigurationError):
+        return 500
+    if isinstance(error, LLMError):
+        return 502
+    if isinstance(error, QueryTimeoutError):
+        return 504
+    # Rejected or failing SQL
+    return 422
+
+class NLSQLService:
+    """Serve the pipeline of an engine (default: nl_to_sql.get_engine()) over HTTP."""
+
+    def __init__(self, engine: Optional[nl_to_sql.Engine] = None,
+                 query_workers: Optional[int] = None, llm_concurrency: int = 32,
+                 max_pending: int = 256, max_body_bytes: int = 1 << 20,
+                 request_timeout: float = 120.0, default_max_rows: int = 1000):
+        if engine is not None:
+            nl_to_sql.set_engine(engine)
+        self.engine = nl_to_sql.get_engine()
+        self.executor = ThreadPoolExecutor(
+            query_workers or os.cpu_count() or 4, thread_name_prefix="nl-sql-query"
+        )
+        self.llm_concurrency = llm_concurrency
+        self.max_pending = max_pending
+        self.max_body_bytes = max_body_bytes
+        self.request_timeout = request_timeout
+        self.default_max_rows = default_max_rows
+        self.pending = 0
+        self._llm_slots: Optional[asyncio.Semaphore] = None
+
+    # HTTP/1.1 with keep-alive
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HTTPError as e:
+                    response = Response.json({"error": str(e)}, e.status)
+                    await self._write(writer, response, keep_alive=False)
+                    return
+                if request is None:
+                    return
+                method, target, headers, body, keep_alive = request
+                response = await self.dispatch(method, target, headers, body)
+                await self._write(writer, response, keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """The next request, or None at EOF.
+
+        Returns the method, target, lowercase headers, body and keep-alive flag.
+        """
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        if len(request_line) > MAX_LINE_BYTES:
+            raise HTTPError(400, "Request line too long")
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise HTTPError(400, "Malformed request line")
+        method, target, version = parts
+        headers = {}
+        for _ in range(MAX_HEADER_LINES + 1):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(line) > MAX_LINE_BYTES:
+                raise HTTPError(400, "Header line too long")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise HTTPError(400, "Too many headers")
+        if headers.get("transfer-encoding"):
+            raise HTTPError(
+                400, "Chunked request bodies are not supported; send Content-Length"
+            )
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length < 0:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length > self.max_body_bytes:
+            raise HTTPError(
+                413, f"Request body larger than {self.max_body_bytes} bytes"
+            )
+        body = await reader.readexactly(length) if length else b""
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+        return method, target, headers, body, keep_alive
+
+    async def _write(self, writer: asyncio.StreamWriter, response: Response,
+                     keep_alive: bool):
+        if response.chunks is not None:
+            await self._write_chunked(writer, response, keep_alive)
+            return
+        head = [
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}",
+            f"Content-Type: {response.content_type}",
+            f"Content-Length: {len(response.body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ] + [f"{name}: {value}" for name, value in response.headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + response.body)
+        await writer.drain()
+
+    async def _write_chunked(self, writer: asyncio.StreamWriter, response: Response,
+                             keep_alive: bool):
+        """Send the body, then each chunk as the executor produces it."""
+        head = [
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}",
+            f"Content-Type: {response.content_type}",
+            "Transfer-Encoding: chunked",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ] + [f"{name}: {value}" for name, value in response.headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        chunk = response.body
+        try:
+            while chunk is not None:
+                if chunk:
+                    size = f"{len(chunk):X}\r\n".encode("latin-1")
+                    writer.write(size + chunk + b"\r\n")
+                    await writer.drain()
+                try:
+                    chunk = await self._run(next, response.chunks, None)
+                except Exception as e:
+                    # Too late for an error status: drop the connection so the
+                    # client sees the body is incomplete
+                    logger.warning("Streamed response failed: %s", e)
+                    raise ConnectionAbortedError(str(e)) from e
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            # Stops the producer if the client went away
+            close = getattr(response.chunks, "close", None)
+            if close is not None:
+                await self._run(close)
+
+    # Routing
+
+    async def dispatch(self, method: str, target: str, headers: Dict[str, str],
+                       body: bytes) -> Response:
+        url = urllib.parse.urlsplit(target)
+        routes = {
+            "/ask": ("POST", self.ask, True),
+            "/sql": ("POST", self.sql, True),
+            "/export": ("POST", self.export, True),
+            "/schema": ("GET", self.schema, False),
+            "/metrics": ("GET", self.metrics, False),
+            "/health": ("GET", self.health, False),
+        }
+        route = routes.get(url.path.rstrip("/") or "/")
+        if route is None:
+            return Response.json({"error": f"Unknown path {url.path}"}, 404)
+        expected_method, handler, admitted = route
+        if method != expected_method:
+            return Response.json(
+                {"error": f"Use {expected_method}"}, 405, {"Allow": expected_method}
+            )
+        if admitted and self.pending >= self.max_pending:
+            return Response.json(
+                {"error": "Too many requests in progress"}, 503, {"Retry-After": "1"}
+            )
+
+        if admitted:
+            self.pending += 1
+        try:
+            payload = self._parse_body(body) if method == "POST" else {}
+            return await asyncio.wait_for(
+                handler(payload, headers), self.request_timeout
+            )
+        except HTTPError as e:
+            return Response.json({"error": str(e)}, e.status, e.headers)
+        except asyncio.TimeoutError:
+            return Response.json({
+                "error": f"Request took longer than {self.request_timeout:g} s",
+            }, 504)
+        except PipelineError as e:
+            return Response.json({
+                "error": str(e), "stage": e.stage, "type": type(e).__name__,
+            }, error_status(e))
+        except Exception as e:
+            logger.exception("Request to %s failed", url.path)
+            return Response.json({"error": str(e), "type": type(e).__name__}, 500)
+        finally:
+            if admitted:
+                self.pending -= 1
+
+    @staticmethod
+    def _parse_body(body: bytes) -> Dict:
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError as e:
+            raise HTTPError(400, f"Invalid JSON: {e}")
+        if not isinstance(payload, dict):
+            raise HTTPError(400, "Expected a JSON object")
+        return payload
+
+    @staticmethod
+    def _question(payload: Dict) -> str:
+        question = payload.get("question")
+        if not isinstance(question, str) or not question.strip():
+            raise HTTPError(400, "Missing \"question\"")
+        return question.strip()
+
+    def _max_rows(self, payload: Dict) -> int:
+        max_rows = payload.get("max_rows", self.default_max_rows)
+        # bool is an int subclass, but true isn't a row count
+        if not isinstance(max_rows, int) or isinstance(max_rows, bool) or max_rows < 0:
+            raise HTTPError(400, "\"max_rows\" must be a non-negative integer")
+        return min(max_rows, self.engine.settings.max_result_rows)
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def _generate(self, question: str, trace) -> Tuple[str, bool]:
+        if self._llm_slots is None:
+            self._llm_slots = asyncio.Semaphore(self.llm_concurrency)
+        return await nl_to_sql.generate_sql_async(
+            question, None, trace, self.executor, self._llm_slots
+        )
+
+    # Endpoints
+
+    async def ask(self, payload: Dict, headers: Dict[str, str]) -> Response:
+        question = self._question(payload)
+        max_rows = self._max_rows(payload)
+        arrow = (payload.get("format") == "arrow"
+                 or ARROW_STREAM in headers.get("accept", ""))
+
+        trace = Trace(question)
+        # Set when the request times out, to cancel a query running in a worker
+        # process
+        cancelled = threading.Event()
+
+        def on_wait():
+            if cancelled.is_set():
+                raise asyncio.CancelledError()
+        try:
+            with trace.stage("total"):
+                sql, cached = await self._generate(question, trace)
+                try:
+                    sql, result = await self._run(
+                        self._execute, question, sql, max_rows, trace, on_wait
+                    )
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+                if not cached:
+                    await self._run(nl_to_sql.cache_translation, question, sql)
+        finally:
+            self.engine.metrics.record(trace)
+
+        truncated = result.height > max_rows
+        result = result.head(max_rows)
+        if arrow:
+            body = await self._run(self._arrow_ipc, result)
+            return Response(200, body, ARROW_STREAM, {
+                "X-SQL": urllib.parse.quote(sql), "X-Cached": str(cached).lower(),
+                "X-Truncated": str(truncated).lower(),
+            })
+        return Response.json({
+            "question": question,
+            "sql": sql,
+            "cached": cached,
+            "columns": result.columns,
+            "types": [str(dtype) for dtype in result.dtypes],
+            "rows": result.rows(),
+            "row_count": result.height,
+            "truncated": truncated,
+            "timings_ms": self._timings(trace),
+        })
+
+    @staticmethod
+    def _timings(trace) -> Dict[str, float]:
+        return {stage: seconds * 1000 for stage, seconds in trace.stages.items()}
+
+    @staticmethod
+    def _execute(question: str, sql: str, max_rows: int, trace, on_wait):
+        """Run SQL in a worker thread, reading one row past max_rows.
+
+        The extra row tells whether there are more.
+        """
+        def fetch(candidate):
+            return nl_to_sql.fetch_page(
+                candidate, 0, max_rows + 1, trace=trace, on_wait=on_wait
+            )
+        return nl_to_sql.run_with_repair(question, sql, fetch, trace, llm_attempts=0)
+
+    @staticmethod
+    def _arrow_ipc(result) -> bytes:
+        import pyarrow as pa
+
+        table = result.to_arrow()
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as stream_writer:
+            stream_writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+    async def sql(self, payload: Dict, headers: Dict[str, str]) -> Response:
+        question = self._question(payload)
+        trace = Trace(question)
+        try:
+            with trace.stage("total"):
+                sql, cached = await self._generate(question, trace)
+        finally:
+            self.engine.metrics.record(trace)
+        return Response.json({
+            "question": question,
+            "sql": sql,
+            "cached": cached,
+            "timings_ms": self._timings(trace),
+        })
+
+    async def export(self, payload: Dict, headers: Dict[str, str]) -> Response:
+        question = self._question(payload)
+        try:
+            options = ExportOptions(
+                payload.get("format", "csv"), payload.get("compression", "zstd"),
+                payload.get("row_group_size"),
+            )
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+        trace = Trace(question)
+        # Set when the request times out, to cancel the export
+        cancelled = threading.Event()
+        try:
+            with trace.stage("total"):
+                sql, cached = await self._generate(question, trace)
+                try:
+                    sql, (stream, first_chunk) = await self._run(
+                        self._start_export, question, sql, options, trace, cancelled
+                    )
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+                if not cached:
+                    await self._run(nl_to_sql.cache_translation, question, sql)
+        finally:
+            self.engine.metrics.record(trace)
+        filename = f"result{EXTENSIONS[options.format]}"
+        return Response(200, first_chunk, stream.media_type, {
+            "X-SQL": urllib.parse.quote(sql), "X-Cached": str(cached).lower(),
+            "Content-Disposition": f"attachment; filename=\"{filename}\"",
+        }, chunks=stream)
+
+    @staticmethod
+    def _start_export(question: str, sql: str, options: ExportOptions, trace,
+                      cancelled: threading.Event):
+        """Start exporting in a worker thread, up to its first chunk.
+
+        By then DuckDB has accepted the SQL.
+        """
+        def progress(_):
+            if cancelled.is_set():
+                raise asyncio.CancelledError()
+
+        def start(candidate):
+            stream = nl_to_sql.stream_export(
+                candidate, options.format, options.compression,
+                options.row_group_size, progress,
+            )
+            first_chunk = next(stream, b"")
+            if cancelled.is_set():
+                stream.close()
+                raise asyncio.CancelledError()
+            return stream, first_chunk
+        with trace.stage("export"):
+            return nl_to_sql.run_with_repair(
+                question, sql, start, trace, llm_attempts=0
+            )
+
+    async def schema(self, payload: Dict, headers: Dict[str, str]) -> Response:
+        catalog = self.engine.catalog
+        await self._run(catalog.refresh)
+        return Response.json({
+            "fingerprint": catalog.fingerprint,
+            "tables": {
+                table_name: {
+                    "description": info["description"],
+                    "columns": [
+                        {"name": name, "description": description}
+                        for name, description in info["columns"]
+                    ],
+                }
+                for table_name, info in catalog.tables.items()
+            },
+        })
+
+    async def metrics(self, payload: Dict, headers: Dict[str, str]) -> Response:
+        body = self.engine.metrics.to_prometheus().encode()
+        return Response(200, body, "text/plain; version=0.0.4")
+
+    async def health(self, payload: Dict, headers: Dict[str, str]) -> Response:
+        return Response.json({"status": "ok", "pending": self.pending})
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000,
+                    backlog: int = 1024) -> asyncio.AbstractServer:
+        """Start listening. Serve with `await server.serve_forever()`."""
+        return await asyncio.start_server(
+            self.handle_connection, host, port, backlog=backlog
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--query-workers", type=int, default=None,
+                        help="DuckDB worker threads (default: CPUs)")
+    parser.add_argument("--llm-concurrency", type=int, default=32,
+                        help="LLM calls in flight at once")
+    parser.add_argument("--max-pending", type=int, default=256,
+                        help="Questions admitted at once; more are answered 503")
+    parser.add_argument("--request-timeout", type=float, default=120.0,
+                        help="Seconds before a request gives up")
+    parser.add_argument("--max-rows", type=int, default=1000,
+                        help="Rows returned by /ask unless asked otherwise")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    service = NLSQLService(
+        query_workers=args.query_workers, llm_concurrency=args.llm_concurrency,
+        max_pending=args.max_pending, request_timeout=args.request_timeout,
+        default_max_rows=args.max_rows,
+    )
+
+    async def run():
+        server = await service.serve(args.host, args.port)
+        logger.info("Serving on http://%s:%d", args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Persistent cache of natural language question -> SQL translations.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+
+import duckdb
+
+CACHE_DB_PATH = Path("data/cache.db")
+
+def normalize_question(question: str) -> str:
+    """Normalize a question: casing, whitespace and end punctuation don't matter."""
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+class TranslationCache:
+    """LRU + TTL cache of generated SQL, persisted to a DuckDB table.
+
+    Entries are keyed on the normalized question and the schema fingerprint
+    (see struct_llm.database.schema_fingerprint). When the fingerprint changes,
+    entries for the old schema are purged from memory and from disk.
+    """
+
+    def __init__(self, db_path: Optional[Path] = CACHE_DB_PATH, max_entries: int = 1024,
+                 ttl_seconds: float = 7 * 24 * 3600):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+        self._fingerprint: Optional[str] = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        """Open the cache database on first use. Returns None when memory-only."""
+        if self._conn is None and self.db_path is not None:
+            try:
+                self.db_path.parent.mkdir(parents=True, exist_ok=True)
+                self._conn = duckdb.connect(str(self.db_path))
+            except duckdb.IOException:
+                # Another process holds the file lock; keep working from memory
+                self.db_path = None
+                return None
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS translation_cache (
+                question VARCHAR NOT NULL,
+                schema_fingerprint VARCHAR NOT NULL,
+                sql VARCHAR NOT NULL,
+                created_at DOUBLE NOT NULL,
+                PRIMARY KEY (question, schema_fingerprint)
+            )
+            """)
+        return self._conn
+
+    def _check_fingerprint(self, fingerprint: str):
+        """Drop entries created against a different schema."""
+        if fingerprint == self._fingerprint:
+            return
+        self._fingerprint = fingerprint
+        for key in [key for key in self._entries if key[1] != fingerprint]:
+            del self._entries[key]
+        conn = self._connection()
+        if conn is not None:
+            conn.execute(
+                "DELETE FROM translation_cache WHERE schema_fingerprint <> ?",
+                [fingerprint],
+            )
+
+    def get(self, question: str, fingerprint: str) -> Optional[str]:
+        """Return the cached SQL for a question, or None on a miss."""
+        key = (normalize_question(question), fingerprint)
+        now = time.time()
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            entry = self._entries.get(key)
+            if entry is None:
+                conn = self._connection()
+                if conn is None:
+                    return None
+                row = conn.execute(
+                    "SELECT sql, created_at FROM translation_cache "
+                    "WHERE question = ? AND schema_fingerprint = ?",
+                    list(key)
+                ).fetchone()
+                if row is None:
+                    return None
+                entry = (row[0], row[1])
+                self._store(key, entry)
+
+            sql, created_at = entry
+            if now - created_at > self.ttl_seconds:
+                self._delete(key)
+                return None
+            self._entries.move_to_end(key)
+            return sql
+
+    def put(self, question: str, fingerprint: str, sql: str):
+        """Cache the SQL generated for a question."""
+        key = (normalize_question(question), fingerprint)
+        entry = (sql, time.time())
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._store(key, entry)
+            conn = self._connection()
+            if conn is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO translation_cache VALUES (?, ?, ?, ?)",
+                    [key[0], key[1], sql, entry[1]]
+                )
+
+    def clear(self):
+        """Remove every cached translation."""
+        with self._lock:
+            self._entries.clear()
+            conn = self._connection()
+            if conn is not None:
+                conn.execute("DELETE FROM translation_cache")
+
+    def _store(self, key: Tuple[str, str], entry: Tuple[str, float]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _delete(self, key: Tuple[str, str]):
+        self._entries.pop(key, None)
+        conn = self._connection()
+        if conn is not None:
+            conn.execute(
+                "DELETE FROM translation_cache "
+                "WHERE question = ? AND schema_fingerprint = ?",
+                list(key),
+            )
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,142 @@
+"""
+In-memory catalog of the schema_metadata table.
+"""
+
+import threading
+from typing import Dict, List, Optional
+
+from struct_llm.database import schema_fingerprint
+from struct_llm.profiling import load_profiles, profile_version
+from struct_llm.retrieval import SchemaIndex, count_tokens, find_relations
+
+
+def load_table_metadata(conn) -> Dict:
+    """Load schema_metadata into a dict of table name -> description and columns."""
+    metadata_rows = conn.execute("""
+    SELECT
+        table_name,
+        column_name,
+        description
+    FROM schema_metadata
+    ORDER BY
+        table_name,
+        column_name IS NOT NULL,
+        column_name
+    """).fetchall()
+
+    # Organize metadata by table
+    tables = {}
+    for table_name, column_name, description in metadata_rows:
+        if table_name not in tables:
+            tables[table_name] = {
+                'description': None,
+                'columns': []
+            }
+        if column_name is None:
+            tables[table_name]['description'] = description
+        else:
+            tables[table_name]['columns'].append((column_name, description))
+
+    return tables
+
+def render_column(col_name: str, col_desc: str, profile: Optional[str] = None) -> str:
+    """Render a column line of the prompt, with its compact profile if there is one."""
+    if profile:
+        return f"- {col_name}: {col_desc} ({profile})"
+    return f"- {col_name}: {col_desc}"
+
+def render_table(table_name: str, info: Dict) -> str:
+    """Render a single table of the metadata dict for the prompt."""
+    profile = info.get('profile', {})
+    return (
+        f"Table: {table_name}\nDescription: {info['description']}\nColumns:\n" +
+        "\n".join([
+            render_column(col_name, col_desc, profile.get(col_name))
+            for col_name, col_desc in info['columns']
+        ])
+    )
+
+def render_schema(metadata: Dict) -> str:
+    """Render the metadata dict as the schema block of the prompt."""
+    return "\n\n".join([
+        render_table(table_name, info) for table_name, info in metadata.items()
+    ])
+
+class SchemaCatalog:
+    """Schema metadata loaded once and reloaded only when schema_metadata changes.
+
+    refresh() compares the schema fingerprint and the profile version (see
+    struct_llm.profiling) against the ones the catalog was built from, so
+    repeated calls cost two small aggregates instead of rebuilding the metadata
+    dict and prompt schema block. Column profiles are attached to each table
+    as info['profile'] and rendered into the prompt.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.fingerprint: Optional[str] = None
+        self.profile_version: Optional[str] = None
+        self._tables: Dict = {}
+        self._rendered: Dict[str, str] = {}
+        self._schema_block = ""
+        self.schema_tokens = 0
+        self.index = SchemaIndex({})
+        self._lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> bool:
+        """Reload the catalog if schema_metadata changed. Returns True if reloaded."""
+        with self._lock:
+            fingerprint = schema_fingerprint(self.conn)
+            version = profile_version(self.conn)
+            unchanged = (
+                fingerprint == self.fingerprint and version == self.profile_version
+            )
+            if not force and unchanged:
+                return False
+            self._tables = load_table_metadata(self.conn)
+            for table_name, profile in load_profiles(self.conn).items():
+                if table_name in self._tables:
+                    self._tables[table_name]['profile'] = profile
+            self._rendered = {
+                table_name: render_table(table_name, info)
+                for table_name, info in self._tables.items()
+            }
+            self._schema_block = "\n\n".join(self._rendered.values())
+            self.schema_tokens = count_tokens(self._schema_block)
+            relations = find_relations(self._tables, self.conn)
+            self.index = SchemaIndex(self._tables, relations)
+            self.fingerprint = fingerprint
+            self.profile_version = version
+            return True
+
+    @property
+    def tables(self) -> Dict:
+        """Metadata dict of table name -> {'description', 'columns'}."""
+        if self.fingerprint is None:
+            self.refresh()
+        return self._tables
+
+    @property
+    def schema_block(self) -> str:
+        """Precompiled schema block of the prompt covering every table."""
+        if self.fingerprint is None:
+            self.refresh()
+        return self._schema_block
+
+    def rendered_table(self, table_name: str) -> str:
+        """Precompiled prompt text for a single table."""
+        if self.fingerprint is None:
+            self.refresh()
+        return self._rendered[table_name]
+
+    def select_tables(self, question: str, top_k: int = 8) -> List[str]:
+        """Tables relevant to the question, ranked by the schema index."""
+        if self.fingerprint is None:
+            self.refresh()
+        return self.index.select(question, top_k)
+
+    def schema_block_for(self, table_names: List[str]) -> str:
+        """Precompiled schema block covering only the given tables."""
+        if len(table_names) == len(self._tables):
+            return self.schema_block
+        return "\n\n".join(self.rendered_table(name) for name in table_names)
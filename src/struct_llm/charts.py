@@ -0,0 +1,313 @@
+"""
+Charts of query results, reduced to a few thousand points inside DuckDB.
+
+The chart type is chosen from the result's column types:
+
+- a date or timestamp column and numeric columns: a line chart per numeric
+  column over time,
+- a text column and a numeric column: a bar chart of the numeric column
+  summed per category,
+- two numeric columns: a scatter plot,
+- one numeric column: a histogram,
+- one text column: a bar chart of row counts per category.
+
+Columns named id or ending in _id are ignored. However large the result,
+the data for the chart is computed by DuckDB over the query as a subquery,
+so only the points drawn leave the database:
+
+- Time series are reduced with MinMaxLTTB: DuckDB splits the time range
+  into max_points equal buckets and keeps the first, last, lowest and
+  highest point of each (M4), then Largest-Triangle-Three-Buckets picks
+  max_points of those in NumPy. Peaks and gaps survive the reduction.
+- Histograms are binned in DuckDB, with one bin per value for integer
+  columns of a small range.
+- Bar charts keep the top_n categories and sum the rest into "Other".
+- Scatter plots are a reservoir sample of max_points rows.
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import polars as pl
+
+from struct_llm.profiling import quote_identifier
+
+# Numeric columns drawn as lines of one chart
+MAX_SERIES = 4
+OTHER_CATEGORY = "Other"
+
+TEMPORAL_RE = re.compile(r"^(DATE|TIMESTAMP.*)$")
+INTEGER_RE = re.compile(r"^U?(TINYINT|SMALLINT|INTEGER|BIGINT|HUGEINT)$")
+NUMERIC_RE = re.compile(
+    r"^(U?(TINYINT|SMALLINT|INTEGER|BIGINT|HUGEINT)|FLOAT|DOUBLE|REAL|DECIMAL.*)$"
+)
+CATEGORICAL_RE = re.compile(r"^(VARCHAR|BOOLEAN|UUID|ENUM.*)$")
+
+@dataclass
+class Chart:
+    """Data of a chart, as st.line_chart, st.bar_chart and st.scatter_chart take it."""
+    # "line", "bar", "histogram" or "scatter"
+    kind: str
+    x: str
+    y: str
+    data: pl.DataFrame
+    # Column telling the series of a line chart apart
+    color: Optional[str] = None
+
+def column_kind(column_type: str) -> Optional[str]:
+    """"temporal", "numeric" or "categorical" for a DuckDB column type, else None."""
+    column_type = column_type.upper()
+    if TEMPORAL_RE.match(column_type):
+        return "temporal"
+    if NUMERIC_RE.match(column_type):
+        return "numeric"
+    if CATEGORICAL_RE.match(column_type):
+        return "categorical"
+    return None
+
+def _is_id(name: str) -> bool:
+    name = name.lower()
+    return name == "id" or name.endswith("_id")
+
+def choose_chart(
+    columns: Sequence[Tuple[str, str]],
+) -> Optional[Tuple[str, str, List[str]]]:
+    """The chart kind, x column and y columns of a result with (name, type) columns.
+
+    The y columns are empty for a histogram and for a bar chart of counts.
+    Returns None if no chart fits.
+    """
+    kinds = {"temporal": [], "numeric": [], "categorical": []}
+    for name, column_type in columns:
+        kind = column_kind(column_type)
+        if kind is not None and not _is_id(name):
+            kinds[kind].append(name)
+    temporal, numeric, categorical = (
+        kinds["temporal"], kinds["numeric"], kinds["categorical"]
+    )
+    if temporal and numeric:
+        return "line", temporal[0], numeric[:MAX_SERIES]
+    if categorical and numeric:
+        return "bar", categorical[0], numeric[:1]
+    if len(numeric) >= 2:
+        return "scatter", numeric[0], numeric[1:2]
+    if numeric:
+        return "histogram", numeric[0], []
+    if categorical:
+        return "bar", categorical[0], []
+    return None
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Indices of the n_out points Largest-Triangle-Three-Buckets keeps, x sorted.
+
+    The first and last points are always kept. Every other bucket of points
+    keeps the one forming the largest triangle with the point kept before it
+    and the average of the next bucket.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    every = (n - 2) / (n_out - 2)
+    edges = np.append(np.floor(np.arange(n_out - 1) * every).astype(np.int64) + 1, n)
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = edges[i + 1], edges[i + 2]
+        avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+def _epoch_ms(x: str) -> str:
+    return f"CAST(epoch_ms({quote_identifier(x)}) AS DOUBLE)"
+
+def _as_double(x: str) -> str:
+    return f"CAST({quote_identifier(x)} AS DOUBLE)"
+
+def bounds_query(sql: str, expression: str) -> str:
+    """Smallest and largest value of an expression over the result.
+
+    Bucketing queries get these as constants rather than joining a subquery
+    computing them, which the guard would take for a cross product.
+    """
+    return f"SELECT min({expression}) AS lo, max({expression}) AS hi FROM ({sql})"
+
+def _bucket(value: str, lo: float, width: float, buckets: str) -> str:
+    """Zero-based bucket of a value in `buckets` equal ranges of `width` from lo.
+
+    Every value is in bucket 0 if width is 0.
+    """
+    if not width:
+        return "0"
+    return f"least(floor(({value} - {lo!r}) / {width!r} * {buckets}), {buckets} - 1)"
+
+def line_query(sql: str, x: str, ys: Sequence[str], buckets: int, lo: float,
+               hi: float) -> str:
+    """First, last, lowest and highest point of each series per `buckets` time ranges.
+
+    lo and hi are the bounds of x in epoch milliseconds. Returns the columns
+    series, t (epoch milliseconds) and y, sorted by series and t.
+    """
+    values = ", ".join(f"{_as_double(y)} AS y{i}" for i, y in enumerate(ys))
+    aggregates = []
+    selects = []
+    for i, y in enumerate(ys):
+        has_value = f"FILTER (WHERE y{i} IS NOT NULL)"
+        aggregates.append(
+            f"arg_min(t, y{i}) AS t_min{i}, min(y{i}) AS y_min{i}, "
+            f"arg_max(t, y{i}) AS t_max{i}, max(y{i}) AS y_max{i}, "
+            f"min(t) {has_value} AS t_first{i}, "
+            f"arg_min(y{i}, t) {has_value} AS y_first{i}, "
+            f"max(t) {has_value} AS t_last{i}, "
+            f"arg_max(y{i}, t) {has_value} AS y_last{i}"
+        )
+        selects.append(
+            f"SELECT DISTINCT {i} AS series, "
+            f"unnest([t_min{i}, t_max{i}, t_first{i}, t_last{i}]) AS t, "
+            f"unnest([y_min{i}, y_max{i}, y_first{i}, y_last{i}]) AS y "
+            f"FROM buckets"
+        )
+    return f"""
+    WITH source AS (
+        SELECT {_epoch_ms(x)} AS t, {values}
+        FROM ({sql})
+        WHERE {quote_identifier(x)} IS NOT NULL
+    ),
+    buckets AS (
+        SELECT {", ".join(aggregates)}
+        FROM source
+        GROUP BY {_bucket("t", lo, hi - lo, str(buckets))}
+    )
+    SELECT * FROM ({" UNION ALL ".join(selects)})
+    WHERE t IS NOT NULL AND y IS NOT NULL
+    ORDER BY series, t, y
+    """
+
+def histogram_query(sql: str, x: str, bins: int, integer: bool, lo: float,
+                    hi: float) -> str:
+    """Row counts of `bins` equal ranges of a numeric column from lo to hi.
+
+    Integer ranges cover whole values, [lo, hi + 1), and get a bin per value
+    if there are fewer values than bins.
+    """
+    if integer:
+        bins = min(bins, int(hi - lo) + 1)
+        width = hi - lo + 1
+    else:
+        width = hi - lo
+    bin_width = (width or 1) / bins
+    return f"""
+    SELECT {lo!r} + bin * {bin_width!r} AS bin_start, count(*) AS count
+    FROM (
+        SELECT {_bucket(_as_double(x), lo, width, str(bins))} AS bin
+        FROM ({sql})
+        WHERE {quote_identifier(x)} IS NOT NULL
+    )
+    GROUP BY bin
+    ORDER BY bin
+    """
+
+def bar_query(sql: str, x: str, y: Optional[str], top_n: int) -> str:
+    """Sum of y (or the row count) per category of x.
+
+    The top_n categories are kept and all others summed together.
+    """
+    value = f"sum(CAST({quote_identifier(y)} AS DOUBLE))" if y else "count(*)"
+    other = OTHER_CATEGORY.replace("'", "''")
+    return f"""
+    WITH grouped AS (
+        SELECT coalesce(CAST({quote_identifier(x)} AS VARCHAR), '(null)') AS category,
+               {value} AS value
+        FROM ({sql})
+        GROUP BY 1
+    ),
+    ranked AS (
+        SELECT category, value,
+               row_number() OVER (ORDER BY value DESC NULLS LAST, category) AS rank
+        FROM grouped
+    )
+    SELECT CASE WHEN rank <= {top_n} THEN category ELSE '{other}' END AS category,
+           CAST(sum(value) AS {"DOUBLE" if y else "BIGINT"}) AS value
+    FROM ranked
+    GROUP BY 1
+    ORDER BY min(rank)
+    """
+
+def scatter_query(sql: str, x: str, y: str, max_points: int) -> str:
+    """A reservoir sample of max_points rows with both columns set."""
+    quoted_x, quoted_y = quote_identifier(x), quote_identifier(y)
+    return f"""
+    SELECT * FROM (
+        SELECT CAST({quoted_x} AS DOUBLE) AS x, CAST({quoted_y} AS DOUBLE) AS y
+        FROM ({sql})
+        WHERE {quoted_x} IS NOT NULL AND {quoted_y} IS NOT NULL
+    ) USING SAMPLE reservoir({max_points} ROWS) REPEATABLE (42)
+    """
+
+def _downsample_lines(data: pl.DataFrame, x: str, ys: Sequence[str], x_type: str,
+                      max_points: int) -> pl.DataFrame:
+    """LTTB over the points DuckDB preselected per series, in long format."""
+    per_series = max(3, max_points // len(ys))
+    frames = []
+    for i, y in enumerate(ys):
+        series = data.filter(pl.col("series") == i)
+        kept = lttb(series["t"].to_numpy(), series["y"].to_numpy(), per_series)
+        frames.append(series[kept].select(
+            pl.col("t").cast(pl.Int64).cast(pl.Datetime("ms")).alias(x),
+            pl.lit(y).alias("series"),
+            pl.col("y").alias("value"),
+        ))
+    lines = pl.concat(frames)
+    if x_type.upper() == "DATE":
+        lines = lines.with_columns(pl.col(x).cast(pl.Date))
+    return lines
+
+def build_chart(sql: str, columns: Sequence[Tuple[str, str]],
+                run: Callable[[str], pl.DataFrame], max_points: int = 2000,
+                top_n: int = 20, bins: int = 50) -> Optional[Chart]:
+    """Chart the result of sql, whose (name, DuckDB type) columns are given.
+
+    run(query) executes the aggregating queries, e.g. nl_to_sql.execute_query.
+    Returns None if no chart fits the columns or the result has fewer than
+    two points to draw.
+    """
+    choice = choose_chart(columns)
+    if choice is None:
+        return None
+    kind, x, ys = choice
+    types = dict(columns)
+    if kind in ("line", "histogram"):
+        expression = _epoch_ms(x) if kind == "line" else _as_double(x)
+        bounds = run(bounds_query(sql, expression))
+        lo, hi = bounds.row(0)
+        if lo is None:
+            return None
+    if kind == "line":
+        data = run(line_query(sql, x, ys, max_points, lo, hi))
+        lines = _downsample_lines(data, x, ys, types[x], max_points)
+        chart = Chart(kind, x, "value", lines, color="series")
+    elif kind == "histogram":
+        integer = bool(INTEGER_RE.match(types[x].upper()))
+        data = run(histogram_query(sql, x, bins, integer, lo, hi))
+        data = data.rename({"bin_start": x})
+        chart = Chart(kind, x, "count", data)
+    elif kind == "bar":
+        y = ys[0] if ys else "count"
+        data = run(bar_query(sql, x, ys[0] if ys else None, top_n))
+        data = data.rename({"category": x, "value": y})
+        chart = Chart(kind, x, y, data)
+    else:
+        data = run(scatter_query(sql, x, ys[0], max_points))
+        data = data.rename({"x": x, "y": ys[0]})
+        chart = Chart(kind, x, ys[0], data)
+    if chart.data.height < 2:
+        return None
+    return chart
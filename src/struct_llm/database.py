@@ -1,6 +1,13 @@
-import duckdb
-import pandas as pd
+import atexit
+import os
+import threading
+import weakref
 from pathlib import Path
+from typing import Dict, Optional
+
+import duckdb
+
+from struct_llm.profiling import profile_database
 
 DB_PATH = Path("data/database.db")
 
@@ -139,11 +146,132 @@ def insert_sample_data():
     (3, 3, 3, 1, 'Shipped')
     """)
     
+    # Invalidate cached results and refresh column profiles and rollups of the
+    # changed tables
+    bump_table_versions(conn, ['customers', 'products', 'orders'])
+    profile_database(conn)
+    # struct_llm.rollup imports this module
+    from struct_llm.rollup import refresh_rollups
+    refresh_rollups(conn)
+    
     conn.close()
 
+class ConnectionManager:
+    """One shared DuckDB database instance handing out a cursor per thread.
+
+    The database is opened once (read-only by default) with the configured
+    threads, memory_limit and temp_directory. execute() runs on a cursor owned
+    by the calling thread, so the manager can be used wherever a DuckDB
+    connection is expected; cursor() returns a new cursor the caller closes.
+    Cursors of threads that have exited are closed on the next call.
+    """
+
+    def __init__(self, db_path: Path = DB_PATH, read_only: bool = True,
+                 threads: Optional[int] = None, memory_limit: Optional[str] = None,
+                 temp_directory: Optional[str] = None):
+        self.db_path = db_path
+        self.read_only = read_only
+        self.config: Dict[str, str] = {}
+        if threads:
+            self.config['threads'] = str(threads)
+        if memory_limit:
+            self.config['memory_limit'] = memory_limit
+        if temp_directory:
+            self.config['temp_directory'] = temp_directory
+        self._conn = None
+        self._thread_cursors: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+
+    def connection(self):
+        """The root connection, opened on first use."""
+        with self._lock:
+            if self._conn is None:
+                self._conn = duckdb.connect(
+                    str(self.db_path), read_only=self.read_only, config=self.config
+                )
+            return self._conn
+
+    def cursor(self):
+        """A new cursor on the shared database, to be closed by the caller."""
+        return self.connection().cursor()
+
+    def thread_cursor(self):
+        """The cursor owned by the calling thread, created on first use."""
+        thread = threading.current_thread()
+        entry = self._thread_cursors.get(thread.ident)
+        if entry is not None and entry[0]() is thread:
+            return entry[1]
+
+        cursor = self.cursor()
+        with self._lock:
+            self._close_dead_cursors()
+            self._thread_cursors[thread.ident] = (weakref.ref(thread), cursor)
+        return cursor
+
+    def execute(self, query: str, parameters=None):
+        """Execute a query on the calling thread's cursor and return the cursor."""
+        return self.thread_cursor().execute(query, parameters)
+
+    def interrupt(self):
+        """Interrupt the query running on the calling thread's cursor."""
+        self.thread_cursor().interrupt()
+
+    def health_check(self) -> bool:
+        """Run a trivial query on a fresh cursor, reopening the database if it fails."""
+        for _ in range(2):
+            try:
+                cursor = self.cursor()
+                try:
+                    return cursor.execute("SELECT 1").fetchone()[0] == 1
+                finally:
+                    cursor.close()
+            except duckdb.Error:
+                self.close()
+        return False
+
+    def close(self):
+        """Close every cursor and the database. It is reopened on next use."""
+        with self._lock:
+            for _, cursor in self._thread_cursors.values():
+                try:
+                    cursor.close()
+                except duckdb.Error:
+                    pass
+            self._thread_cursors.clear()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _close_dead_cursors(self):
+        for ident, (thread_ref, cursor) in list(self._thread_cursors.items()):
+            thread = thread_ref()
+            if thread is None or not thread.is_alive():
+                cursor.close()
+                del self._thread_cursors[ident]
+
+_connection_manager: Optional[ConnectionManager] = None
+_connection_manager_lock = threading.Lock()
+
+def get_connection_manager() -> ConnectionManager:
+    """Get the process-wide read-only connection manager.
+
+    Configured from the DUCKDB_THREADS, DUCKDB_MEMORY_LIMIT and
+    DUCKDB_TEMP_DIRECTORY environment variables.
+    """
+    global _connection_manager
+    with _connection_manager_lock:
+        if _connection_manager is None:
+            _connection_manager = ConnectionManager(
+                threads=int(os.getenv('DUCKDB_THREADS', '0')) or None,
+                memory_limit=os.getenv('DUCKDB_MEMORY_LIMIT'),
+                temp_directory=os.getenv('DUCKDB_TEMP_DIRECTORY'),
+            )
+            atexit.register(_connection_manager.close)
+        return _connection_manager
+
 def get_db_connection():
-    """Get a connection to the database."""
-    return duckdb.connect(str(DB_PATH))
+    """Get a cursor on the shared database. Closing it leaves the database open."""
+    return get_connection_manager().cursor()
 
 def get_schema_info():
     """Get the complete schema information including descriptions."""
@@ -161,4 +289,64 @@ def get_schema_info():
         column_name
     """).fetchall()
     conn.close()
-    return result 
\ No newline at end of file
+    return result 
+
+def schema_fingerprint(conn) -> str:
+    """Return an md5 hash of the schema_metadata contents.
+
+    Caches that depend on the schema are keyed on this value, so they are
+    invalidated as soon as init_db or data/update_database.py rewrite the metadata.
+    """
+    return conn.execute("""
+    SELECT md5(COALESCE(string_agg(
+        table_name || '|' || COALESCE(column_name, '') || '|' || description,
+        chr(10)
+        ORDER BY table_name, column_name NULLS FIRST
+    ), ''))
+    FROM schema_metadata
+    """).fetchone()[0]
+
+def ensure_table_versions(conn):
+    """Create the table holding a data version per table, if it doesn't exist."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS table_versions (
+        table_name VARCHAR PRIMARY KEY,
+        version BIGINT NOT NULL,
+        updated_at TIMESTAMP NOT NULL
+    )
+    """)
+
+def bump_table_versions(conn, table_names):
+    """Record that the data of the given tables changed. Needs a writable connection.
+
+    Results cached for queries over these tables (see struct_llm.result_cache)
+    are invalidated by the new versions.
+    """
+    ensure_table_versions(conn)
+    for table_name in table_names:
+        conn.execute("""
+        INSERT INTO table_versions VALUES (?, 1, current_timestamp)
+        ON CONFLICT (table_name) DO UPDATE
+        SET version = version + 1, updated_at = excluded.updated_at
+        """, [table_name])
+
+def track_table_versions(conn, table_names):
+    """Start tracking the data version of the given tables.
+
+    Versions of tables already tracked are kept.
+    """
+    ensure_table_versions(conn)
+    for table_name in table_names:
+        conn.execute("""
+        INSERT INTO table_versions VALUES (?, 1, current_timestamp)
+        ON CONFLICT (table_name) DO NOTHING
+        """, [table_name])
+
+def load_table_versions(conn) -> Dict[str, int]:
+    """Data version of every table whose changes are tracked."""
+    try:
+        rows = conn.execute("SELECT table_name, version FROM table_versions").fetchall()
+        return dict(rows)
+    except duckdb.CatalogException:
+        # Database from before table versions were tracked
+        return {}
@@ -0,0 +1,31 @@
+"""
+Exceptions raised by the NL->SQL pipeline.
+
+Each error records the pipeline stage it came from, so that callers and
+metrics can tell LLM failures from database failures without parsing
+messages. The messages keep their original "Error from OpenAI API: ..." and
+"Error executing query: ..." form.
+"""
+
+class PipelineError(Exception):
+    """Base class of the pipeline's errors."""
+    stage = "pipeline"
+
+class ConfigurationError(PipelineError, ValueError):
+    """Missing or invalid configuration, e.g. no OpenAI API key."""
+    stage = "config"
+
+class LLMError(PipelineError):
+    """The LLM request failed."""
+    stage = "llm"
+
+class QueryError(PipelineError):
+    """DuckDB failed to execute the generated SQL."""
+    stage = "execute"
+
+class QueryRejectedError(QueryError):
+    """The generated SQL was rejected before running: its plan is too expensive."""
+    stage = "guard"
+
+class QueryTimeoutError(QueryError):
+    """The generated SQL was interrupted for running longer than the query timeout."""
@@ -0,0 +1,379 @@
+"""
+Export of full query results with DuckDB's COPY.
+
+COPY (query) TO ... writes CSV or Parquet from DuckDB's own threads, so the
+rows never pass through Python, whatever the size of the result. Arrow IPC,
+which COPY can't write without an extension, is written one record batch at
+a time instead.
+
+export_file() writes to a file. ExportStream yields the bytes of an export
+as DuckDB produces them, for an HTTP response: COPY writes into a named
+pipe, which holds at most a pipe buffer of data and blocks DuckDB until the
+consumer has read it, so nothing accumulates in memory or on disk. Where
+named pipes aren't available the export goes through a temporary file.
+
+Both report progress from the calling thread while the export runs: the
+share of the query DuckDB estimates it has done and the bytes written. An
+exception raised by the progress callback cancels the export.
+"""
+
+import os
+import select
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Tuple
+
+import duckdb
+import pyarrow as pa
+
+from struct_llm.errors import QueryError
+
+# Media type and file extension of each format
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+# Arrow IPC files are in the IPC file format rather than the stream format
+FILE_MEDIA_TYPES = {**MEDIA_TYPES, "arrow": "application/vnd.apache.arrow.file"}
+EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+PARQUET_COMPRESSIONS = ("zstd", "snappy", "gzip", "lz4", "brotli", "uncompressed")
+
+# Bytes read from the pipe at a time
+CHUNK_SIZE = 1 << 20
+# Seconds between progress reports
+POLL_INTERVAL = 0.2
+
+@dataclass
+class ExportOptions:
+    """Output format and its options."""
+    # "csv", "parquet" or "arrow" (Arrow IPC: the file format for files, the stream
+    # format for streams)
+    format: str = "csv"
+    # Parquet only
+    compression: str = "zstd"
+    row_group_size: Optional[int] = None
+    # Rows per record batch of Arrow IPC
+    batch_size: int = 100_000
+
+    def __post_init__(self):
+        if self.format not in MEDIA_TYPES:
+            raise ValueError(
+                f"Unknown export format {self.format!r}, "
+                f"expected one of {', '.join(MEDIA_TYPES)}"
+            )
+        if self.compression not in PARQUET_COMPRESSIONS:
+            raise ValueError(
+                f"Unknown Parquet compression {self.compression!r}, "
+                f"expected one of {', '.join(PARQUET_COMPRESSIONS)}"
+            )
+
+@dataclass
+class ExportProgress:
+    """How far an export has got."""
+    # DuckDB's estimate of the share of the query done, 0-100, or None before it has one
+    percent: Optional[float]
+    bytes_written: int
+    elapsed: float
+    # Rows exported, known once done
+    rows: Optional[int] = None
+    done: bool = False
+
+ProgressCallback = Callable[[ExportProgress], None]
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+def copy_statement(sql: str, path: str, options: ExportOptions) -> str:
+    """The COPY statement writing the result of sql to path in CSV or Parquet."""
+    if options.format == "csv":
+        copy_options = "FORMAT csv, HEADER"
+    elif options.format == "parquet":
+        copy_options = f"FORMAT parquet, COMPRESSION {options.compression}"
+        if options.row_group_size:
+            copy_options += f", ROW_GROUP_SIZE {int(options.row_group_size)}"
+    else:
+        raise ValueError(f"COPY can't write {options.format}")
+    return f"COPY ({sql}) TO {_literal(path)} ({copy_options})"
+
+def _enable_progress(cursor):
+    """Make DuckDB track the progress of the cursor's queries, without printing it."""
+    try:
+        cursor.execute("SET enable_progress_bar = true")
+        cursor.execute("SET enable_progress_bar_print = false")
+        cursor.execute("SET progress_bar_time = 0")
+    except duckdb.Error:
+        pass
+
+def _percent(cursor) -> Optional[float]:
+    try:
+        percent = cursor.query_progress()
+    except duckdb.Error:
+        return None
+    return percent if percent >= 0 else None
+
+class _Copy(threading.Thread):
+    """A COPY statement running in the background on a cursor of its own."""
+
+    def __init__(self, cursor, statement: str):
+        super().__init__(name="duckdb-copy", daemon=True)
+        self.cursor = cursor
+        self.statement = statement
+        self.rows: Optional[int] = None
+        self.error: Optional[Exception] = None
+
+    def run(self):
+        try:
+            self.rows = self.cursor.execute(self.statement).fetchone()[0]
+        except Exception as e:
+            self.error = e
+
+    def result(self) -> int:
+        """Rows copied, once the statement finished; raises QueryError if it failed."""
+        self.join()
+        if self.error is not None:
+            message = f"Error executing query: {str(self.error)}"
+            raise QueryError(message) from self.error
+        return self.rows
+
+    def cancel(self):
+        self.cursor.interrupt()
+        self.join()
+
+def _record_batches(cursor, sql: str,
+                    batch_size: int) -> Tuple[pa.Schema, Iterator[pa.RecordBatch]]:
+    """The schema of the result of sql and an iterator of its record batches.
+
+    Errors are raised as QueryError.
+    """
+    try:
+        reader = cursor.execute(sql).fetch_record_batch(batch_size)
+    except Exception as e:
+        raise QueryError(f"Error executing query: {str(e)}") from e
+
+    def batches():
+        try:
+            yield from reader
+        except Exception as e:
+            raise QueryError(f"Error executing query: {str(e)}") from e
+    return reader.schema, batches()
+
+def _file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+def export_file(cursor, sql: str, path: Path, options: Optional[ExportOptions] = None,
+                progress: Optional[ProgressCallback] = None) -> int:
+    """Write the result of sql to a file and return the number of rows written.
+
+    The query runs on cursor, which must not be used by anything else
+    meanwhile. progress is called every POLL_INTERVAL seconds and when done.
+    """
+    options = options or ExportOptions()
+    path = Path(path)
+    started = time.monotonic()
+    _enable_progress(cursor)
+    if options.format == "arrow":
+        rows = 0
+        schema, batches = _record_batches(cursor, sql, options.batch_size)
+        sink = pa.OSFile(str(path), "wb")
+        with sink, pa.ipc.new_file(sink, schema) as writer:
+            reported = started
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+                now = time.monotonic()
+                if progress is not None and now - reported >= POLL_INTERVAL:
+                    reported = now
+                    percent = _percent(cursor)
+                    progress(ExportProgress(percent, sink.tell(), now - started))
+    else:
+        # COPY writes a temporary file beside an existing one, whose size wouldn't
+        # show the progress
+        path.unlink(missing_ok=True)
+        copy = _Copy(cursor, copy_statement(sql, str(path), options))
+        copy.start()
+        try:
+            while copy.is_alive():
+                copy.join(POLL_INTERVAL)
+                if progress is not None and copy.is_alive():
+                    percent, size = _percent(cursor), _file_size(path)
+                    elapsed = time.monotonic() - started
+                    progress(ExportProgress(percent, size, elapsed))
+        except BaseException:
+            copy.cancel()
+            raise
+        rows = copy.result()
+    if progress is not None:
+        elapsed = time.monotonic() - started
+        progress(ExportProgress(100.0, _file_size(path), elapsed, rows, done=True))
+    return rows
+
+class _Chunks:
+    """A file-like sink for pyarrow whose written bytes are taken out chunk by chunk."""
+
+    closed = False
+
+    def __init__(self):
+        self._parts = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+class ExportStream:
+    """The bytes of an export as DuckDB produces them.
+
+    Iterate over it for chunks of up to CHUNK_SIZE bytes; rows is set once
+    the iteration is done. The stream owns cursor and closes it at the end.
+    Closing the stream early cancels the export.
+    """
+
+    def __init__(self, cursor, sql: str, options: Optional[ExportOptions] = None,
+                 progress: Optional[ProgressCallback] = None,
+                 chunk_size: int = CHUNK_SIZE):
+        self.options = options or ExportOptions()
+        self.media_type = MEDIA_TYPES[self.options.format]
+        self.rows: Optional[int] = None
+        self.bytes_written = 0
+        self._cursor = cursor
+        self._sql = sql
+        self._progress = progress
+        self._chunk_size = chunk_size
+        self._started = time.monotonic()
+        if self.options.format == "arrow":
+            chunks = self._arrow()
+        elif hasattr(os, "mkfifo"):
+            chunks = self._copy_through_pipe()
+        else:
+            chunks = self._copy_through_file()
+        self._chunks = self._counted(chunks)
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        return next(self._chunks)
+
+    def close(self):
+        self._chunks.close()
+
+    def _report(self, done: bool = False):
+        if self._progress is not None:
+            percent = 100.0 if done else _percent(self._cursor)
+            elapsed = time.monotonic() - self._started
+            self._progress(ExportProgress(percent, self.bytes_written, elapsed,
+                                          self.rows if done else None, done))
+
+    def _counted(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        try:
+            _enable_progress(self._cursor)
+            for chunk in chunks:
+                if chunk:
+                    self.bytes_written += len(chunk)
+                    yield chunk
+            self._report(done=True)
+        finally:
+            chunks.close()
+            self._cursor.close()
+
+    def _arrow(self) -> Iterator[bytes]:
+        schema, batches = _record_batches(
+            self._cursor, self._sql, self.options.batch_size
+        )
+        sink = _Chunks()
+        rows = 0
+        reported = time.monotonic()
+        with pa.ipc.new_stream(sink, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+                yield sink.take()
+                if time.monotonic() - reported >= POLL_INTERVAL:
+                    reported = time.monotonic()
+                    self._report()
+        # The end-of-stream marker is written on closing
+        yield sink.take()
+        self.rows = rows
+
+    def _copy_through_pipe(self) -> Iterator[bytes]:
+        directory = tempfile.mkdtemp(prefix="struct-llm-export-")
+        fifo = os.path.join(directory, "result" + EXTENSIONS[self.options.format])
+        os.mkfifo(fifo)
+        # Opened for reading and writing, so that neither end blocks on opening and
+        # reads never see end-of-file; the end of the data is the end of the COPY
+        fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+        copy = _Copy(self._cursor, copy_statement(self._sql, fifo, self.options))
+        copy.start()
+        try:
+            reported = time.monotonic()
+            while True:
+                ready, _, _ = select.select([fd], [], [], POLL_INTERVAL)
+                if ready:
+                    yield os.read(fd, self._chunk_size)
+                elif not copy.is_alive():
+                    break
+                # Also while the data keeps coming, or the progress would
+                # only be reported when DuckDB is slower than the reader
+                if time.monotonic() - reported >= POLL_INTERVAL:
+                    reported = time.monotonic()
+                    self._report()
+            # Whatever COPY wrote before it finished
+            while True:
+                try:
+                    chunk = os.read(fd, self._chunk_size)
+                except BlockingIOError:
+                    break
+                if not chunk:
+                    break
+                yield chunk
+            self.rows = copy.result()
+        finally:
+            # DuckDB may be blocked writing into the full pipe, where an interrupt
+            # doesn't reach it: discard what it writes until it notices
+            while copy.is_alive():
+                self._cursor.interrupt()
+                if select.select([fd], [], [], POLL_INTERVAL)[0]:
+                    try:
+                        os.read(fd, self._chunk_size)
+                    except BlockingIOError:
+                        pass
+            os.close(fd)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _copy_through_file(self) -> Iterator[bytes]:
+        directory = tempfile.mkdtemp(prefix="struct-llm-export-")
+        path = Path(directory) / ("result" + EXTENSIONS[self.options.format])
+        try:
+            self.rows = export_file(self._cursor, self._sql, path, self.options,
+                                    lambda p: self._report() if not p.done else None)
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(self._chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,178 @@
+"""
+Pre-flight cost checks and a wall-clock timeout for generated SQL.
+
+Before a generated query runs, its physical plan is read with
+EXPLAIN (FORMAT JSON) and the estimated cardinality of every operator is
+collected. Plans whose largest intermediate result exceeds
+max_estimated_rows (e.g. an accidental cartesian join) are rejected, and
+plans expected to return more than max_result_rows rows get a LIMIT, unless
+the query already has a smaller constant LIMIT of its own. Queries
+that still run too long are interrupted by a watchdog timer through the
+connection's interrupt().
+"""
+
+import json
+import threading
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import duckdb
+
+from struct_llm.errors import QueryRejectedError, QueryTimeoutError
+
+# Operators whose output is at most the product of their inputs' sizes
+MULTIPLYING_OPERATORS = {"CROSS_PRODUCT", "NESTED_LOOP_JOIN", "BLOCKWISE_NL_JOIN"}
+
+@dataclass
+class PlanEstimate:
+    """Estimated cardinalities of a query plan."""
+    # Rows the query is expected to return
+    output_rows: int
+    # Largest estimated intermediate result, and the operator producing it
+    peak_rows: int
+    peak_operator: str
+    # Constant LIMIT of the outermost query, if it has one
+    limit: Optional[int] = None
+
+def _walk(node: dict) -> Tuple[int, int, str]:
+    """Estimate (output rows, peak rows, peak operator) of a plan node.
+
+    Operators without an estimate (or with an estimate of 0, which DuckDB
+    reports for some projections) are given the product of their inputs for
+    cross products and nested-loop joins and the largest input otherwise.
+    """
+    name = node.get("name", "").strip()
+    children = [_walk(child) for child in node.get("children", [])]
+    estimate = node.get("extra_info", {}).get("Estimated Cardinality")
+    try:
+        rows = int(estimate)
+    except (TypeError, ValueError):
+        rows = 0
+    if not rows and children:
+        if name in MULTIPLYING_OPERATORS:
+            rows = 1
+            for child_rows, _, _ in children:
+                rows *= max(child_rows, 1)
+        else:
+            rows = max(child_rows for child_rows, _, _ in children)
+
+    # On ties report the operator producing the rows rather than the ones passing
+    # them on
+    peak_rows, peak_operator = rows, name
+    for _, child_peak, child_operator in children:
+        if child_peak >= peak_rows:
+            peak_rows, peak_operator = child_peak, child_operator
+    return rows, peak_rows, peak_operator
+
+def outer_limit(conn, sql: str) -> Optional[int]:
+    """The constant LIMIT of a query's outermost SELECT, from its parsed syntax tree.
+
+    The physical plan can't be used for this: DuckDB rewrites large LIMITs
+    into joins that no longer show the limit.
+    """
+    tree = json.loads(conn.execute("SELECT json_serialize_sql(?)", [sql]).fetchone()[0])
+    if tree.get("error") or len(tree.get("statements", [])) != 1:
+        return None
+    for modifier in tree["statements"][0]["node"].get("modifiers", []):
+        limit = modifier.get("limit") or {}
+        if (modifier.get("type") == "LIMIT_MODIFIER"
+                and limit.get("class") == "CONSTANT"):
+            value = limit.get("value", {}).get("value")
+            if isinstance(value, int):
+                return value
+    return None
+
+def estimate_plan(conn, sql: str) -> PlanEstimate:
+    """Estimate a query's cardinalities from its physical plan, without running it."""
+    rows = conn.execute(f"EXPLAIN (FORMAT JSON) {sql}").fetchall()
+    roots = json.loads(rows[0][1])
+    output_rows, peak_rows, peak_operator = 0, 0, ""
+    for root in roots:
+        root_output, root_peak, root_operator = _walk(root)
+        output_rows = max(output_rows, root_output)
+        if root_peak > peak_rows:
+            peak_rows, peak_operator = root_peak, root_operator
+    limit = outer_limit(conn, sql)
+    if limit is not None:
+        output_rows = min(output_rows, limit)
+    return PlanEstimate(output_rows, peak_rows, peak_operator, limit)
+
+def _as_subquery(sql: str) -> str:
+    return sql.strip().rstrip(";")
+
+class Watchdog:
+    """Interrupt a connection's running query once `timeout` seconds have passed.
+
+    The timer starts the first time the watchdog is entered and keeps running
+    across later `with` blocks until cancel(). A query interrupted by the
+    watchdog raises QueryTimeoutError.
+    """
+
+    def __init__(self, conn, timeout: Optional[float]):
+        self.conn = conn
+        self.timeout = timeout
+        self.fired = False
+        self._timer: Optional[threading.Timer] = None
+
+    def _fire(self):
+        self.fired = True
+        self.conn.interrupt()
+
+    def __enter__(self):
+        if self.timeout and self._timer is None:
+            self._timer = threading.Timer(self.timeout, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.fired and isinstance(exc, duckdb.InterruptException):
+            raise QueryTimeoutError(
+                f"Error executing query: timed out after {self.timeout:g} seconds"
+            ) from exc
+        return False
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+class QueryGuard:
+    """Limits applied to generated SQL. A limit of 0 or None disables that check."""
+
+    def __init__(self, max_estimated_rows: Optional[int] = None,
+                 max_result_rows: Optional[int] = None,
+                 timeout: Optional[float] = None):
+        self.max_estimated_rows = max_estimated_rows
+        self.max_result_rows = max_result_rows
+        self.timeout = timeout
+
+    def check(self, conn, sql: str,
+              auto_limit: bool = True) -> Tuple[str, Optional[PlanEstimate]]:
+        """Estimate a query's plan, rejecting it if too expensive.
+
+        Returns the SQL to run, with a LIMIT of max_result_rows added if
+        auto_limit is set and the query is expected to return more rows, and
+        the estimate. Queries that EXPLAIN can't plan are returned unchanged so
+        that executing them reports the real error.
+        """
+        if not (self.max_estimated_rows or (auto_limit and self.max_result_rows)):
+            return sql, None
+        try:
+            estimate = estimate_plan(conn, _as_subquery(sql))
+        except duckdb.Error:
+            return sql, None
+
+        if self.max_estimated_rows and estimate.peak_rows > self.max_estimated_rows:
+            raise QueryRejectedError(
+                f"Error executing query: rejected, the {estimate.peak_operator} "
+                f"operator is estimated to produce {estimate.peak_rows:,} rows "
+                f"(limit {self.max_estimated_rows:,}). "
+                f"Check the query for a missing join condition."
+            )
+        if (auto_limit and self.max_result_rows
+                and estimate.output_rows > self.max_result_rows):
+            sql = f"SELECT * FROM ({_as_subquery(sql)}) LIMIT {self.max_result_rows}"
+        return sql, estimate
+
+    def watchdog(self, conn) -> Watchdog:
+        return Watchdog(conn, self.timeout)
@@ -0,0 +1,477 @@
+"""
+Query history: an append-only log of answered questions and a similarity index over it.
+
+Every processed question is appended to query_history in data/history.db with
+its SQL, stage timings, row count and whether it succeeded. Writes are queued
+and inserted in batches by a background thread, so they stay off the request
+path.
+
+The successful questions of the current schema are kept in a HistoryIndex.
+Questions are turned into hashed word unigrams and bigrams (after the
+tokenization of struct_llm.retrieval) with L2-normalized weights. Candidates
+are found by locality-sensitive hashing: a MinHash signature of each
+question's n-grams is cut into bands, and questions sharing a band with the
+query are looked up by binary search in per-band sorted arrays. Candidates
+are ranked by the cosine similarity of their n-gram vectors, computed for all
+of them at once with NumPy. A lookup therefore costs a few binary searches
+and a small vectorized rerank, independent of the size of the history.
+"""
+
+import json
+import queue
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import duckdb
+import numpy as np
+
+from struct_llm.cache import normalize_question
+from struct_llm.retrieval import tokenize
+
+HISTORY_DB_PATH = Path("data/history.db")
+
+# n-grams kept per question; longer questions keep their first ones
+MAX_FEATURES = 32
+
+# LSH bands of MinHash values: more bands find less similar questions
+BANDS = 8
+ROWS_PER_BAND = 4
+
+# n-gram hashes are kept to 31 bits, so that -1 can pad feature arrays
+FEATURE_MASK = (1 << 31) - 1
+
+# Candidates taken from one band bucket, the most recently added first
+MAX_BUCKET_CANDIDATES = 256
+
+# Log entries indexed at a time when the index is loaded
+LOAD_CHUNK_SIZE = 65536
+
+_rng = np.random.default_rng(0)
+# Odd multipliers and offsets of the MinHash hash functions
+_HASH_A = (
+    _rng.integers(0, 1 << 32, BANDS * ROWS_PER_BAND, dtype=np.uint32) | np.uint32(1)
+)
+_HASH_B = _rng.integers(0, 1 << 32, BANDS * ROWS_PER_BAND, dtype=np.uint32)
+# Combines the MinHash values of a band into one key (the 64-bit FNV prime)
+_BAND_MULTIPLIER = np.uint64(0x100000001B3)
+
+@dataclass
+class HistoryMatch:
+    """A successful past question similar to the one asked."""
+    question: str
+    sql: str
+    similarity: float
+
+def question_features(question: str) -> Dict[int, int]:
+    """Counts of the hashed word unigrams and bigrams of a question."""
+    terms = tokenize(normalize_question(question))
+    counts: Dict[int, int] = {}
+    for gram in terms + [f"{left} {right}" for left, right in zip(terms, terms[1:])]:
+        feature = zlib.crc32(gram.encode()) & FEATURE_MASK
+        if feature in counts:
+            counts[feature] += 1
+        elif len(counts) < MAX_FEATURES:
+            counts[feature] = 1
+    return counts
+
+def feature_arrays(questions: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Fixed-width n-gram arrays of questions.
+
+    Returns the features, padded with -1, and their L2-normalized weights.
+    """
+    features = np.full((len(questions), MAX_FEATURES), -1, dtype=np.int64)
+    weights = np.zeros((len(questions), MAX_FEATURES), dtype=np.float32)
+    for i, question in enumerate(questions):
+        counts = question_features(question)
+        features[i, :len(counts)] = list(counts)
+        weights[i, :len(counts)] = list(counts.values())
+    norms = np.linalg.norm(weights, axis=1, keepdims=True)
+    np.divide(weights, norms, out=weights, where=norms > 0)
+    return features, weights
+
+def band_keys(features: np.ndarray, chunk_size: int = 256) -> np.ndarray:
+    """The LSH band keys of the MinHash signatures of rows of feature_arrays()."""
+    keys = np.zeros((len(features), BANDS), dtype=np.uint64)
+    for start in range(0, len(features), chunk_size):
+        chunk = features[start:start + chunk_size]
+        # Padding repeats the first feature, which leaves the minimum alone
+        chunk = np.where(chunk < 0, chunk[:, :1], chunk).astype(np.uint32)
+        # Random linear permutations of the 32-bit integers, wrapping around
+        hashed = _HASH_A[None, :, None] * chunk[:, None, :]
+        hashed += _HASH_B[None, :, None]
+        rows = hashed.min(axis=2).astype(np.uint64)
+        rows = rows.reshape(len(chunk), BANDS, ROWS_PER_BAND)
+        band = rows[:, :, 0]
+        for i in range(1, ROWS_PER_BAND):
+            band = band * _BAND_MULTIPLIER + rows[:, :, i]
+        # Keep the bands apart
+        keys[start:start + chunk_size] = band ^ np.arange(BANDS, dtype=np.uint64)
+    return keys
+
+class HistoryIndex:
+    """Nearest-neighbour index of question -> SQL pairs, one per normalized question.
+
+    Entries are appended to growing arrays. The band keys of most entries are
+    kept sorted, per band, for binary search; the keys of recently added ones
+    are looked up in a dict until they make up a quarter of the index, when
+    they are merged into the sorted arrays.
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self.questions: List[str] = []
+        self.sqls: List[str] = []
+        self._keys = np.zeros((0, BANDS), dtype=np.uint64)
+        self._features = np.zeros((0, MAX_FEATURES), dtype=np.int64)
+        self._weights = np.zeros((0, MAX_FEATURES), dtype=np.float32)
+        self._sorted_keys = np.zeros((BANDS, 0), dtype=np.uint64)
+        self._sorted_ids = np.zeros((BANDS, 0), dtype=np.int64)
+        self._recent: Dict[int, List[int]] = {}
+        # _lock guards the arrays against searches; adds are serialized by _add_lock
+        self._lock = threading.Lock()
+        self._add_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.questions)
+
+    def _grow(self, size: int):
+        capacity = len(self._keys)
+        if size <= capacity:
+            return
+        capacity = max(1024, capacity * 2, size)
+        for name in ("_keys", "_features", "_weights"):
+            old = getattr(self, name)
+            new = np.zeros((capacity, old.shape[1]), dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, question: str, sql: str):
+        """Add a question, or replace the SQL of a question that is already indexed."""
+        self.add_many([(question, sql)])
+
+    def add_many(self, pairs: Iterable[Tuple[str, str]]):
+        """Add (question, SQL) pairs.
+
+        A later pair of the same question replaces the SQL of an earlier one.
+        """
+        with self._add_lock:
+            self._add_many(pairs)
+
+    def _add_many(self, pairs: Iterable[Tuple[str, str]]):
+        new: Dict[str, Tuple[str, str]] = {}
+        for question, sql in pairs:
+            key = normalize_question(question)
+            entry = self._ids.get(key)
+            if entry is not None:
+                self.sqls[entry] = sql
+            elif key in new:
+                new[key] = (new[key][0], sql)
+            else:
+                new[key] = (question, sql)
+        if not new:
+            return
+        questions = [question for question, _ in new.values()]
+        features, weights = feature_arrays(questions)
+        keys = band_keys(features)
+        with self._lock:
+            first = len(self.questions)
+            last = first + len(questions)
+            self._grow(last)
+            self._keys[first:last] = keys
+            self._features[first:last] = features
+            self._weights[first:last] = weights
+            for entry, (key, (question, sql)) in enumerate(new.items(), first):
+                self._ids[key] = entry
+                self.questions.append(question)
+                self.sqls.append(sql)
+            indexed = self._sorted_ids.shape[1]
+            if last - indexed > max(1024, indexed // 4):
+                self._reindex(last)
+            else:
+                for entry, row in enumerate(keys.tolist(), first):
+                    for key in row:
+                        self._recent.setdefault(key, []).append(entry)
+
+    def _reindex(self, size: int):
+        """Sort the band keys of the first size entries. Needs the lock."""
+        keys = self._keys[:size].T
+        self._sorted_ids = np.argsort(keys, axis=1, kind="stable")
+        self._sorted_keys = np.take_along_axis(keys, self._sorted_ids, axis=1)
+        self._recent = {}
+
+    def exact(self, question: str) -> Optional[HistoryMatch]:
+        """The entry for the same normalized question, if there is one."""
+        entry = self._ids.get(normalize_question(question))
+        if entry is None:
+            return None
+        return HistoryMatch(self.questions[entry], self.sqls[entry], 1.0)
+
+    def search(self, question: str, k: int = 3,
+               min_similarity: float = 0.3) -> List[HistoryMatch]:
+        """The k indexed questions most similar to this one.
+
+        Only questions with a cosine similarity of at least min_similarity are
+        returned.
+        """
+        features, weights = feature_arrays([question])
+        features, weights = features[0][features[0] >= 0], weights[0][features[0] >= 0]
+        if not len(features):
+            return []
+        keys = band_keys(features[None, :])[0]
+        with self._lock:
+            candidates = []
+            for band, key in enumerate(keys):
+                sorted_keys = self._sorted_keys[band]
+                left = np.searchsorted(sorted_keys, key, side="left")
+                right = np.searchsorted(sorted_keys, key, side="right")
+                first = max(left, right - MAX_BUCKET_CANDIDATES)
+                candidates.append(self._sorted_ids[band, first:right])
+                recent = self._recent.get(int(key), [])[-MAX_BUCKET_CANDIDATES:]
+                candidates.append(np.array(recent, dtype=np.int64))
+            ids = np.unique(np.concatenate(candidates))
+            if not len(ids):
+                return []
+            candidate_features = self._features[ids]
+            candidate_weights = self._weights[ids]
+            questions = [self.questions[i] for i in ids]
+            sqls = [self.sqls[i] for i in ids]
+
+        # Cosine similarity of the query with every candidate at once
+        order = np.argsort(features)
+        sorted_features, sorted_weights = features[order], weights[order]
+        positions = np.searchsorted(sorted_features, candidate_features)
+        positions = positions.clip(max=len(sorted_features) - 1)
+        hits = sorted_features[positions] == candidate_features
+        products = candidate_weights * sorted_weights[positions] * hits
+        similarities = products.sum(axis=1)
+
+        best = np.argsort(-similarities, kind="stable")[:k]
+        return [
+            HistoryMatch(questions[i], sqls[i], float(similarities[i]))
+            for i in best if similarities[i] >= min_similarity
+        ]
+
+class QueryHistory:
+    """Append-only DuckDB log of processed questions; successful ones are indexed.
+
+    record() queues an entry and returns immediately; a background thread
+    inserts queued entries in batches of up to batch_size, at least every
+    flush_interval seconds. The index covers the questions answered against
+    one schema fingerprint and is rebuilt from the log, in the background,
+    when the fingerprint changes. db_path=None keeps the history in memory
+    only.
+    """
+
+    def __init__(self, db_path: Optional[Path] = HISTORY_DB_PATH,
+                 batch_size: int = 256, flush_interval: float = 1.0):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.index = HistoryIndex()
+        self.fingerprint: Optional[str] = None
+        self._conn = None
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        # Threads loading the index, the last one for the current fingerprint
+        self._loaders: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._conn_lock = threading.Lock()
+
+    def _connection(self):
+        """Open the history database on first use. Returns None when memory-only."""
+        with self._conn_lock:
+            if self._conn is None and self.db_path is not None:
+                try:
+                    self.db_path.parent.mkdir(parents=True, exist_ok=True)
+                    self._conn = duckdb.connect(str(self.db_path))
+                except duckdb.IOException:
+                    # Another process holds the file lock; keep working from memory
+                    self.db_path = None
+                    return None
+                self._conn.execute("CREATE SEQUENCE IF NOT EXISTS query_history_id")
+                self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS query_history (
+                    id BIGINT PRIMARY KEY DEFAULT nextval('query_history_id'),
+                    created_at TIMESTAMP NOT NULL,
+                    question VARCHAR NOT NULL,
+                    normalized_question VARCHAR NOT NULL,
+                    schema_fingerprint VARCHAR,
+                    sql VARCHAR,
+                    success BOOLEAN NOT NULL,
+                    error VARCHAR,
+                    row_count BIGINT,
+                    total_ms DOUBLE,
+                    -- JSON object of stage -> milliseconds
+                    stages VARCHAR
+                )
+                """)
+            return self._conn
+
+    def use_fingerprint(self, fingerprint: str):
+        """Serve lookups for a schema, reloading the index from the log on a change."""
+        with self._lock:
+            if fingerprint == self.fingerprint:
+                return
+            self.fingerprint = fingerprint
+            self.index = HistoryIndex()
+            if self.db_path is not None:
+                loader = threading.Thread(
+                    target=self._load, args=(fingerprint, self.index),
+                    name="history-loader", daemon=True,
+                )
+                self._loaders = [
+                    thread for thread in self._loaders if thread.is_alive()
+                ]
+                self._loaders.append(loader)
+                loader.start()
+
+    def _load(self, fingerprint: str, index: HistoryIndex):
+        """Index the latest SQL of every question answered successfully for a schema."""
+        conn = self._connection()
+        if conn is None:
+            return
+        with self._conn_lock:
+            cursor = conn.cursor()
+        try:
+            rows = cursor.execute("""
+            SELECT question, sql
+            FROM query_history
+            WHERE success AND row_count IS NOT NULL AND schema_fingerprint = ?
+            QUALIFY row_number() OVER (
+                PARTITION BY normalized_question ORDER BY id DESC
+            ) = 1
+            ORDER BY id
+            """, [fingerprint]).fetchall()
+        finally:
+            cursor.close()
+        for start in range(0, len(rows), LOAD_CHUNK_SIZE):
+            if index is not self.index:
+                # The schema changed again
+                return
+            index.add_many(rows[start:start + LOAD_CHUNK_SIZE])
+
+    def lookup(self, question: str, fingerprint: str,
+               k: int = 3) -> List[HistoryMatch]:
+        """Successful past questions similar to this one, asked of the same schema."""
+        self.use_fingerprint(fingerprint)
+        index = self.index
+        exact = index.exact(question)
+        matches = index.search(question, k)
+        if exact is not None:
+            others = [match for match in matches if match.question != exact.question]
+            matches = [exact] + others[:k - 1]
+        return matches
+
+    def record(self, trace):
+        """Queue a trace of a processed question for the log.
+
+        Successful questions, whose SQL ran without error, are indexed at
+        once; SQL that was only generated (no row count) is logged but not
+        reused.
+        """
+        if not trace.question:
+            return
+        fingerprint = getattr(trace, "schema_fingerprint", None)
+        if (trace.ok and trace.sql and trace.rows is not None
+                and fingerprint is not None and fingerprint == self.fingerprint):
+            self.index.add(trace.question, trace.sql)
+        if self.db_path is None:
+            # Memory only: no writer would ever take the entry off the queue
+            return
+        stages = {
+            stage: round(seconds * 1000, 3) for stage, seconds in trace.stages.items()
+        }
+        total = trace.stages.get("total")
+        self._queue.put((
+            time.time(), trace.question, normalize_question(trace.question),
+            fingerprint, trace.sql, trace.ok, trace.error, trace.rows,
+            None if total is None else total * 1000, json.dumps(stages),
+        ))
+        self._start_writer()
+
+    def _start_writer(self):
+        if self._writer is None and self.db_path is not None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(
+                        target=self._write_loop, name="history-writer", daemon=True
+                    )
+                    self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            entry = self._queue.get()
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            while entry is not None and len(batch) < self.batch_size:
+                try:
+                    timeout = max(0.0, deadline - time.monotonic())
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(entry)
+            stop = batch[-1] is None
+            rows = [row for row in batch if row is not None]
+            try:
+                self._insert(rows)
+            except duckdb.Error:
+                import logging
+                logging.getLogger(__name__).exception(
+                    "Writing %d history entries failed", len(rows)
+                )
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _insert(self, rows: List[tuple]):
+        conn = self._connection()
+        if conn is None or not rows:
+            return
+        with self._conn_lock:
+            conn.executemany("""
+            INSERT INTO query_history (created_at, question, normalized_question,
+                                       schema_fingerprint, sql, success, error,
+                                       row_count, total_ms, stages)
+            VALUES (to_timestamp(?), ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+
+    def flush(self):
+        """Wait until every queued entry has been written."""
+        if self._writer is not None:
+            self._queue.join()
+
+    def close(self):
+        """Write the queued entries and stop the writer thread."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        # Loaders still reading the log would lose their connection
+        for loader in self._loaders:
+            loader.join()
+        self._loaders = []
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def recent(self, limit: int = 20) -> List[Dict]:
+        """The most recently logged questions, newest first."""
+        self.flush()
+        conn = self._connection()
+        if conn is None:
+            return []
+        with self._conn_lock:
+            rows = conn.execute("""
+            SELECT created_at, question, sql, success, row_count, total_ms
+            FROM query_history
+            ORDER BY id DESC
+            LIMIT ?
+            """, [limit]).fetchall()
+        columns = ("created_at", "question", "sql", "success", "row_count", "total_ms")
+        return [dict(zip(columns, row)) for row in rows]
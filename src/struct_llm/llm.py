@@ -0,0 +1,291 @@
+"""
+LLM backends: where the pipeline's prompts are sent.
+
+LLMBackend is the interface nl_to_sql calls: complete() returns the response
+text, stream() yields it as it is generated and complete_async() is used by
+batch processing. Implementations:
+
+- OpenAIClientBackend wraps an OpenAI SDK client, or a fake with its interface.
+  It is the default.
+- HTTPBackend posts to any OpenAI-compatible /chat/completions endpoint
+  (a proxy, a local model server or benchmarks/llm_server.py) through a
+  requests session, which keeps its connections alive and retries rate
+  limiting (429), server errors (5xx) and connection failures with backoff.
+- RoutingBackend sends short prompts over few tables to a cheaper backend and
+  everything else to the default one.
+"""
+
+import asyncio
+import json
+import re
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from struct_llm.retrieval import count_tokens
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+
+# Response statuses HTTPBackend retries: rate limiting and server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+Messages = List[Dict[str, str]]
+
+# Lines of the schema block that start a table, see struct_llm.catalog.render_schema
+TABLE_LINE_RE = re.compile(r"^Table: ", re.MULTILINE)
+
+# Questions asking for comparisons or derived measures go to the default model
+COMPLEX_QUESTION_RE = re.compile(
+    r"^User Question: .*\b(?:compare|comparison|versus|vs|trend|growth|rank\w*"
+    r"|ratio|percent\w*|share|cumulative|running|median|correlat\w*"
+    r"|year over year|month over month)\b",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+class APIStatusError(Exception):
+    """The API answered with an error status."""
+
+    def __init__(self, message: str, status_code: int,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class LLMBackend:
+    """A chat completion model.
+
+    Subclasses implement complete(); stream() and complete_async() default to
+    a single chunk and a worker thread. If a trace is passed, the token usage
+    and the model that answered are recorded in it.
+    """
+    model: str = ""
+
+    def complete(self, messages: Messages, trace=None) -> str:
+        """The text of the model's response to messages."""
+        raise NotImplementedError
+
+    def stream(self, messages: Messages, trace=None) -> Iterator[str]:
+        """Yield the response text as it is generated; closing the iterator stops it."""
+        yield self.complete(messages, trace)
+
+    async def complete_async(self, messages: Messages, trace=None) -> str:
+        return await asyncio.to_thread(self.complete, messages, trace)
+
+    def close(self):
+        """Release the backend's connections."""
+
+    def _record(self, trace, usage, model: Optional[str] = None):
+        if trace is not None:
+            trace.model = model or self.model
+            trace.record_usage(usage)
+
+class HTTPBackend(LLMBackend):
+    """OpenAI-compatible chat completions over a requests session.
+
+    The session keeps up to pool_size keep-alive connections, so the TCP and
+    TLS handshakes are paid once per connection. Its adapter retries
+    connection failures, 429 and 5xx responses up to retries times, waiting
+    as long as the server's Retry-After header asks or else with exponential
+    backoff. Streams are only retried before their response arrives.
+    complete_async() runs complete() in a worker thread.
+    """
+
+    def __init__(self, api_key: Optional[str], model: str,
+                 base_url: str = DEFAULT_BASE_URL, temperature: float = 0.1,
+                 connect_timeout: float = 5.0, read_timeout: float = 60.0,
+                 retries: int = 2, backoff: float = 0.5, pool_size: int = 8):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.api_key = api_key
+        self.model = model
+        self.temperature = temperature
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"POST"}), respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(
+            {"Content-Type": "application/json", "Accept": "application/json"}
+        )
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def _payload(self, messages: Messages, stream: bool = False) -> Dict:
+        payload = {
+            "model": self.model, "messages": messages, "temperature": self.temperature,
+        }
+        if stream:
+            payload.update(stream=True, stream_options={"include_usage": True})
+        return payload
+
+    def _post(self, payload: Dict, stream: bool = False):
+        """POST a completion request; the session retries failures.
+
+        Raises APIStatusError for an error status.
+        """
+        response = self.session.post(
+            self.url, json=payload, timeout=self.timeout, stream=stream
+        )
+        if response.status_code >= 400:
+            try:
+                raise _status_error(
+                    response.status_code, response.reason,
+                    response.headers.get("Retry-After"), response.content,
+                )
+            finally:
+                response.close()
+        return response
+
+    def complete(self, messages: Messages, trace=None) -> str:
+        data = self._post(self._payload(messages)).json()
+        usage = data.get("usage")
+        usage = SimpleNamespace(**usage) if usage else None
+        self._record(trace, usage, data.get("model"))
+        return data["choices"][0]["message"]["content"] or ""
+
+    def stream(self, messages: Messages, trace=None) -> Iterator[str]:
+        response = self._post(self._payload(messages, stream=True), stream=True)
+        if trace is not None:
+            # The usage, which names the model too, only comes at the end of a stream
+            # that is read to the end
+            trace.model = self.model
+        try:
+            # Server-sent events: "data: {chunk}" lines, ending with "data: [DONE]"
+            for line in response.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("usage"):
+                    usage = SimpleNamespace(**chunk["usage"])
+                    self._record(trace, usage, chunk.get("model"))
+                choices = chunk.get("choices")
+                if choices and choices[0].get("delta", {}).get("content"):
+                    yield choices[0]["delta"]["content"]
+        finally:
+            # Closed before the end, the connection is dropped, which stops the
+            # generation
+            response.close()
+
+    def close(self):
+        self.session.close()
+
+def _status_error(status: int, reason: str, retry_after: Optional[str],
+                  body: bytes) -> APIStatusError:
+    """The error of a failed response."""
+    try:
+        message = json.loads(body)["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        message = body.decode(errors="replace")[:500]
+    try:
+        delay = float(retry_after) if retry_after is not None else None
+    except ValueError:
+        # An HTTP date; fall back to the backoff
+        delay = None
+    return APIStatusError(f"{status} {reason}: {message}", status, delay)
+
+class OpenAIClientBackend(LLMBackend):
+    """An OpenAI SDK client, or anything with its chat.completions.create() interface.
+
+    complete_async() uses async_client, or the client async_client_factory
+    creates on its first call; without either, the blocking client runs in a
+    worker thread.
+    """
+
+    def __init__(self, client, model: str, temperature: float = 0.1,
+                 async_client=None,
+                 async_client_factory: Optional[Callable[[], Any]] = None):
+        self.client = client
+        self.async_client = async_client
+        self.async_client_factory = async_client_factory
+        self.model = model
+        self.temperature = temperature
+
+    def complete(self, messages: Messages, trace=None) -> str:
+        response = self.client.chat.completions.create(
+            model=self.model, messages=messages, temperature=self.temperature
+        )
+        self._record(trace, getattr(response, "usage", None))
+        return response.choices[0].message.content or ""
+
+    def stream(self, messages: Messages, trace=None) -> Iterator[str]:
+        response = self.client.chat.completions.create(
+            model=self.model, messages=messages, temperature=self.temperature,
+            stream=True, stream_options={"include_usage": True},
+        )
+        if trace is not None:
+            trace.model = self.model
+        try:
+            for chunk in response:
+                if getattr(chunk, "usage", None) is not None:
+                    self._record(trace, chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            close = getattr(response, "close", None)
+            if close is not None:
+                close()
+
+    async def complete_async(self, messages: Messages, trace=None) -> str:
+        if self.async_client is None and self.async_client_factory is not None:
+            self.async_client = self.async_client_factory()
+        if self.async_client is None:
+            return await super().complete_async(messages, trace)
+        response = await self.async_client.chat.completions.create(
+            model=self.model, messages=messages, temperature=self.temperature
+        )
+        self._record(trace, getattr(response, "usage", None))
+        return response.choices[0].message.content or ""
+
+class RoutingBackend(LLMBackend):
+    """Send simple prompts to a cheaper backend and the rest to the default one.
+
+    A prompt is simple if it has at most max_tokens tokens, its schema block
+    has at most max_tables tables and its question doesn't ask for a
+    comparison, ranking, share or trend (COMPLEX_QUESTION_RE).
+    """
+
+    def __init__(self, small: LLMBackend, default: LLMBackend, max_tokens: int = 1500,
+                 max_tables: int = 2):
+        self.small = small
+        self.default = default
+        self.max_tokens = max_tokens
+        self.max_tables = max_tables
+
+    @property
+    def model(self) -> str:
+        return self.default.model
+
+    def route(self, messages: Messages) -> LLMBackend:
+        """The backend to send messages to."""
+        prompt = messages[-1]["content"]
+        if (len(TABLE_LINE_RE.findall(prompt)) > self.max_tables
+                or COMPLEX_QUESTION_RE.search(prompt)
+                or sum(count_tokens(message["content"])
+                       for message in messages) > self.max_tokens):
+            return self.default
+        return self.small
+
+    def complete(self, messages: Messages, trace=None) -> str:
+        return self.route(messages).complete(messages, trace)
+
+    def stream(self, messages: Messages, trace=None) -> Iterator[str]:
+        return self.route(messages).stream(messages, trace)
+
+    async def complete_async(self, messages: Messages, trace=None) -> str:
+        return await self.route(messages).complete_async(messages, trace)
+
+    def close(self):
+        self.small.close()
+        self.default.close()
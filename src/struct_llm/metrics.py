@@ -0,0 +1,362 @@
+"""
+Per-question tracing and aggregate metrics for the NL->SQL pipeline.
+
+process_question fills a Trace with the wall time of each stage (metadata,
+cache, history, prompt, llm, repair, result_cache, rollup, partitions, guard,
+execute, fetch), the model called and the token usage it reported, the rows
+and bytes materialized, whether the translation and result caches were hit,
+whether the query history answered the question or supplied examples, which
+rollup tables answered the query and how rejected SQL was repaired.
+Finished traces are recorded in a MetricsRegistry, which keeps counters and
+latency histograms, renders them as Prometheus text or JSON and passes each
+trace on to registered hooks.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds of the stage latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+METRIC_PREFIX = "struct_llm"
+
+Hook = Callable[["Trace"], None]
+
+@dataclass
+class Trace:
+    """What happened while answering one question."""
+    question: str
+    # Seconds spent per stage, in the order the stages ran
+    stages: Dict[str, float] = field(default_factory=dict)
+    sql: Optional[str] = None
+    cache_hit: Optional[bool] = None
+    # Fingerprint of the schema the SQL was generated for
+    schema_fingerprint: Optional[str] = None
+    # "answered" when the SQL of a past question was reused, "examples" when
+    # past questions were put in the prompt
+    history: Optional[str] = None
+    # None when the query's result can't be cached
+    result_cache_hit: Optional[bool] = None
+    # Model that generated the SQL, when an LLM was called
+    model: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    rows: Optional[int] = None
+    result_bytes: Optional[int] = None
+    # Rows the query planner expected, and whether a LIMIT was added because of it
+    estimated_rows: Optional[int] = None
+    limited: bool = False
+    # Rollup tables the query was rewritten to read
+    rollups: List[str] = field(default_factory=list)
+    # Repairs of rejected SQL, "local" or "llm", in order
+    repairs: List[str] = field(default_factory=list)
+    error_stage: Optional[str] = None
+    error_type: Optional[str] = None
+    error: Optional[str] = None
+    started_at: float = field(default_factory=time.time)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage; an exception escaping it is recorded as the trace's error."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.fail(name, e)
+            raise
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def fail(self, stage: str, error: BaseException):
+        """Record the first error of the trace."""
+        if self.error is None:
+            self.error_stage = stage
+            self.error_type = type(error).__name__
+            self.error = str(error)
+
+    def clear_error(self):
+        """Forget the recorded error, e.g. once rejected SQL was repaired."""
+        self.error_stage = self.error_type = self.error = None
+
+    def record_usage(self, usage):
+        """Add the token counts of an OpenAI response's `usage`, if it has any."""
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        if prompt_tokens is not None:
+            self.prompt_tokens = (self.prompt_tokens or 0) + prompt_tokens
+        if completion_tokens is not None:
+            self.completion_tokens = (self.completion_tokens or 0) + completion_tokens
+
+    def record_result(self, df):
+        """Record the size of a Polars result."""
+        self.rows = df.height
+        self.result_bytes = df.estimated_size()
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+class Histogram:
+    """Cumulative latency histogram with fixed buckets, as in Prometheus."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """(le, cumulative count) pairs including +Inf."""
+        pairs, running = [], 0
+        for bound, count in zip(list(self.buckets) + [float("inf")], self.counts):
+            running += count
+            pairs.append(("+Inf" if bound == float("inf") else repr(bound), running))
+        return pairs
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile by linear interpolation, like histogram_quantile()."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower, running = 0.0, 0
+        for bound, count in zip(self.buckets, self.counts):
+            if running + count >= rank and count:
+                return lower + (bound - lower) * (rank - running) / count
+            running += count
+            lower = bound
+        # The quantile falls in the +Inf bucket
+        return self.buckets[-1]
+
+def _labels(**labels: str) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{name}="'
+        + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+class MetricsRegistry:
+    """Thread-safe aggregate of recorded traces, with hooks called for every trace."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+                 keep_recent: int = 100):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._hooks: List[Hook] = []
+        self._recent: deque = deque(maxlen=keep_recent)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.questions = 0
+            self.errors: Dict[Tuple[str, str], int] = {}
+            self.cache = {"hit": 0, "miss": 0}
+            self.result_cache = {"hit": 0, "miss": 0}
+            self.history = {"answered": 0, "examples": 0}
+            self.tokens = {"prompt": 0, "completion": 0}
+            self.models: Dict[str, int] = {}
+            self.rows = 0
+            self.result_bytes = 0
+            self.limited = 0
+            self.repairs = {"local": 0, "llm": 0}
+            self.rollups: Dict[str, int] = {}
+            self.stages: Dict[str, Histogram] = {}
+            self._recent.clear()
+
+    def add_hook(self, hook: Hook):
+        """Call hook with every recorded trace, e.g. to log or forward it."""
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook: Hook):
+        with self._lock:
+            self._hooks.remove(hook)
+
+    def record(self, trace: Trace):
+        """Add a finished trace to the aggregates and pass it to the hooks."""
+        with self._lock:
+            self.questions += 1
+            if trace.error is not None:
+                key = (trace.error_stage or "unknown", trace.error_type or "Exception")
+                self.errors[key] = self.errors.get(key, 0) + 1
+            if trace.cache_hit is not None:
+                self.cache["hit" if trace.cache_hit else "miss"] += 1
+            if trace.result_cache_hit is not None:
+                self.result_cache["hit" if trace.result_cache_hit else "miss"] += 1
+            if trace.history is not None:
+                self.history[trace.history] += 1
+            if trace.model is not None:
+                self.models[trace.model] = self.models.get(trace.model, 0) + 1
+            self.tokens["prompt"] += trace.prompt_tokens or 0
+            self.tokens["completion"] += trace.completion_tokens or 0
+            self.rows += trace.rows or 0
+            self.result_bytes += trace.result_bytes or 0
+            self.limited += trace.limited
+            for repair in trace.repairs:
+                self.repairs[repair] = self.repairs.get(repair, 0) + 1
+            for rollup in trace.rollups:
+                self.rollups[rollup] = self.rollups.get(rollup, 0) + 1
+            for stage, seconds in trace.stages.items():
+                histogram = self.stages.get(stage)
+                if histogram is None:
+                    histogram = self.stages[stage] = Histogram(self.buckets)
+                histogram.observe(seconds)
+            self._recent.append(trace)
+            hooks = list(self._hooks)
+
+        for hook in hooks:
+            try:
+                hook(trace)
+            except Exception:
+                # A broken hook must not fail the question it observes
+                import logging
+                logging.getLogger(__name__).exception("Metrics hook %r failed", hook)
+
+    def recent(self) -> List[Trace]:
+        """The most recently recorded traces, oldest first."""
+        with self._lock:
+            return list(self._recent)
+
+    def snapshot(self) -> Dict:
+        """The aggregates as plain data, with approximate p50/p95 stage latencies."""
+        with self._lock:
+            return {
+                "questions": self.questions,
+                "errors": [
+                    {"stage": stage, "type": error_type, "count": count}
+                    for (stage, error_type), count in sorted(self.errors.items())
+                ],
+                "cache": dict(self.cache),
+                "result_cache": dict(self.result_cache),
+                "history": dict(self.history),
+                "tokens": dict(self.tokens),
+                "models": dict(self.models),
+                "rows": self.rows,
+                "result_bytes": self.result_bytes,
+                "limited": self.limited,
+                "repairs": dict(self.repairs),
+                "rollups": dict(self.rollups),
+                "stages": {
+                    stage: {
+                        "count": histogram.count,
+                        "total_s": histogram.sum,
+                        "mean_ms": histogram.sum / histogram.count * 1000,
+                        "p50_ms": histogram.quantile(0.5) * 1000,
+                        "p95_ms": histogram.quantile(0.95) * 1000,
+                    }
+                    for stage, histogram in self.stages.items()
+                },
+            }
+
+    def to_json(self, indent: Optional[int] = 2) -> str:
+        import json
+        return json.dumps(self.snapshot(), indent=indent)
+
+    def to_prometheus(self) -> str:
+        """Render the aggregates in the Prometheus text exposition format."""
+        p = METRIC_PREFIX
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str,
+                   samples: List[Tuple[str, float]]):
+            lines.append(f"# HELP {p}_{name} {help_text}")
+            lines.append(f"# TYPE {p}_{name} {kind}")
+            for suffix_and_labels, value in samples:
+                lines.append(f"{p}_{name}{suffix_and_labels} {value}")
+
+        with self._lock:
+            metric("questions_total", "counter", "Questions processed.", [
+                ("", self.questions),
+            ])
+            metric("errors_total", "counter",
+                   "Questions that failed, by stage and error type.", [
+                (_labels(stage=stage, type=error_type), count)
+                for (stage, error_type), count in sorted(self.errors.items())
+            ])
+            metric("translation_cache_total", "counter",
+                   "Translation cache lookups, by result.", [
+                (_labels(result=result), count) for result, count in self.cache.items()
+            ])
+            metric("result_cache_total", "counter",
+                   "Result cache lookups, by result.", [
+                (_labels(result=result), count)
+                for result, count in self.result_cache.items()
+            ])
+            metric("history_total", "counter",
+                   "Questions helped by the query history, by use.", [
+                (_labels(use=use), count) for use, count in self.history.items()
+            ])
+            metric("llm_tokens_total", "counter",
+                   "Tokens reported by the LLM, by kind.", [
+                (_labels(kind=kind), count) for kind, count in self.tokens.items()
+            ])
+            metric("llm_questions_total", "counter",
+                   "Questions the LLM was called for, by model.", [
+                (_labels(model=model), count)
+                for model, count in sorted(self.models.items())
+            ])
+            metric("result_rows_total", "counter", "Result rows materialized.", [
+                ("", self.rows),
+            ])
+            metric("result_bytes_total", "counter",
+                   "Estimated bytes of materialized results.", [
+                ("", self.result_bytes),
+            ])
+            metric("auto_limited_total", "counter",
+                   "Queries given a LIMIT because of their estimated size.", [
+                ("", self.limited),
+            ])
+            metric("sql_repairs_total", "counter",
+                   "Repairs of SQL that DuckDB rejected, by kind.", [
+                (_labels(kind=kind), count) for kind, count in self.repairs.items()
+            ])
+            metric("rollup_rewrites_total", "counter",
+                   "Queries answered from a rollup table, by rollup.", [
+                (_labels(rollup=rollup), count)
+                for rollup, count in sorted(self.rollups.items())
+            ])
+
+            samples = []
+            for stage, histogram in self.stages.items():
+                for le, count in histogram.cumulative():
+                    samples.append((f"_bucket{_labels(stage=stage, le=le)}", count))
+                samples.append((f"_sum{_labels(stage=stage)}", histogram.sum))
+                samples.append((f"_count{_labels(stage=stage)}", histogram.count))
+            metric("stage_seconds", "histogram", "Time spent per pipeline stage.",
+                   samples)
+        return "\n".join(lines) + "\n"
+
+def jsonl_hook(path) -> Hook:
+    """A hook appending every trace to a JSON-lines file."""
+    import json
+    lock = threading.Lock()
+
+    def hook(trace: Trace):
+        line = json.dumps(trace.to_dict(), default=str)
+        with lock, open(path, "a") as f:
+            f.write(line + "\n")
+    return hook
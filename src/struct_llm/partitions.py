@@ -0,0 +1,439 @@
+"""
+Hive-partitioned Parquet storage of large tables, and partition pruning of
+queries over it.
+
+With the Parquet storage layout (data/update_database.py --storage parquet),
+orders is kept as Parquet files under data/orders/, one directory per month
+of order_date (order_year=2024/order_month=3/), and database.db holds a view
+of the same name over them. schema_metadata, the prompt, profiling and the
+rollups see the view like the table; it adds the partition columns
+order_year and order_month. Loading writes only what changed: new rows of
+months without changed rows, such as a new day's orders, are appended to
+their month as a new file, and only the months where a stored row changed
+are rewritten. Files are written to a staging directory and moved into
+place.
+
+DuckDB skips the directories whose partition values fail a filter on
+order_year and order_month, but not for a filter on order_date, which is
+what date-ranged questions filter on. PartitionPruner adds the partition
+filter implied by each comparison of order_date (or year(order_date)) with a
+constant: WHERE order_date >= DATE '2024-03-10' gets
+AND (order_year, order_month) >= (2024, 3).
+"""
+
+import copy
+import json
+import re
+import shutil
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import duckdb
+
+from struct_llm.profiling import quote_identifier
+from struct_llm.rollup import MAIN_SCHEMAS, _statement
+
+
+@dataclass(frozen=True)
+class PartitionedTable:
+    """A table stored as Parquet files partitioned by the year and month of a date."""
+    name: str
+    date_column: str
+    year_column: str
+    month_column: str
+
+ORDERS = PartitionedTable("orders", "order_date", "order_year", "order_month")
+
+PARTITIONED_TABLES = [ORDERS]
+
+# Comparison of a column with a constant -> the comparison with the sides swapped
+MIRRORED = {
+    "COMPARE_EQUAL": "COMPARE_EQUAL",
+    "COMPARE_GREATERTHAN": "COMPARE_LESSTHAN",
+    "COMPARE_GREATERTHANOREQUALTO": "COMPARE_LESSTHANOREQUALTO",
+    "COMPARE_LESSTHAN": "COMPARE_GREATERTHAN",
+    "COMPARE_LESSTHANOREQUALTO": "COMPARE_GREATERTHANOREQUALTO",
+}
+OPERATORS = {
+    "COMPARE_EQUAL": "=",
+    "COMPARE_GREATERTHAN": ">",
+    "COMPARE_GREATERTHANOREQUALTO": ">=",
+    "COMPARE_LESSTHAN": "<",
+    "COMPARE_LESSTHANOREQUALTO": "<=",
+}
+
+# Expression classes a constant must not contain
+NON_CONSTANT_CLASSES = {
+    "COLUMN_REF", "SUBQUERY", "PARAMETER", "WINDOW", "STAR", "LAMBDA", "LAMBDA_REF",
+    "DEFAULT",
+}
+# Special values that parse as column references, e.g.
+# WHERE order_date >= current_date - INTERVAL 30 DAY
+CONSTANT_COLUMN_REFS = {
+    "current_date", "current_timestamp", "current_time", "localtimestamp", "localtime",
+}
+
+def partitioned_table(table_name: str) -> Optional[PartitionedTable]:
+    """The partitioning of a table, if it can be stored partitioned."""
+    for table in PARTITIONED_TABLES:
+        if table.name == table_name:
+            return table
+    return None
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+def is_partitioned(conn, table: PartitionedTable) -> bool:
+    """True if the table is a view over its partitioned Parquet files."""
+    # Checked on the view's SQL: the columns of a view over Parquet files are only
+    # known by reading them
+    return conn.execute("""
+    SELECT count(*)
+    FROM duckdb_views()
+    WHERE database_name = current_database() AND schema_name = 'main' AND view_name = ?
+        AND contains(sql, 'read_parquet') AND contains(sql, ?)
+    """, [table.name, table.year_column]).fetchone()[0] > 0
+
+def create_view(conn, table: PartitionedTable, directory: Path):
+    """Replace the table with a view over the Parquet files under directory.
+
+    The partition columns come last.
+    """
+    year = quote_identifier(table.year_column)
+    month = quote_identifier(table.month_column)
+    files = _literal(str(directory / "*" / "*" / "*.parquet"))
+    hive_types = (f"{{{_literal(table.year_column)}: INTEGER, "
+                  f"{_literal(table.month_column)}: INTEGER}}")
+    stored_as_table = conn.execute("""
+    SELECT count(*) FROM duckdb_tables()
+    WHERE database_name = current_database() AND schema_name = 'main' AND table_name = ?
+    """, [table.name]).fetchone()[0] > 0
+    if stored_as_table:
+        conn.execute(f"DROP TABLE {quote_identifier(table.name)}")
+    conn.execute(f"""
+    CREATE OR REPLACE VIEW {quote_identifier(table.name)} AS
+    SELECT * EXCLUDE ({year}, {month}), {year}, {month}
+    FROM read_parquet({files}, hive_partitioning = true, hive_types = {hive_types})
+    """)
+
+def _with_partition_columns(table: PartitionedTable, rows: str) -> str:
+    date = quote_identifier(table.date_column)
+    return (f"SELECT *, year({date}) AS {quote_identifier(table.year_column)}, "
+            f"month({date}) AS {quote_identifier(table.month_column)} FROM {rows}")
+
+def _copy_partitioned(conn, table: PartitionedTable, query: str, directory: Path):
+    year = quote_identifier(table.year_column)
+    month = quote_identifier(table.month_column)
+    conn.execute(f"""
+    COPY ({query}) TO {_literal(str(directory))}
+    (FORMAT parquet, COMPRESSION zstd, PARTITION_BY ({year}, {month}),
+     OVERWRITE_OR_IGNORE)
+    """)
+
+def _partition_files(directory: Path) -> Dict[Path, List[Path]]:
+    """Parquet files under directory by partition directory, relative to directory."""
+    files: Dict[Path, List[Path]] = {}
+    for path in sorted(directory.glob("*/*/*.parquet")):
+        files.setdefault(path.parent.relative_to(directory), []).append(path)
+    return files
+
+def store_partitioned(conn, table: PartitionedTable, rows: str, key: str,
+                      directory: Path, rebuild: bool = False) -> Tuple[int, int]:
+    """Write the rows of a table or query (e.g. a staging table) to the partitions.
+
+    With rebuild, the stored rows are replaced by them; otherwise they are
+    upserted by key. The view is (re)created over directory. Returns (rows
+    upserted, partitions written). Needs a writable connection.
+    """
+    name = quote_identifier(table.name)
+    key_col = quote_identifier(key)
+    year = quote_identifier(table.year_column)
+    month = quote_identifier(table.month_column)
+    staging = directory.parent / f".{directory.name}.staging"
+    shutil.rmtree(staging, ignore_errors=True)
+    if rebuild:
+        upserted = conn.execute(f"SELECT count(*) FROM {rows}").fetchone()[0]
+        if not upserted:
+            raise ValueError(f"Can't store {table.name} partitioned without any rows")
+        _copy_partitioned(conn, table, _with_partition_columns(table, rows), staging)
+        written = len(_partition_files(staging))
+        previous = directory.parent / f".{directory.name}.previous"
+        shutil.rmtree(previous, ignore_errors=True)
+        if directory.exists():
+            directory.rename(previous)
+        staging.rename(directory)
+        shutil.rmtree(previous, ignore_errors=True)
+        create_view(conn, table, directory)
+        return upserted, written
+
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE _changes AS
+    SELECT * FROM {rows}
+    EXCEPT
+    SELECT * EXCLUDE ({year}, {month}) FROM {name}
+    """)
+    # Months holding a stored version of a changed row are rewritten, the changed
+    # rows of other months are appended
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE _rewritten AS
+    SELECT DISTINCT {year}, {month} FROM {name}
+    WHERE {key_col} IN (SELECT {key_col} FROM _changes)
+    """)
+    upserted = conn.execute("SELECT count(*) FROM _changes").fetchone()[0]
+    staging.mkdir(parents=True)
+    rewritten = f"(SELECT {year}, {month} FROM _rewritten)"
+    changes = _with_partition_columns(table, "_changes")
+    _copy_partitioned(conn, table, f"""
+    SELECT * FROM {name}
+    WHERE ({year}, {month}) IN {rewritten}
+        AND {key_col} NOT IN (SELECT {key_col} FROM _changes)
+    UNION ALL BY NAME
+    SELECT * FROM ({changes}) WHERE ({year}, {month}) IN {rewritten}
+    """, staging / "rewritten")
+    _copy_partitioned(conn, table, f"""
+    SELECT * FROM ({changes}) WHERE ({year}, {month}) NOT IN {rewritten}
+    """, staging / "appended")
+    conn.execute("DROP TABLE _changes")
+    conn.execute("DROP TABLE _rewritten")
+
+    stored = _partition_files(directory)
+    written = 0
+    for kind in ("rewritten", "appended"):
+        for partition, paths in _partition_files(staging / kind).items():
+            target = directory / partition
+            target.mkdir(parents=True, exist_ok=True)
+            for path in paths:
+                path.rename(target / f"{uuid.uuid4().hex}.parquet")
+            if kind == "rewritten":
+                for path in stored.get(partition, []):
+                    path.unlink()
+            written += 1
+    # Months whose rows all moved to other months
+    for partition, paths in stored.items():
+        if not any((directory / partition).glob("*.parquet")):
+            (directory / partition).rmdir()
+    shutil.rmtree(staging, ignore_errors=True)
+    create_view(conn, table, directory)
+    return upserted, written
+
+def _conjuncts(node: dict) -> List[dict]:
+    if node.get("class") == "CONJUNCTION" and node.get("type") == "CONJUNCTION_AND":
+        return [
+            conjunct for child in node["children"] for conjunct in _conjuncts(child)
+        ]
+    return [node]
+
+def _is_constant(node) -> bool:
+    if isinstance(node, list):
+        return all(_is_constant(item) for item in node)
+    if not isinstance(node, dict):
+        return True
+    if node.get("class") == "COLUMN_REF":
+        names = node.get("column_names", [])
+        return len(names) == 1 and names[0].lower() in CONSTANT_COLUMN_REFS
+    if node.get("class") in NON_CONSTANT_CLASSES:
+        return False
+    return all(_is_constant(value) for value in node.values())
+
+class PartitionPruner:
+    """Adds the partition filters implied by date filters to queries over the views."""
+
+    def __init__(self, tables: Optional[List[PartitionedTable]] = None):
+        self.tables = PARTITIONED_TABLES if tables is None else tables
+        self._expressions: Dict[str, dict] = {}
+        pattern = "|".join(re.escape(table.date_column) for table in self.tables)
+        self._date_re = (
+            re.compile(rf"\b({pattern})\b", re.IGNORECASE) if pattern else None
+        )
+
+    def partitioned(self, conn) -> Dict[str, PartitionedTable]:
+        """The tables stored partitioned in this database, by name."""
+        return {
+            table.name: table for table in self.tables if is_partitioned(conn, table)
+        }
+
+    def parse_expression(self, conn, text: str) -> dict:
+        """The syntax tree of an expression, parsed once per text."""
+        if text not in self._expressions:
+            tree = json.loads(conn.execute(
+                "SELECT json_serialize_sql(?)", [f"SELECT {text}"]
+            ).fetchone()[0])
+            self._expressions[text] = tree["statements"][0]["node"]["select_list"][0]
+        return copy.deepcopy(self._expressions[text])
+
+    def prune(self, conn, sql: str) -> Optional[str]:
+        """The query with partition filters added, or None if it has no date filter."""
+        if self._date_re is None or not self._date_re.search(sql):
+            return None
+        try:
+            return self._prune(conn, sql)
+        except (duckdb.Error, KeyError, ValueError, TypeError):
+            # Run the query as written rather than fail it here
+            return None
+
+    def _prune(self, conn, sql: str) -> Optional[str]:
+        tables = self.partitioned(conn)
+        if not tables:
+            return None
+        tree = json.loads(
+            conn.execute("SELECT json_serialize_sql(?)", [sql]).fetchone()[0]
+        )
+        if tree.get("error") or len(tree.get("statements", [])) != 1:
+            return None
+        added: List[str] = []
+        node = self._prune_node(
+            conn, tree["statements"][0]["node"], tables, set(), added
+        )
+        if not added:
+            return None
+        return conn.execute(
+            "SELECT json_deserialize_sql(?)", [_statement(node)]
+        ).fetchone()[0]
+
+    def _prune_node(self, conn, node, tables: Dict[str, PartitionedTable], cte_names,
+                    added: List[str]):
+        """Add partition filters to every SELECT of a tree filtering a view by date."""
+        if isinstance(node, list):
+            return [
+                self._prune_node(conn, item, tables, cte_names, added) for item in node
+            ]
+        if not isinstance(node, dict):
+            return node
+        if node.get("type") == "SELECT_NODE":
+            # A CTE of the same name hides the view
+            cte_map = node.get("cte_map", {}).get("map", [])
+            cte_names = cte_names | {entry["key"].lower() for entry in cte_map}
+        node = {
+            key: self._prune_node(conn, value, tables, cte_names, added)
+            for key, value in node.items()
+        }
+        if node.get("type") == "SELECT_NODE" and node.get("where_clause"):
+            refs: Dict[str, PartitionedTable] = {}
+            self._partitioned_refs(
+                node.get("from_table") or {}, tables, cte_names, refs
+            )
+            filters = (
+                self._partition_filters(conn, node["where_clause"], refs)
+                if refs else []
+            )
+            if filters:
+                where = self.parse_expression(conn, " AND ".join(["NULL"] + filters))
+                where["children"][0] = node["where_clause"]
+                node["where_clause"] = where
+                added.extend(filters)
+        return node
+
+    def _partitioned_refs(self, from_table: dict, tables: Dict[str, PartitionedTable],
+                          cte_names, refs: Dict[str, PartitionedTable]):
+        """Collect the views a FROM clause reads directly, by the name used for them."""
+        if from_table.get("type") == "BASE_TABLE":
+            table_name = from_table["table_name"].lower()
+            if (from_table.get("schema_name", "").lower() in MAIN_SCHEMAS
+                    and not from_table.get("catalog_name")
+                    and not from_table.get("column_name_alias")
+                    and table_name in tables and table_name not in cte_names):
+                name = (from_table.get("alias") or table_name).lower()
+                refs[name] = tables[table_name]
+        elif from_table.get("type") == "JOIN":
+            self._partitioned_refs(from_table["left"], tables, cte_names, refs)
+            self._partitioned_refs(from_table["right"], tables, cte_names, refs)
+
+    def _target(self, node: dict, refs: Dict[str, PartitionedTable]
+                ) -> Optional[Tuple[str, PartitionedTable, str]]:
+        """(name used, view, "date" or "year") for a view's date column or its year."""
+        if node.get("class") == "FUNCTION" and not node.get("filter"):
+            function_name = node.get("function_name", "").lower()
+            children = node.get("children", [])
+            if function_name == "year" and len(children) == 1:
+                column = children[0]
+            elif (function_name in ("date_part", "datepart") and len(children) == 2
+                  and children[0].get("class") == "CONSTANT"
+                  and str(children[0]["value"].get("value", "")).lower()
+                  in ("year", "years", "y", "yr", "yrs")):
+                column = children[1]
+            else:
+                return None
+            target = self._target(column, refs)
+            if target is None or target[2] != "date":
+                return None
+            return (target[0], target[1], "year")
+        if node.get("class") != "COLUMN_REF":
+            return None
+        names = [name.lower() for name in node.get("column_names", [])]
+        if len(names) == 1 and len(refs) == 1:
+            ref_name, table = next(iter(refs.items()))
+        elif len(names) == 2 and names[0] in refs:
+            ref_name, table = names[0], refs[names[0]]
+        else:
+            return None
+        return (ref_name, table, "date") if names[-1] == table.date_column else None
+
+    def _bounds(self, conjunct: dict, refs: Dict[str, PartitionedTable]
+                ) -> List[Tuple[Tuple, str, dict]]:
+        """(target, comparison type, constant) of each bound on a date or its year."""
+        if conjunct.get("class") == "BETWEEN":
+            target = self._target(conjunct["input"], refs)
+            constant = (_is_constant(conjunct["lower"])
+                        and _is_constant(conjunct["upper"]))
+            if target is None or not constant:
+                return []
+            return [(target, "COMPARE_GREATERTHANOREQUALTO", conjunct["lower"]),
+                    (target, "COMPARE_LESSTHANOREQUALTO", conjunct["upper"])]
+        if (conjunct.get("class") != "COMPARISON"
+                or conjunct.get("type") not in MIRRORED):
+            return []
+        left, right, compare = conjunct["left"], conjunct["right"], conjunct["type"]
+        for column, constant, comparison in ((left, right, compare),
+                                             (right, left, MIRRORED[compare])):
+            target = self._target(column, refs)
+            if target is not None and _is_constant(constant):
+                return [(target, comparison, constant)]
+        return []
+
+    def _partition_filters(self, conn, where: dict,
+                           refs: Dict[str, PartitionedTable]) -> List[str]:
+        """Partition filters implied by the top-level conjuncts of a WHERE clause."""
+        bounds = [
+            bound for conjunct in _conjuncts(where)
+            for bound in self._bounds(conjunct, refs)
+        ]
+        if not bounds:
+            return []
+        # Evaluate the constants in one query, as dates or years
+        values = []
+        for (_, _, kind), _, constant in bounds:
+            cast = self.parse_expression(
+                conn, f"TRY_CAST(NULL AS {'DATE' if kind == 'date' else 'INTEGER'})"
+            )
+            cast["child"] = constant
+            values.append(cast)
+        query = json.loads(
+            conn.execute("SELECT json_serialize_sql('SELECT 1')").fetchone()[0]
+        )["statements"][0]["node"]
+        query["select_list"] = values
+        sql = conn.execute(
+            "SELECT json_deserialize_sql(?)", [_statement(query)]
+        ).fetchone()[0]
+        row = conn.execute(sql).fetchone()
+
+        filters = []
+        for ((ref_name, table, kind), comparison, _), value in zip(bounds, row):
+            if value is None:
+                continue
+            ref = quote_identifier(ref_name)
+            year = f"{ref}.{quote_identifier(table.year_column)}"
+            if kind == "year":
+                filters.append(f"{year} {OPERATORS[comparison]} {int(value)}")
+                continue
+            # Every order_date of a month is on or after its first day, so only the
+            # month of the bound counts
+            operator = {"COMPARE_GREATERTHAN": ">=", "COMPARE_LESSTHAN": "<="}.get(
+                comparison, OPERATORS[comparison]
+            )
+            month = f"{ref}.{quote_identifier(table.month_column)}"
+            filters.append(
+                f"({year}, {month}) {operator} ({value.year}, {value.month})"
+            )
+        return filters
@@ -0,0 +1,218 @@
+"""
+Incremental column profiling stored next to schema_metadata.
+
+Per-column statistics (min/max, null fraction, approximate distinct count and
+top values for low-cardinality columns) are computed with DuckDB's SUMMARIZE
+and approx_top_k aggregates and stored in schema_profile. A table is only
+re-profiled when its data version (see struct_llm.database.bump_table_versions)
+differs from the one recorded in schema_profile_state at its last profiling
+run, so finding the changed tables doesn't read their data. Tables whose
+versions aren't tracked are profiled once; pass force=True to refresh them.
+"""
+
+from typing import Dict, List, Optional
+
+import duckdb
+
+# Top values are collected for columns with at most this many distinct values
+TOP_K_MAX_DISTINCT = 25
+TOP_K = 5
+
+def quote_identifier(name: str) -> str:
+    """Quote a table or column name for use in SQL."""
+    return '"' + name.replace('"', '""') + '"'
+
+def ensure_profile_tables(conn):
+    """Create the profile tables if they don't exist."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_profile (
+        table_name VARCHAR NOT NULL,
+        column_name VARCHAR NOT NULL,
+        column_type VARCHAR,
+        min_value VARCHAR,
+        max_value VARCHAR,
+        null_fraction DOUBLE,
+        approx_distinct BIGINT,
+        -- Most frequent values, only for low-cardinality columns
+        top_values VARCHAR[],
+        PRIMARY KEY (table_name, column_name)
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_profile_state (
+        table_name VARCHAR PRIMARY KEY,
+        -- NULL for a table whose data version isn't tracked
+        data_version BIGINT,
+        profiled_at TIMESTAMP NOT NULL
+    )
+    """)
+
+def table_exists(conn, table_name: str) -> bool:
+    """True if a table or view with the given name exists in the main schema."""
+    return conn.execute(
+        "SELECT count(*) FROM information_schema.tables "
+        "WHERE table_schema = 'main' AND table_name = ?",
+        [table_name],
+    ).fetchone()[0] > 0
+
+def profile_table(conn, table_name: str) -> List[tuple]:
+    """Compute the profile rows of a table."""
+    table = quote_identifier(table_name)
+    summary = conn.execute(f"SUMMARIZE SELECT * FROM {table}").fetchall()
+
+    # Top values for all low-cardinality columns in one scan
+    categorical = [
+        row[0] for row in summary
+        if row[4] is not None and row[4] <= TOP_K_MAX_DISTINCT
+    ]
+    top_values = {}
+    if categorical:
+        aggregates = ", ".join(
+            f"approx_top_k({quote_identifier(name)}, {TOP_K})::VARCHAR[]"
+            for name in categorical
+        )
+        row = conn.execute(f"SELECT {aggregates} FROM {table}").fetchone()
+        top_values = dict(zip(categorical, row))
+
+    rows = []
+    for column in summary:
+        column_name, column_type, min_value, max_value, approx_unique = column[:5]
+        null_percentage = column[-1]
+        rows.append((
+            table_name,
+            column_name,
+            column_type,
+            None if min_value is None else str(min_value),
+            None if max_value is None else str(max_value),
+            float(null_percentage or 0) / 100,
+            approx_unique,
+            top_values.get(column_name),
+        ))
+    return rows
+
+def profile_database(conn, tables: Optional[List[str]] = None,
+                     force: bool = False) -> List[str]:
+    """Profile the tables of schema_metadata that changed since their last profile.
+
+    Needs a writable connection. Returns the names of the tables that were
+    (re-)profiled; pass force=True to profile every table regardless.
+    """
+    # Imported here: struct_llm.database imports this module
+    from struct_llm.database import load_table_versions
+
+    ensure_profile_tables(conn)
+    if tables is None:
+        tables = [row[0] for row in conn.execute(
+            "SELECT DISTINCT table_name FROM schema_metadata ORDER BY table_name"
+        ).fetchall()]
+    previous = dict(conn.execute(
+        "SELECT table_name, data_version FROM schema_profile_state"
+    ).fetchall())
+    versions = load_table_versions(conn)
+
+    profiled = []
+    for table_name in tables:
+        if not table_exists(conn, table_name):
+            continue
+        version = versions.get(table_name)
+        unchanged = table_name in previous and (
+            version is None or previous[table_name] == version
+        )
+        if not force and unchanged:
+            continue
+
+        rows = profile_table(conn, table_name)
+        conn.execute("BEGIN TRANSACTION")
+        try:
+            conn.execute(
+                "DELETE FROM schema_profile WHERE table_name = ?", [table_name]
+            )
+            conn.executemany(
+                "INSERT INTO schema_profile VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO schema_profile_state "
+                "VALUES (?, ?, current_timestamp)",
+                [table_name, version],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        profiled.append(table_name)
+
+    # Forget tables that no longer exist
+    conn.execute("""
+    DELETE FROM schema_profile
+    WHERE table_name NOT IN (
+        SELECT table_name FROM information_schema.tables WHERE table_schema = 'main'
+    )
+    """)
+    conn.execute("""
+    DELETE FROM schema_profile_state
+    WHERE table_name NOT IN (
+        SELECT table_name FROM information_schema.tables WHERE table_schema = 'main'
+    )
+    """)
+    return profiled
+
+def profile_version(conn) -> Optional[str]:
+    """A token that changes whenever a table is re-profiled; None before any profile."""
+    # Called on every catalog refresh: querying the table directly is several
+    # times cheaper than checking information_schema for it first
+    try:
+        count, latest = conn.execute(
+            "SELECT count(*), max(profiled_at) FROM schema_profile_state"
+        ).fetchone()
+    except duckdb.CatalogException:
+        return None
+    return f"{count}:{latest}"
+
+def format_column_profile(column_type: str, min_value: Optional[str],
+                          max_value: Optional[str], null_fraction: float,
+                          approx_distinct: Optional[int],
+                          top_values: Optional[List[str]]) -> str:
+    """Render a column profile compactly, e.g. 'values: Paid, Pending, Failed'."""
+    parts = []
+    if top_values:
+        parts.append("values: " + ", ".join(top_values))
+    elif min_value is not None and column_type != 'VARCHAR':
+        parts.append(f"range: {min_value} to {max_value}")
+    elif approx_distinct is not None:
+        parts.append(f"~{approx_distinct} distinct")
+    if null_fraction:
+        parts.append(f"{null_fraction:.0%} null")
+    return "; ".join(parts)
+
+def load_profiles(conn) -> Dict[str, Dict[str, str]]:
+    """Load compact column profiles as table name -> column name -> summary."""
+    try:
+        rows = conn.execute("""
+        SELECT table_name, column_name, column_type, min_value, max_value,
+               null_fraction, approx_distinct, top_values
+        FROM schema_profile
+        """).fetchall()
+    except duckdb.CatalogException:
+        return {}
+    profiles: Dict[str, Dict[str, str]] = {}
+    for table_name, column_name, *stats in rows:
+        summary = format_column_profile(*stats)
+        if summary:
+            profiles.setdefault(table_name, {})[column_name] = summary
+    return profiles
+
+if __name__ == "__main__":
+    import argparse
+
+    from struct_llm.database import DB_PATH
+
+    parser = argparse.ArgumentParser(
+        description="Profile tables whose data changed since the last run."
+    )
+    parser.add_argument("--force", action="store_true", help="Re-profile every table")
+    args = parser.parse_args()
+
+    conn = duckdb.connect(str(DB_PATH))
+    profiled = profile_database(conn, force=args.force)
+    conn.close()
+    print(f"Profiled {len(profiled)} table(s): {', '.join(profiled) or 'none changed'}")
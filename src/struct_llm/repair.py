@@ -0,0 +1,291 @@
+"""
+Deterministic local repair of generated SQL.
+
+clean_sql() tidies every LLM response before it runs: it strips markdown
+code fences and rewrites common dialect slips (SQL Server TOP, MySQL
+backticks and LIMIT offset, count, GETDATE() and NVL()) outside of string
+literals. When DuckDB still rejects a query, repair_sql() tries to fix it
+from the binder error and the known schema:
+
+- ambiguous column references are qualified with a table that has the
+  column if every such table is equated on it in the ON conditions of inner
+  joins, where all of them hold the same value,
+- columns qualified with the wrong alias are moved to the one table alias
+  that has the column,
+- double-quoted strings DuckDB took for column names become string literals.
+
+Column references are located in the syntax tree from json_serialize_sql,
+so edits are exact and scoped to the SELECT they appear in. Only if no local
+fix applies is the error sent back to the LLM (see nl_to_sql.run_with_repair).
+"""
+
+import json
+import re
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Local fixes tried for one query before falling back to the LLM
+MAX_LOCAL_REPAIRS = 3
+
+FENCE_RE = re.compile(
+    r"```[ \t]*(?:sql|duckdb|postgresql|postgres)?[ \t]*\n?(.*?)```",
+    re.DOTALL | re.IGNORECASE,
+)
+
+# A response wrapped in inline code, e.g. `SELECT 1`; backticks inside are
+# MySQL identifiers
+INLINE_CODE_RE = re.compile(r"`+([^`]*)`+")
+
+# String literals, quoted identifiers and comments, which dialect fixes must not touch
+PROTECTED_RE = re.compile(
+    r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/)", re.DOTALL
+)
+
+# Rewrites applied to the SQL outside string literals and comments
+DIALECT_FIXES = [
+    # MySQL `identifier`
+    (re.compile(r"`([^`]*)`"), r'"\1"'),
+    # MySQL LIMIT offset, count
+    (re.compile(r"\bLIMIT\s+(\d+)\s*,\s*(\d+)", re.IGNORECASE), r"LIMIT \2 OFFSET \1"),
+    # SQL Server / Oracle functions
+    (re.compile(r"\bGETDATE\s*\(\s*\)", re.IGNORECASE), "current_timestamp"),
+    (re.compile(r"\bSYSDATE\b", re.IGNORECASE), "current_timestamp"),
+    (re.compile(r"\bNVL\s*\(", re.IGNORECASE), "coalesce("),
+]
+
+# SQL Server SELECT TOP n at the start of the statement
+TOP_RE = re.compile(
+    r"^(\s*SELECT\s+(?:DISTINCT\s+)?)TOP\s+\(?(\d+)\)?\s+", re.IGNORECASE
+)
+
+AMBIGUOUS_RE = re.compile(r'Ambiguous reference to column name "([^"]+)"')
+WRONG_TABLE_RE = re.compile(r'Table "([^"]+)" does not have a column named "([^"]+)"')
+NOT_FOUND_RE = re.compile(r'Referenced column "([^"]+)" not found')
+
+def strip_fences(text: str) -> str:
+    """Extract the SQL from a response wrapped in a markdown code block."""
+    match = FENCE_RE.search(text)
+    if match:
+        text = match.group(1)
+    text = text.strip()
+    match = INLINE_CODE_RE.fullmatch(text)
+    return (match.group(1) if match else text).strip()
+
+def _map_code(sql: str, fix) -> str:
+    """Apply fix to sql outside string literals, quoted identifiers and comments."""
+    parts = PROTECTED_RE.split(sql)
+    # split() with one capture group alternates code and protected parts
+    return "".join(fix(part) if i % 2 == 0 else part for i, part in enumerate(parts))
+
+def fix_dialect(sql: str) -> str:
+    """Rewrite common non-DuckDB syntax in a query."""
+    def fix(code: str) -> str:
+        for pattern, replacement in DIALECT_FIXES:
+            code = pattern.sub(replacement, code)
+        return code
+    sql = _map_code(sql, fix)
+
+    match = TOP_RE.match(sql)
+    if match and not re.search(r"\bLIMIT\b", PROTECTED_RE.sub(" ", sql), re.IGNORECASE):
+        body = sql[match.end():].rstrip().rstrip(";").rstrip()
+        sql = f"{match.group(1)}{body} LIMIT {match.group(2)}"
+    return sql
+
+def clean_sql(text: str) -> str:
+    """Turn an LLM response into runnable DuckDB SQL, as far as possible unparsed."""
+    return fix_dialect(strip_fences(text))
+
+class _Scope:
+    """The tables and column references of one SELECT."""
+
+    def __init__(self):
+        self.tables: List[Tuple[str, str]] = []  # (name used in the query, table name)
+        self.columns: List[dict] = []  # COLUMN_REF nodes
+        # (name, name, column) of the inner join conditions a.column = b.column
+        self.equated: List[Tuple[str, str, str]] = []
+
+def _collect_equalities(condition, scope: _Scope):
+    """Record the a.column = b.column terms of the AND-ed condition of an inner join."""
+    if not isinstance(condition, dict):
+        return
+    if condition.get("type") == "CONJUNCTION_AND":
+        for child in condition.get("children", []):
+            _collect_equalities(child, scope)
+    elif condition.get("type") == "COMPARE_EQUAL":
+        left, right = condition.get("left") or {}, condition.get("right") or {}
+        if left.get("class") == "COLUMN_REF" and right.get("class") == "COLUMN_REF":
+            left_names = left.get("column_names", [])
+            right_names = right.get("column_names", [])
+            if (len(left_names) == 2 and len(right_names) == 2
+                    and left_names[1].lower() == right_names[1].lower()):
+                scope.equated.append((
+                    left_names[0].lower(), right_names[0].lower(),
+                    left_names[1].lower(),
+                ))
+
+def _collect_tables(node, scope: _Scope):
+    if isinstance(node, dict):
+        if node.get("type") == "BASE_TABLE":
+            table = node["table_name"]
+            scope.tables.append((node.get("alias") or table, table))
+            return
+        if node.get("type") == "JOIN" and node.get("join_type") == "INNER":
+            # An outer join keeps rows whose join column is NULL on one side
+            _collect_equalities(node.get("condition"), scope)
+        for key, value in node.items():
+            # Subqueries in FROM are scopes of their own
+            if key != "subquery":
+                _collect_tables(value, scope)
+    elif isinstance(node, list):
+        for item in node:
+            _collect_tables(item, scope)
+
+def _collect_scopes(node, scope: Optional[_Scope], scopes: List[_Scope]):
+    if isinstance(node, dict):
+        if node.get("type") == "SELECT_NODE":
+            scope = _Scope()
+            scopes.append(scope)
+            _collect_tables(node.get("from_table"), scope)
+        elif node.get("class") == "COLUMN_REF" and scope is not None:
+            scope.columns.append(node)
+        for value in node.values():
+            _collect_scopes(value, scope, scopes)
+    elif isinstance(node, list):
+        for item in node:
+            _collect_scopes(item, scope, scopes)
+
+def parse_scopes(conn, sql: str) -> Optional[List[_Scope]]:
+    """The SELECT scopes of a query, or None if it can't be parsed."""
+    tree = json.loads(conn.execute("SELECT json_serialize_sql(?)", [sql]).fetchone()[0])
+    if tree.get("error"):
+        return None
+    scopes: List[_Scope] = []
+    _collect_scopes(tree.get("statements", []), None, scopes)
+    return scopes
+
+def _tables_with_column(scope: _Scope, column: str,
+                        schema: Dict[str, Set[str]]) -> List[str]:
+    """Names used in the scope for the tables that have the column, in FROM order."""
+    return [
+        name for name, table in scope.tables
+        if column.lower() in schema.get(table.lower(), set())
+    ]
+
+def _apply_edits(sql: str, edits: Iterable[Tuple[int, int, str]]) -> str:
+    """Replace (start, end, text) byte ranges of sql, as query_location counts bytes."""
+    data = sql.encode()
+    for start, end, text in sorted(edits, reverse=True):
+        data = data[:start] + text.encode() + data[end:]
+    return data.decode()
+
+def _quote(name: str) -> str:
+    if re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name):
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+def _qualifier_span(sql_bytes: bytes, location: int) -> Optional[int]:
+    """End offset of the `qualifier.` at location, or None."""
+    pattern = re.compile(rb'\s*("(?:[^"]|"")*"|[^\s."]+)\s*\.\s*')
+    match = pattern.match(sql_bytes, location)
+    return match.end() if match else None
+
+def _all_equated(scope: _Scope, column: str, names: List[str]) -> bool:
+    """True if the joins of the scope equate the column of all the named tables."""
+    reached = {names[0].lower()}
+    grew = True
+    while grew:
+        grew = False
+        for left, right, equated_column in scope.equated:
+            if (equated_column == column.lower()
+                    and (left in reached) != (right in reached)):
+                reached.update((left, right))
+                grew = True
+    return all(name.lower() in reached for name in names)
+
+def qualify_ambiguous(scopes: List[_Scope], column: str,
+                      schema: Dict[str, Set[str]]) -> List[Tuple[int, int, str]]:
+    """Edits qualifying unqualified references to a column of several tables.
+
+    Only done where the tables are joined on the column, so any of them gives
+    the same values; otherwise which one was meant is left to the LLM.
+    """
+    edits = []
+    for scope in scopes:
+        candidates = _tables_with_column(scope, column, schema)
+        if len(candidates) < 2 or not _all_equated(scope, column, candidates):
+            continue
+        for ref in scope.columns:
+            names = ref.get("column_names", [])
+            if (len(names) == 1 and names[0].lower() == column.lower()
+                    and ref.get("query_location") is not None):
+                location = ref["query_location"]
+                edits.append((location, location, f"{_quote(candidates[0])}."))
+    return edits
+
+def requalify(scopes: List[_Scope], sql: str, table: str, column: str,
+              schema: Dict[str, Set[str]]) -> List[Tuple[int, int, str]]:
+    """Edits moving table.column references to the only table that has the column."""
+    edits = []
+    sql_bytes = sql.encode()
+    for scope in scopes:
+        candidates = _tables_with_column(scope, column, schema)
+        if len(candidates) != 1:
+            continue
+        for ref in scope.columns:
+            names = ref.get("column_names", [])
+            if (len(names) == 2 and names[0].lower() == table.lower()
+                    and names[1].lower() == column.lower()
+                    and ref.get("query_location") is not None):
+                location = ref["query_location"]
+                end = _qualifier_span(sql_bytes, location)
+                if end is not None:
+                    edits.append((location, end, f"{_quote(candidates[0])}."))
+    return edits
+
+def unquote_literal(scopes: List[_Scope], sql: str, name: str,
+                    schema: Dict[str, Set[str]]) -> List[Tuple[int, int, str]]:
+    """Edits turning "name" into 'name' where it is not a column of any table."""
+    if any(name.lower() in columns for columns in schema.values()):
+        return []
+    edits = []
+    sql_bytes = sql.encode()
+    quoted = ('"' + name.replace('"', '""') + '"').encode()
+    for scope in scopes:
+        for ref in scope.columns:
+            location = ref.get("query_location")
+            if (ref.get("column_names") == [name] and location is not None
+                    and sql_bytes.startswith(quoted, location)):
+                literal = "'" + name.replace("'", "''") + "'"
+                edits.append((location, location + len(quoted), literal))
+    return edits
+
+def repair_sql(conn, sql: str, error: str,
+               schema: Dict[str, Set[str]]) -> Optional[str]:
+    """Fix the query DuckDB rejected with the error, or None if no local fix applies.
+
+    schema maps lowercase table names to their lowercase column names.
+    """
+    scopes = parse_scopes(conn, sql)
+    if not scopes:
+        return None
+
+    edits = []
+    match = AMBIGUOUS_RE.search(error)
+    if match:
+        edits = qualify_ambiguous(scopes, match.group(1), schema)
+    match = WRONG_TABLE_RE.search(error)
+    if match:
+        edits = requalify(scopes, sql, match.group(1), match.group(2), schema)
+    match = NOT_FOUND_RE.search(error)
+    if match:
+        edits = unquote_literal(scopes, sql, match.group(1), schema)
+
+    if not edits:
+        return None
+    return _apply_edits(sql, edits)
+
+def schema_columns(tables: Dict) -> Dict[str, Set[str]]:
+    """Lowercase table name -> lowercase column names, from catalog metadata."""
+    return {
+        table_name.lower(): {column_name.lower() for column_name, _ in info['columns']}
+        for table_name, info in tables.items()
+    }
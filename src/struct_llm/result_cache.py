@@ -0,0 +1,245 @@
+"""
+Cache of query results keyed on the SQL and the data versions of its tables.
+
+A result is cached under the normalized SQL plus the version of every table
+the query reads (see struct_llm.database.bump_table_versions), so reloading
+any of those tables makes the entry unreachable and it is dropped the next
+time versions are seen to change. Queries over tables whose versions aren't
+tracked, or calling volatile functions such as random() or now(), are never
+cached.
+
+Results are kept as Arrow tables in a memory tier bounded in bytes; entries
+evicted from memory spill to Parquet files in a disk tier with its own byte
+bound. Both tiers evict least recently used entries first.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from struct_llm.database import load_table_versions
+
+RESULT_CACHE_DIR = Path("data/result_cache")
+
+# Parquet schema metadata key holding the table versions an entry was computed from
+VERSIONS_KEY = b"struct_llm.table_versions"
+
+VOLATILE_RE = re.compile(
+    r"\b(random|now|today|current_date|current_time|current_timestamp|get_current_time|"
+    r"gen_random_uuid|uuid|nextval|currval|setseed)\b",
+    re.IGNORECASE,
+)
+
+class CacheKey(NamedTuple):
+    """Key of a cached result: a digest of the SQL and its table versions."""
+    digest: str
+    versions: Dict[str, int]
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace and drop a trailing semicolon; formatting doesn't matter."""
+    return " ".join(sql.split()).rstrip(";").rstrip()
+
+class ResultCache:
+    """Two-tier LRU cache of Arrow query results: memory first, Parquet files second.
+
+    A tier with a budget of 0 bytes is disabled; directory=None disables the disk tier.
+    """
+
+    def __init__(self, memory_bytes: int = 256 << 20, disk_bytes: int = 1 << 30,
+                 directory: Optional[Path] = RESULT_CACHE_DIR):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes if directory is not None else 0
+        self.directory = Path(directory) if directory is not None else None
+        # key -> (table, versions)
+        self._memory: "OrderedDict[str, Tuple[pa.Table, Dict[str, int]]]" = (
+            OrderedDict()
+        )
+        self._memory_used = 0
+        # key -> (file size, versions)
+        self._disk: "OrderedDict[str, Tuple[int, Dict[str, int]]]" = OrderedDict()
+        self._disk_used = 0
+        self._versions: Optional[Dict[str, int]] = None
+        self._lock = threading.Lock()
+        if self.disk_bytes:
+            self._load_disk_index()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.memory_bytes or self.disk_bytes)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.parquet"
+
+    def _load_disk_index(self):
+        """Index the entries spilled by earlier runs, least recently used first."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = sorted(
+            self.directory.glob("*.parquet"), key=lambda path: path.stat().st_mtime
+        )
+        for path in files:
+            try:
+                metadata = pq.read_schema(path).metadata or {}
+                versions = json.loads(metadata[VERSIONS_KEY])
+            except Exception:
+                path.unlink(missing_ok=True)
+                continue
+            size = path.stat().st_size
+            self._disk[path.stem] = (size, versions)
+            self._disk_used += size
+
+    def key(self, conn, sql: str) -> Optional[CacheKey]:
+        """The key of a query against the current data, or None if uncacheable."""
+        if not self.enabled or VOLATILE_RE.search(sql):
+            return None
+        try:
+            tables = conn.get_table_names(sql)
+        except Exception:
+            # Let executing the query report the error
+            return None
+        if not tables:
+            return None
+
+        current = load_table_versions(conn)
+        self._check_versions(current)
+        if not tables <= current.keys():
+            # Reads a view or a table whose changes aren't tracked
+            return None
+        versions = {table: current[table] for table in sorted(tables)}
+
+        payload = json.dumps([normalize_sql(sql), versions])
+        return CacheKey(hashlib.sha256(payload.encode()).hexdigest(), versions)
+
+    def _check_versions(self, current: Dict[str, int]):
+        """Drop every entry computed from an older version of a table."""
+        with self._lock:
+            if current == self._versions:
+                return
+            self._versions = current
+
+            def stale(versions: Dict[str, int]) -> bool:
+                return any(
+                    current.get(table) != version for table, version in versions.items()
+                )
+
+            for key in [key for key, entry in self._memory.items() if stale(entry[1])]:
+                self._memory_used -= self._memory.pop(key)[0].nbytes
+            for key in [key for key, entry in self._disk.items() if stale(entry[1])]:
+                self._disk_used -= self._disk.pop(key)[0]
+                self._path(key).unlink(missing_ok=True)
+
+    def get(self, cache_key: CacheKey) -> Optional[pa.Table]:
+        """The cached result for a key, or None. Disk hits are promoted to memory."""
+        key = cache_key.digest
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry[0]
+            if key not in self._disk:
+                return None
+            versions = self._disk[key][1]
+        try:
+            table = pq.read_table(self._path(key))
+        except (OSError, pa.ArrowException):
+            with self._lock:
+                if key in self._disk:
+                    self._disk_used -= self._disk.pop(key)[0]
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+                os.utime(self._path(key))
+            if table.nbytes <= self.memory_bytes:
+                self._put_memory(key, table, versions)
+        return table
+
+    def put(self, cache_key: CacheKey, table: pa.Table):
+        """Cache a result. Results larger than both tier budgets are not cached."""
+        key, versions = cache_key
+        with self._lock:
+            if table.nbytes <= self.memory_bytes:
+                self._put_memory(key, table, versions)
+                return
+        # Too large for memory: straight to disk
+        self._spill(key, table, versions)
+
+    def _put_memory(self, key: str, table: pa.Table, versions: Dict[str, int]):
+        """Add to the memory tier, spilling the least recently used entries to disk.
+
+        Needs the lock.
+        """
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= previous[0].nbytes
+        self._memory[key] = (table, versions)
+        self._memory_used += table.nbytes
+        evicted = []
+        while self._memory_used > self.memory_bytes and self._memory:
+            old_key, (old_table, old_versions) = self._memory.popitem(last=False)
+            self._memory_used -= old_table.nbytes
+            if old_key not in self._disk:
+                evicted.append((old_key, old_table, old_versions))
+        for old_key, old_table, old_versions in evicted:
+            self._spill(old_key, old_table, old_versions, locked=True)
+
+    def _spill(self, key: str, table: pa.Table, versions: Dict[str, int],
+               locked: bool = False):
+        """Write an entry to the disk tier, evicting the least recently used files."""
+        if not self.disk_bytes:
+            return
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        metadata = dict(table.schema.metadata or {})
+        # Only the versions of the entry's own tables matter for invalidation
+        metadata[VERSIONS_KEY] = json.dumps(versions).encode()
+        pq.write_table(
+            table.replace_schema_metadata(metadata), tmp_path, compression="zstd"
+        )
+        size = tmp_path.stat().st_size
+        if size > self.disk_bytes:
+            tmp_path.unlink(missing_ok=True)
+            return
+        os.replace(tmp_path, path)
+
+        if not locked:
+            self._lock.acquire()
+        try:
+            previous = self._disk.pop(key, None)
+            if previous is not None:
+                self._disk_used -= previous[0]
+            self._disk[key] = (size, versions)
+            self._disk_used += size
+            while self._disk_used > self.disk_bytes and self._disk:
+                old_key, (old_size, _) = self._disk.popitem(last=False)
+                self._disk_used -= old_size
+                self._path(old_key).unlink(missing_ok=True)
+        finally:
+            if not locked:
+                self._lock.release()
+
+    def clear(self):
+        """Drop every entry from both tiers."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+            for key in self._disk:
+                self._path(key).unlink(missing_ok=True)
+            self._disk.clear()
+            self._disk_used = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_used,
+            }
@@ -0,0 +1,175 @@
+"""
+Offline schema retrieval: pick the tables relevant to a question before building
+the prompt.
+"""
+
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Set, Tuple
+
+STOPWORDS = {
+    'a', 'all', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'by', 'can', 'do',
+    'does', 'each', 'for', 'from', 'get', 'give', 'has', 'have', 'how', 'i', 'in',
+    'is', 'it', 'list', 'many', 'me', 'much', 'of', 'on', 'or', 'per', 'show', 'tell',
+    'that', 'the', 'their', 'there', 'these', 'this', 'to', 'was', 'we', 'were',
+    'what', 'when', 'where', 'which', 'who', 'with',
+}
+
+# Field weights: names are a stronger signal than free-text descriptions
+TABLE_NAME_WEIGHT = 3
+COLUMN_NAME_WEIGHT = 2
+DESCRIPTION_WEIGHT = 1
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase terms, dropping stopwords and plural 's' endings."""
+    terms = []
+    for term in re.findall(r"[a-z0-9]+", (text or "").lower()):
+        if term in STOPWORDS:
+            continue
+        if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+            term = term[:-1]
+        terms.append(term)
+    return terms
+
+def count_tokens(text: str) -> int:
+    """Approximate the number of LLM tokens in text.
+
+    Uses the ~4 characters per token rule on each word and counts punctuation
+    separately, which tracks the OpenAI tokenizers closely enough to compare
+    prompt sizes without needing a tokenizer download.
+    """
+    return sum(
+        max(1, math.ceil(len(piece) / 4))
+        for piece in re.findall(r"\w+|[^\w\s]", text)
+    )
+
+def find_relations(tables: Dict, conn=None) -> Set[Tuple[str, str]]:
+    """Find pairs of related tables.
+
+    Declared foreign keys are read from DuckDB when a connection is given. Tables
+    loaded from CSV have no constraints, so tables sharing an '*_id' column are
+    also treated as related.
+    """
+    relations = set()
+    if conn is not None:
+        for table_name, referenced_table in conn.execute("""
+        SELECT table_name, referenced_table
+        FROM duckdb_constraints()
+        WHERE constraint_type = 'FOREIGN KEY'
+        """).fetchall():
+            if table_name in tables and referenced_table in tables:
+                relations.add(tuple(sorted((table_name, referenced_table))))
+
+    tables_by_column: Dict[str, List[str]] = {}
+    for table_name, info in tables.items():
+        for col_name, _ in info['columns']:
+            if col_name.endswith("_id"):
+                tables_by_column.setdefault(col_name, []).append(table_name)
+    for table_names in tables_by_column.values():
+        for i, left in enumerate(table_names):
+            for right in table_names[i + 1:]:
+                relations.add(tuple(sorted((left, right))))
+    return relations
+
+class SchemaIndex:
+    """BM25 index over table names, column names and their descriptions."""
+
+    def __init__(self, tables: Dict, relations: Iterable[Tuple[str, str]] = (),
+                 k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.table_names = list(tables)
+        self.column_counts = {
+            name: len(info['columns']) for name, info in tables.items()
+        }
+        self.neighbours: Dict[str, Set[str]] = {
+            name: set() for name in self.table_names
+        }
+        for left, right in relations:
+            self.neighbours[left].add(right)
+            self.neighbours[right].add(left)
+
+        self.term_freqs: List[Counter] = []
+        for table_name, info in tables.items():
+            terms = Counter()
+            for term in tokenize(table_name.replace("_", " ")):
+                terms[term] += TABLE_NAME_WEIGHT
+            for term in tokenize(info['description']):
+                terms[term] += DESCRIPTION_WEIGHT
+            for col_name, col_desc in info['columns']:
+                for term in tokenize(col_name.replace("_", " ")):
+                    terms[term] += COLUMN_NAME_WEIGHT
+                for term in tokenize(col_desc):
+                    terms[term] += DESCRIPTION_WEIGHT
+            self.term_freqs.append(terms)
+
+        self.doc_lengths = [sum(terms.values()) for terms in self.term_freqs]
+        self.avg_length = (
+            sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0.0
+        )
+        doc_freqs = Counter()
+        for terms in self.term_freqs:
+            doc_freqs.update(terms.keys())
+        n_docs = len(self.term_freqs)
+        self.idf = {
+            term: math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for term, df in doc_freqs.items()
+        }
+
+    def scores(self, question: str) -> Dict[str, float]:
+        """BM25 score of every table for the question."""
+        query_terms = set(tokenize(question))
+        scores = {}
+        documents = zip(self.table_names, self.term_freqs, self.doc_lengths)
+        for table_name, terms, length in documents:
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self.avg_length)
+            for term in query_terms:
+                tf = terms.get(term)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores[table_name] = score
+        return scores
+
+    def select(self, question: str, top_k: int = 8,
+               max_neighbours: int = 4) -> List[str]:
+        """The top_k tables for the question and up to max_neighbours related ones.
+
+        Neighbours are added so that the join partners of the matched tables are
+        available to the LLM. If the schema is no larger than top_k, every table
+        is returned; if nothing matches, the top_k tables with the most related
+        tables (then the most columns) are.
+        """
+        if len(self.table_names) <= top_k:
+            return list(self.table_names)
+
+        scores = self.scores(question)
+        ranked = sorted(
+            (name for name in self.table_names if scores[name] > 0),
+            key=lambda name: (-scores[name], name)
+        )
+        if not ranked:
+            # A vague question: the hub tables most questions join through,
+            # not the whole schema
+            ranked = sorted(self.table_names, key=lambda name: (
+                -len(self.neighbours[name]), -self.column_counts[name], name
+            ))
+            return self._in_catalog_order(ranked[:top_k])
+
+        selected = ranked[:top_k]
+        candidates = {
+            neighbour
+            for table_name in selected
+            for neighbour in self.neighbours[table_name]
+            if neighbour not in selected
+        }
+        neighbours = sorted(candidates, key=lambda name: (-scores[name], name))
+        selected.extend(neighbours[:max_neighbours])
+
+        return self._in_catalog_order(selected)
+
+    def _in_catalog_order(self, selected: List[str]) -> List[str]:
+        # Keep the schema in catalog order so prompts stay stable
+        selected_set = set(selected)
+        return [name for name in self.table_names if name in selected_set]
@@ -0,0 +1,757 @@
+"""
+Pre-aggregated rollup tables and the rewrite of queries to use them.
+
+A rollup groups a fact table (joined to its dimension tables through their
+foreign keys) by a set of dimension columns and stores count(*) and the
+sum/min/max/count of its measure columns per group. The default rollup,
+rollup_daily_sales, keeps orders by day, product, coverage type (the product
+category) and payment and policy status: a few thousand rows instead of a
+join over every order.
+
+refresh_rollups() is run by the data load step. A rollup is rebuilt when a
+dimension table or its definition changed; when only the fact table changed,
+just the partitions (days) whose row count or checksum differs from the last
+refresh are recomputed, like the incremental profiling in
+struct_llm.profiling. The versions of the source tables in table_versions are
+recorded with each refresh, and the rollup table's own version is bumped so
+that cached results over it are invalidated.
+
+RollupRewriter rewrites an aggregate query into one over a rollup if the
+rollup is fresh and every column the query groups or filters by is one of its
+dimensions: count(*) becomes sum(order_count), sum(x) sum(x_sum), avg(x)
+sum(x_sum) / sum(x_count) and so on. Subqueries in FROM (such as the
+pagination wrapper) are rewritten the same way. The rewrite is verified by
+binding both queries, and it is only used if the result columns' names and
+types are unchanged.
+"""
+
+import copy
+import hashlib
+import json
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+import duckdb
+
+from struct_llm.database import bump_table_versions, load_table_versions
+from struct_llm.profiling import quote_identifier
+
+# Aggregates a measure can be stored as; avg is answered from sum and count
+MEASURE_AGGREGATES = ("sum", "min", "max", "count")
+
+@dataclass(frozen=True)
+class Rollup:
+    """Definition of a rollup table.
+
+    Dimensions are (rollup column, source table, source column). Joins are
+    the fact table's foreign keys as (column, referenced table, referenced
+    column); every fact row must match exactly one row of each, which the
+    loader enforces and refresh_rollup() verifies. Measures are fact table
+    columns with the aggregates stored for them, as <column>_<aggregate>.
+    The rollup is refreshed partition by partition on the fact table column
+    partition_by, which must be a dimension.
+    """
+    name: str
+    fact_table: str
+    dimensions: Tuple[Tuple[str, str, str], ...]
+    measures: Tuple[Tuple[str, Tuple[str, ...]], ...]
+    partition_by: str
+    joins: Tuple[Tuple[str, str, str], ...] = ()
+
+    @property
+    def source_tables(self) -> List[str]:
+        return [self.fact_table] + [table for _, table, _ in self.joins]
+
+    def dimension_map(self) -> Dict[Tuple[str, str], str]:
+        """(source table, source column) -> rollup column.
+
+        Includes the join keys of the dimension tables.
+        """
+        mapping = {(table, column): name for name, table, column in self.dimensions}
+        for column, table, table_column in self.joins:
+            if (self.fact_table, column) in mapping:
+                mapping[(table, table_column)] = mapping[(self.fact_table, column)]
+        return mapping
+
+    def measure_map(self) -> Dict[str, Tuple[str, ...]]:
+        """Fact column -> the aggregates stored for it."""
+        return dict(self.measures)
+
+    def select_sql(self, where: str = "") -> str:
+        """The query computing the rollup's rows, optionally restricted by a WHERE."""
+        fact = quote_identifier(self.fact_table)
+        columns = [
+            f"{quote_identifier(table)}.{quote_identifier(column)} "
+            f"AS {quote_identifier(name)}"
+            for name, table, column in self.dimensions
+        ]
+        columns.append("count(*) AS order_count")
+        for column, aggregates in self.measures:
+            for aggregate in aggregates:
+                name = quote_identifier(f"{column}_{aggregate}")
+                columns.append(
+                    f"{aggregate}({fact}.{quote_identifier(column)}) AS {name}"
+                )
+        joins = "".join(
+            f"\nJOIN {quote_identifier(table)} ON {fact}.{quote_identifier(column)} = "
+            f"{quote_identifier(table)}.{quote_identifier(table_column)}"
+            for column, table, table_column in self.joins
+        )
+        group_by = ", ".join(str(i + 1) for i in range(len(self.dimensions)))
+        return (
+            f"SELECT {', '.join(columns)}\nFROM {fact}{joins}\n{where}\n"
+            f"GROUP BY {group_by}"
+        )
+
+    @property
+    def definition(self) -> str:
+        """A digest of the rollup query; the rollup is rebuilt when it changes."""
+        return hashlib.md5(self.select_sql().encode()).hexdigest()
+
+DAILY_SALES = Rollup(
+    name="rollup_daily_sales",
+    fact_table="orders",
+    dimensions=(
+        ("order_date", "orders", "order_date"),
+        ("product_id", "orders", "product_id"),
+        ("product_name", "products", "product_name"),
+        ("coverage_type", "products", "coverage_type"),
+        ("payment_status", "orders", "payment_status"),
+        ("policy_status", "orders", "policy_status"),
+    ),
+    measures=(
+        ("premium_amount", MEASURE_AGGREGATES),
+        ("coverage_amount", MEASURE_AGGREGATES),
+        ("order_id", ("count",)),
+        ("customer_id", ("count",)),
+    ),
+    partition_by="order_date",
+    joins=(("product_id", "products", "product_id"),),
+)
+
+ROLLUPS = [DAILY_SALES]
+
+def ensure_rollup_state(conn):
+    """Create the tables recording what each rollup was built from, if missing."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS _rollup_state (
+        rollup_name VARCHAR PRIMARY KEY,
+        definition VARCHAR NOT NULL,
+        -- JSON object of source table -> table_versions version
+        source_versions VARCHAR NOT NULL,
+        refreshed_at TIMESTAMP NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS _rollup_partitions (
+        rollup_name VARCHAR NOT NULL,
+        partition_value VARCHAR,
+        row_count BIGINT NOT NULL,
+        checksum UBIGINT
+    )
+    """)
+
+def load_rollup_state(conn) -> Dict[str, Tuple[str, Dict[str, int]]]:
+    """Rollup name -> (definition digest, source table versions) at its last refresh."""
+    try:
+        rows = conn.execute(
+            "SELECT rollup_name, definition, source_versions FROM _rollup_state"
+        ).fetchall()
+    except duckdb.CatalogException:
+        # Database from before rollups were maintained
+        return {}
+    return {
+        name: (definition, json.loads(versions))
+        for name, definition, versions in rows
+    }
+
+def _missing_columns(conn, rollup: Rollup) -> List[str]:
+    """Source columns of the rollup that don't exist in the database."""
+    needed = {(table, column) for _, table, column in rollup.dimensions}
+    needed |= {(rollup.fact_table, column) for column, _ in rollup.measures}
+    needed |= {(rollup.fact_table, column) for column, _, _ in rollup.joins}
+    needed |= {(table, column) for _, table, column in rollup.joins}
+    existing = set(conn.execute("""
+    SELECT table_name, column_name FROM information_schema.columns
+    WHERE table_schema = 'main'
+    """).fetchall())
+    return sorted(f"{table}.{column}" for table, column in needed - existing)
+
+def _partition_state(conn, rollup: Rollup):
+    """Store the row count and checksum of each fact table partition in a temp table."""
+    fact = quote_identifier(rollup.fact_table)
+    partition = quote_identifier(rollup.partition_by)
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE _rollup_partitions_now AS
+    SELECT CAST(t.{partition} AS VARCHAR) AS partition_value, count(*) AS row_count,
+        bit_xor(hash(t)) AS checksum
+    FROM {fact} t
+    GROUP BY 1
+    """)
+
+def _is_consistent(conn, rollup: Rollup) -> bool:
+    """True if every fact row was counted once, i.e. matched one row of each join."""
+    for _, table, column in rollup.joins:
+        total, distinct = conn.execute(
+            f"SELECT count(*), count(DISTINCT {quote_identifier(column)}) "
+            f"FROM {quote_identifier(table)}"
+        ).fetchone()
+        if total != distinct:
+            return False
+    fact_rows = conn.execute(
+        f"SELECT count(*) FROM {quote_identifier(rollup.fact_table)}"
+    ).fetchone()[0]
+    rollup_rows = conn.execute(
+        f"SELECT coalesce(sum(order_count), 0) FROM {quote_identifier(rollup.name)}"
+    ).fetchone()[0]
+    return fact_rows == rollup_rows
+
+def refresh_rollup(conn, rollup: Rollup, force: bool = False) -> Optional[str]:
+    """Bring a rollup up to date with its source tables. Needs a writable connection.
+
+    Returns what was done ("rebuilt", "refreshed N partition(s)", "dropped")
+    or None if the rollup was already up to date.
+    """
+    ensure_rollup_state(conn)
+    table = quote_identifier(rollup.name)
+    missing = _missing_columns(conn, rollup)
+    if missing:
+        # The loaded schema doesn't have the rollup's columns
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute(
+            "DELETE FROM _rollup_state WHERE rollup_name = ?", [rollup.name]
+        )
+        conn.execute(
+            "DELETE FROM _rollup_partitions WHERE rollup_name = ?", [rollup.name]
+        )
+        return "dropped"
+
+    versions = load_table_versions(conn)
+    source_versions = {
+        table_name: versions.get(table_name) for table_name in rollup.source_tables
+    }
+    previous = load_rollup_state(conn).get(rollup.name)
+    dimension_tables_changed = previous is None or any(
+        previous[1].get(table_name) != version
+        for table_name, version in source_versions.items()
+        if table_name != rollup.fact_table
+    )
+    rebuild = force or dimension_tables_changed or previous[0] != rollup.definition
+    fact_version = source_versions[rollup.fact_table]
+    if not rebuild and previous[1].get(rollup.fact_table) == fact_version:
+        return None
+
+    _partition_state(conn, rollup)
+    partition = quote_identifier(rollup.partition_by)
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        if rebuild:
+            conn.execute(f"CREATE OR REPLACE TABLE {table} AS {rollup.select_sql()}")
+            changed = conn.execute(
+                "SELECT count(*) FROM _rollup_partitions_now"
+            ).fetchone()[0]
+        else:
+            conn.execute("""
+            CREATE OR REPLACE TEMP TABLE _rollup_changed AS
+            SELECT coalesce(n.partition_value, p.partition_value) AS partition_value
+            FROM _rollup_partitions_now n
+            FULL OUTER JOIN (SELECT * FROM _rollup_partitions WHERE rollup_name = ?) p
+                ON n.partition_value IS NOT DISTINCT FROM p.partition_value
+            WHERE n.row_count IS DISTINCT FROM p.row_count
+                OR n.checksum IS DISTINCT FROM p.checksum
+            """, [rollup.name])
+            changed = conn.execute(
+                "SELECT count(*) FROM _rollup_changed"
+            ).fetchone()[0]
+            conn.execute(f"""
+            DELETE FROM {table}
+            WHERE EXISTS (
+                SELECT 1 FROM _rollup_changed c
+                WHERE c.partition_value
+                    IS NOT DISTINCT FROM CAST({table}.{partition} AS VARCHAR)
+            )
+            """)
+            fact_partition = f"{quote_identifier(rollup.fact_table)}.{partition}"
+            conn.execute(f"INSERT INTO {table} " + rollup.select_sql(f"""WHERE EXISTS (
+                SELECT 1 FROM _rollup_changed c
+                WHERE c.partition_value
+                    IS NOT DISTINCT FROM CAST({fact_partition} AS VARCHAR)
+            )"""))
+            conn.execute("DROP TABLE _rollup_changed")
+        conn.execute(
+            "DELETE FROM _rollup_partitions WHERE rollup_name = ?", [rollup.name]
+        )
+        conn.execute(
+            "INSERT INTO _rollup_partitions SELECT ?, * FROM _rollup_partitions_now",
+            [rollup.name],
+        )
+        if _is_consistent(conn, rollup):
+            conn.execute(
+                "INSERT OR REPLACE INTO _rollup_state "
+                "VALUES (?, ?, ?, current_timestamp)",
+                [rollup.name, rollup.definition, json.dumps(source_versions)],
+            )
+        else:
+            # Orphaned fact rows or duplicate keys: queries must not be answered
+            # from it
+            conn.execute(
+                "DELETE FROM _rollup_state WHERE rollup_name = ?", [rollup.name]
+            )
+        # Invalidates results cached for queries over the rollup
+        bump_table_versions(conn, [rollup.name])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.execute("DROP TABLE IF EXISTS _rollup_partitions_now")
+    return "rebuilt" if rebuild else f"refreshed {changed} partition(s)"
+
+def refresh_rollups(conn, rollups: Optional[List[Rollup]] = None,
+                    force: bool = False) -> Dict[str, str]:
+    """Refresh every rollup whose source tables changed.
+
+    Returns rollup name -> what was done.
+    """
+    results = {}
+    for rollup in ROLLUPS if rollups is None else rollups:
+        result = refresh_rollup(conn, rollup, force)
+        if result is not None:
+            results[rollup.name] = result
+    return results
+
+class _NotRewritable(Exception):
+    """The query uses something the rollup can't answer."""
+
+# Table references whose name may refer to the main schema
+MAIN_SCHEMAS = ("", "main")
+
+# Expression classes a rewritten query must not contain
+UNSUPPORTED_CLASSES = {
+    "SUBQUERY", "WINDOW", "STAR", "LAMBDA", "LAMBDA_REF", "PARAMETER",
+}
+
+def _has_aggregate(node, aggregates: Set[str]) -> bool:
+    """True if an expression calls an aggregate function outside of subqueries."""
+    if isinstance(node, list):
+        return any(_has_aggregate(item, aggregates) for item in node)
+    if not isinstance(node, dict) or node.get("class") == "SUBQUERY":
+        return False
+    if (node.get("class") == "FUNCTION"
+            and node.get("function_name", "").lower() in aggregates):
+        return True
+    return any(_has_aggregate(value, aggregates) for value in node.values())
+
+def _statement(node: dict) -> str:
+    """Wrap a query node as the JSON json_deserialize_sql expects."""
+    return json.dumps({
+        "error": False, "statements": [{"node": node, "named_param_map": []}],
+    })
+
+class _Scope:
+    """Rewrites the expressions of one SELECT over a rollup."""
+
+    def __init__(self, rewriter: "RollupRewriter", conn, rollup: Rollup,
+                 aliases: Dict[str, str], columns: Dict[str, Set[str]],
+                 select_aliases: Set[str]):
+        self.rewriter = rewriter
+        self.conn = conn
+        self.rollup = rollup
+        # Name used in the query -> table name
+        self.aliases = aliases
+        self.columns = columns
+        self.select_aliases = select_aliases
+        self.dimensions = rollup.dimension_map()
+        self.measures = rollup.measure_map()
+
+    def resolve(self, names: List[str]) -> Optional[Tuple[str, str]]:
+        """(table, column) of a column reference, or None if not a column of FROM."""
+        names = [name.lower() for name in names]
+        if len(names) >= 2:
+            table = self.aliases.get(names[-2])
+            if table is None or len(names) > 3:
+                raise _NotRewritable()
+            if names[-1] not in self.columns[table]:
+                raise _NotRewritable()
+            return table, names[-1]
+        candidates = sorted({
+            table for table in self.aliases.values() if names[0] in self.columns[table]
+        })
+        if not candidates:
+            return None
+        targets = {self.dimensions.get((table, names[0])) for table in candidates}
+        if len(candidates) > 1 and (len(targets) != 1 or None in targets):
+            # Ambiguous unless every candidate is the same dimension, e.g. a join
+            # key
+            raise _NotRewritable()
+        return candidates[0], names[0]
+
+    def column(self, node: dict, qualified: bool, name: str) -> dict:
+        """A reference to a rollup column, qualified if the original reference was."""
+        node = copy.deepcopy(node)
+        node["column_names"] = [self.rollup.name, name] if qualified else [name]
+        return node
+
+    def expression(self, node, in_aggregate: bool = False):
+        if isinstance(node, list):
+            return [self.expression(item, in_aggregate) for item in node]
+        if not isinstance(node, dict):
+            return node
+        kind = node.get("class")
+        if kind in UNSUPPORTED_CLASSES:
+            raise _NotRewritable()
+        if kind == "COLUMN_REF":
+            return self.column_ref(node)
+        aggregates = self.rewriter.aggregates(self.conn)
+        if kind == "FUNCTION" and node.get("function_name", "").lower() in aggregates:
+            if in_aggregate:
+                raise _NotRewritable()
+            return self.aggregate(node)
+        return {
+            key: self.expression(value, in_aggregate) for key, value in node.items()
+        }
+
+    def column_ref(self, node: dict) -> dict:
+        names = node["column_names"]
+        resolved = self.resolve(names)
+        if resolved is None:
+            # A select list alias, e.g. in ORDER BY or HAVING
+            name = names[0].lower()
+            if (name not in self.select_aliases
+                    or name in self.rewriter.rollup_columns(self.rollup)):
+                raise _NotRewritable()
+            return node
+        dimension = self.dimensions.get(resolved)
+        if dimension is None:
+            raise _NotRewritable()
+        qualified = len(names) > 1 or dimension != resolved[1]
+        return self.column(node, qualified, dimension)
+
+    def aggregate(self, node: dict) -> dict:
+        name = node["function_name"].lower()
+        children = node.get("children", [])
+        if node.get("order_bys", {}).get("orders") or node.get("export_state"):
+            raise _NotRewritable()
+        if name == "count_star" or (name == "count" and not children):
+            template = "CAST(coalesce(sum(order_count), 0) AS BIGINT)"
+        elif len(children) == 1 and children[0].get("class") == "COLUMN_REF":
+            resolved = self.resolve(children[0]["column_names"])
+            if resolved is None:
+                raise _NotRewritable()
+            dimension = self.dimensions.get(resolved)
+            if dimension is not None:
+                # Groups of the rollup have one value per dimension
+                if name in ("min", "max") or (name == "count" and node.get("distinct")):
+                    return {
+                        key: self.expression(value, True) for key, value in node.items()
+                    }
+                if name == "count":
+                    column = self.expression(children[0], True)
+                    template = (
+                        "CAST(coalesce(sum(CASE WHEN {dimension} IS NOT NULL "
+                        "THEN order_count END), 0) AS BIGINT)"
+                    )
+                    return self.fill(node, template, {"dimension": column})
+                raise _NotRewritable()
+            table, column = resolved
+            stored = (
+                self.measures.get(column) if table == self.rollup.fact_table else None
+            )
+            if not stored or node.get("distinct"):
+                raise _NotRewritable()
+            if name in ("sum", "min", "max") and name in stored:
+                template = f"{name}({quote_identifier(f'{column}_{name}')})"
+            elif name == "count" and "count" in stored:
+                count = quote_identifier(f"{column}_count")
+                template = f"CAST(coalesce(sum({count}), 0) AS BIGINT)"
+            elif name in ("avg", "mean") and "sum" in stored and "count" in stored:
+                template = (
+                    f"CAST(sum({quote_identifier(f'{column}_sum')}) AS DOUBLE) / "
+                    f"sum({quote_identifier(f'{column}_count')})"
+                )
+            else:
+                raise _NotRewritable()
+        else:
+            raise _NotRewritable()
+        return self.fill(node, template, {})
+
+    def fill(self, node: dict, template: str, placeholders: Dict[str, dict]) -> dict:
+        """The parsed template replacing an aggregate, with its alias and FILTER."""
+        text = template.format(**{name: f"__{name}__" for name in placeholders})
+        replacement = self.rewriter.parse_expression(self.conn, text)
+        condition = node.get("filter")
+        if condition is not None:
+            condition = self.expression(condition, True)
+
+        def fill_in(item):
+            if isinstance(item, list):
+                return [fill_in(value) for value in item]
+            if not isinstance(item, dict):
+                return item
+            if item.get("class") == "COLUMN_REF" and len(item["column_names"]) == 1:
+                name = item["column_names"][0]
+                if name.startswith("__") and name.strip("_") in placeholders:
+                    return placeholders[name.strip("_")]
+            item = {key: fill_in(value) for key, value in item.items()}
+            if (item.get("class") == "FUNCTION"
+                    and item.get("function_name") in ("sum", "min", "max")
+                    and condition is not None):
+                item["filter"] = condition
+            return item
+
+        replacement = fill_in(replacement)
+        replacement["alias"] = node.get("alias", "")
+        return replacement
+
+class RollupRewriter:
+    """Rewrites aggregate queries to read fresh rollup tables instead of raw tables."""
+
+    def __init__(self, rollups: Optional[List[Rollup]] = None):
+        self.rollups = ROLLUPS if rollups is None else rollups
+        self._aggregates: Optional[Set[str]] = None
+        self._expressions: Dict[str, dict] = {}
+        pattern = "|".join(re.escape(rollup.fact_table) for rollup in self.rollups)
+        self._fact_re = (
+            re.compile(rf"\b({pattern})\b", re.IGNORECASE) if pattern else None
+        )
+
+    def aggregates(self, conn) -> Set[str]:
+        """Names of DuckDB's aggregate functions."""
+        if self._aggregates is None:
+            self._aggregates = {row[0].lower() for row in conn.execute(
+                "SELECT DISTINCT function_name FROM duckdb_functions() "
+                "WHERE function_type = 'aggregate'"
+            ).fetchall()} | {"count_star"}
+        return self._aggregates
+
+    def rollup_columns(self, rollup: Rollup) -> Set[str]:
+        columns = {name for name, _, _ in rollup.dimensions} | {"order_count"}
+        columns |= {
+            f"{column}_{aggregate}"
+            for column, aggregates in rollup.measures for aggregate in aggregates
+        }
+        return columns
+
+    def parse_expression(self, conn, text: str) -> dict:
+        """The syntax tree of an expression, parsed once per text."""
+        if text not in self._expressions:
+            tree = json.loads(conn.execute(
+                "SELECT json_serialize_sql(?)", [f"SELECT {text}"]
+            ).fetchone()[0])
+            self._expressions[text] = tree["statements"][0]["node"]["select_list"][0]
+        return copy.deepcopy(self._expressions[text])
+
+    def fresh_rollups(self, conn) -> List[Rollup]:
+        """The rollups whose last refresh saw the current version of their sources."""
+        state = load_rollup_state(conn)
+        if not state:
+            return []
+        versions = load_table_versions(conn)
+        fresh = []
+        for rollup in self.rollups:
+            definition, source_versions = state.get(rollup.name, (None, {}))
+            if definition != rollup.definition:
+                continue
+            if all(versions.get(table) is not None
+                   and versions.get(table) == source_versions.get(table)
+                   for table in rollup.source_tables):
+                fresh.append(rollup)
+        return fresh
+
+    def rewrite(self, conn, sql: str) -> Optional[Tuple[str, List[str]]]:
+        """Rewrite a query to read rollups where possible.
+
+        Returns the new SQL and the names of the rollups it reads, or None if
+        no part of the query can be answered from a fresh rollup.
+        """
+        if self._fact_re is None or not self._fact_re.search(sql):
+            return None
+        try:
+            return self._rewrite(conn, sql)
+        except (duckdb.Error, KeyError, ValueError):
+            # Run the query as written rather than fail it here
+            return None
+
+    def _rewrite(self, conn, sql: str) -> Optional[Tuple[str, List[str]]]:
+        rollups = self.fresh_rollups(conn)
+        if not rollups:
+            return None
+        tree = json.loads(
+            conn.execute("SELECT json_serialize_sql(?)", [sql]).fetchone()[0]
+        )
+        if tree.get("error") or len(tree.get("statements", [])) != 1:
+            return None
+
+        statement = tree["statements"][0]
+        used: List[str] = []
+        columns = self._table_columns(conn, rollups)
+        node = self._rewrite_node(
+            conn, statement["node"], rollups, columns, set(), used
+        )
+        if not used:
+            return None
+        rewritten = conn.execute(
+            "SELECT json_deserialize_sql(?)", [_statement(node)]
+        ).fetchone()[0]
+        # Only use the rewrite if it produces exactly the same columns
+        original = self._describe(conn, sql)
+        if original is None or original != self._describe(conn, rewritten):
+            return None
+        return rewritten, used
+
+    def _describe(self, conn, sql: str) -> Optional[List[Tuple[str, str]]]:
+        try:
+            return [row[:2] for row in conn.execute(f"DESCRIBE {sql}").fetchall()]
+        except duckdb.Error:
+            return None
+
+    def _table_columns(self, conn, rollups: List[Rollup]) -> Dict[str, Set[str]]:
+        tables = sorted({table for rollup in rollups for table in rollup.source_tables})
+        columns: Dict[str, Set[str]] = {table: set() for table in tables}
+        for table, column in conn.execute(f"""
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_schema = 'main' AND table_name IN ({', '.join('?' for _ in tables)})
+        """, tables).fetchall():
+            columns[table].add(column.lower())
+        return columns
+
+    def _rewrite_node(self, conn, node, rollups: List[Rollup],
+                      columns: Dict[str, Set[str]], cte_names: Set[str],
+                      used: List[str]):
+        """Rewrite every SELECT of a tree that a rollup can answer, outermost first."""
+        if isinstance(node, list):
+            return [
+                self._rewrite_node(conn, item, rollups, columns, cte_names, used)
+                for item in node
+            ]
+        if not isinstance(node, dict):
+            return node
+        if node.get("type") == "SELECT_NODE":
+            # A CTE of the same name hides the table
+            cte_map = node.get("cte_map", {}).get("map", [])
+            cte_names = cte_names | {entry["key"].lower() for entry in cte_map}
+            for rollup in rollups:
+                rewritten = self._rewrite_select(conn, node, rollup, columns, cte_names)
+                if rewritten is not None:
+                    used.append(rollup.name)
+                    return rewritten
+        return {
+            key: self._rewrite_node(conn, value, rollups, columns, cte_names, used)
+            for key, value in node.items()
+        }
+
+    def _from_tables(self, from_table: dict, rollup: Rollup,
+                     cte_names: Set[str]) -> Optional[Dict[str, str]]:
+        """Name used in the query -> table, if FROM only joins the rollup's tables.
+
+        The tables must be joined on their keys.
+        """
+        if from_table.get("type") == "BASE_TABLE":
+            table = from_table["table_name"].lower()
+            if (from_table.get("schema_name", "").lower() not in MAIN_SCHEMAS
+                    or from_table.get("catalog_name")
+                    or from_table.get("column_name_alias")
+                    or from_table.get("sample") or from_table.get("at_clause")
+                    or table in cte_names or table not in rollup.source_tables):
+                return None
+            return {(from_table.get("alias") or table).lower(): table}
+        if (from_table.get("type") != "JOIN"
+                or from_table.get("ref_type") != "REGULAR"
+                or from_table.get("sample")):
+            return None
+        left = self._from_tables(from_table["left"], rollup, cte_names)
+        right = self._from_tables(from_table["right"], rollup, cte_names)
+        if (left is None or right is None or set(left) & set(right)
+                or set(left.values()) & set(right.values())):
+            return None
+        join_type = from_table.get("join_type")
+        if join_type == "LEFT":
+            # Only a LEFT JOIN from the fact table to a dimension table matches
+            # every fact row too
+            if rollup.fact_table not in left.values():
+                return None
+        elif join_type != "INNER":
+            return None
+        aliases = {**left, **right}
+        if not self._is_key_join(from_table, left, right, rollup):
+            return None
+        return aliases
+
+    def _is_key_join(self, join: dict, left: Dict[str, str], right: Dict[str, str],
+                     rollup: Rollup) -> bool:
+        """True if the join equates a fact foreign key with its dimension table key."""
+        tables = set(left.values()) | set(right.values())
+        keys = [key for key in rollup.joins if key[1] in tables]
+        if rollup.fact_table not in tables or len(keys) != 1 or len(tables) != 2:
+            return False
+        column, table, table_column = keys[0]
+        using = [name.lower() for name in join.get("using_columns", [])]
+        if using:
+            return using == [column] and column == table_column
+        condition = join.get("condition") or {}
+        if condition.get("type") != "COMPARE_EQUAL":
+            return False
+        aliases = {**left, **right}
+        sides = set()
+        for side in (condition.get("left", {}), condition.get("right", {})):
+            names = [name.lower() for name in side.get("column_names", [])]
+            if (side.get("class") != "COLUMN_REF" or len(names) != 2
+                    or names[0] not in aliases):
+                return False
+            sides.add((aliases[names[0]], names[1]))
+        return sides == {(rollup.fact_table, column), (table, table_column)}
+
+    def _rewrite_select(self, conn, node: dict, rollup: Rollup,
+                        columns: Dict[str, Set[str]],
+                        cte_names: Set[str]) -> Optional[dict]:
+        """The SELECT rewritten to read the rollup, or None if it can't answer it."""
+        if (node.get("cte_map", {}).get("map") or node.get("sample")
+                or node.get("qualify")):
+            return None
+        from_table = node.get("from_table") or {}
+        aliases = self._from_tables(from_table, rollup, cte_names)
+        if aliases is None or rollup.fact_table not in aliases.values():
+            return None
+        aggregates = self.aggregates(conn)
+        has_aggregate = (_has_aggregate(node.get("select_list"), aggregates)
+                         or node.get("having") is not None)
+        if not (node.get("group_expressions")
+                or node.get("aggregate_handling") == "FORCE_AGGREGATES"
+                or has_aggregate):
+            # Plain rows can't be read from the rollup
+            return None
+
+        select_aliases = {
+            item["alias"].lower() for item in node["select_list"] if item.get("alias")
+        }
+        scope = _Scope(self, conn, rollup, aliases, columns, select_aliases)
+        original_names = self._describe(conn, conn.execute(
+            "SELECT json_deserialize_sql(?)", [_statement(node)]
+        ).fetchone()[0])
+        if original_names is None or len(original_names) != len(node["select_list"]):
+            return None
+        try:
+            rewritten = dict(node)
+            rewritten["select_list"] = []
+            for item, (name, _) in zip(node["select_list"], original_names):
+                new_item = scope.expression(item)
+                # Keep the result column names of the original query
+                new_item["alias"] = item.get("alias") or name
+                rewritten["select_list"].append(new_item)
+            for key in ("where_clause", "group_expressions", "having", "modifiers"):
+                rewritten[key] = scope.expression(node.get(key))
+        except _NotRewritable:
+            return None
+        rewritten["from_table"] = self.parse_from(conn, rollup.name)
+        return rewritten
+
+    def parse_from(self, conn, table_name: str) -> dict:
+        key = f"FROM {table_name}"
+        if key not in self._expressions:
+            tree = json.loads(conn.execute(
+                "SELECT json_serialize_sql(?)",
+                [f"SELECT 1 FROM {quote_identifier(table_name)}"],
+            ).fetchone()[0])
+            self._expressions[key] = tree["statements"][0]["node"]["from_table"]
+        return copy.deepcopy(self._expressions[key])
@@ -0,0 +1,223 @@
+"""
+Incremental extraction of SQL from a streamed LLM response.
+
+scan_sql() locates the SQL statement in the text received so far: after an
+opening markdown fence if there is one, or from the first word if that is a
+SQL keyword. The statement ends at a semicolon or closing fence outside
+string literals, quoted identifiers and comments. An unterminated statement
+outside a fence also ends at a blank line followed by a sentence: a line
+that starts with a word other than a SQL keyword and has a '.', ':', '!' or
+'?' followed by whitespace before any quote, e.g. "This query counts the
+orders." A line such as "Orders as o" is never taken for prose. SqlStream
+passes only the SQL on to its consumer as it arrives, and closes the LLM
+stream as soon as the statement is complete or prose follows it, so the
+query can be checked and run while the model would otherwise still be
+explaining it.
+"""
+
+import re
+import time
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+from struct_llm.repair import clean_sql
+
+# Words a SQL statement can start with
+STATEMENT_START_RE = re.compile(r"(?:SELECT|WITH|FROM|VALUES|\()", re.IGNORECASE)
+
+# Opening fence and its language tag, e.g. "```sql\n"
+OPENING_FENCE_RE = re.compile(r"```[^\n`]*\n")
+
+# A line break followed by a blank line
+BLANK_LINE_RE = re.compile(r"\n[ \t]*\n\s*")
+
+# A line of prose after its first word: sentence punctuation before any quote
+SENTENCE_RE = re.compile(r"[^'\"\n]*?[.:!?]\s")
+
+# Words that can start a line of a statement, which is then never taken for prose
+SQL_KEYWORDS = {
+    "select", "from", "where", "group", "order", "having", "limit", "offset", "join",
+    "left", "right", "inner", "outer", "full", "cross", "natural", "asof", "positional",
+    "semi", "anti", "lateral", "on", "using", "and", "or", "not", "union", "intersect",
+    "except", "with", "as", "case", "when", "then", "else", "end", "qualify", "window",
+    "values", "distinct", "by", "asc", "desc", "in", "is", "between", "like", "ilike",
+    "over", "partition", "all", "any", "exists", "cast", "interval", "date",
+    "timestamp",
+}
+
+@dataclass
+class SqlSpan:
+    """Where the SQL statement is in a partial response."""
+    # Offsets of the statement's text that can be shown; end excludes a possible
+    # partial fence
+    start: Optional[int]
+    end: int
+    # The statement is complete: no more SQL will follow
+    complete: bool = False
+    # Text follows the statement, i.e. the rest of the response is not needed
+    prose: bool = False
+
+    @property
+    def done(self) -> bool:
+        """Nothing after the statement is needed: it is complete or prose follows it."""
+        return self.complete or self.prose
+
+def _find_start(text: str) -> Optional[int]:
+    """Offset where the statement starts, or None if it hasn't started yet."""
+    stripped = len(text) - len(text.lstrip())
+    word = re.match(r"\(|[A-Za-z_]+(?=[\s(])", text[stripped:])
+    if word and STATEMENT_START_RE.fullmatch(word.group(0)):
+        return stripped
+    fence = text.find("```")
+    if fence != -1:
+        match = OPENING_FENCE_RE.match(text, fence)
+        return match.end() if match else None
+    # Prose before the statement: wait for a fence
+    return None
+
+def _is_prose(text: str, line_start: int, final: bool) -> Optional[bool]:
+    """Whether the line at line_start is a sentence, or None if it can't be told yet."""
+    word = re.match(r"[A-Za-z]+", text[line_start:])
+    if word is None or word.group(0).lower() in SQL_KEYWORDS:
+        return False
+    line_end = text.find("\n", line_start)
+    rest = text[line_start + word.end():len(text) if line_end == -1 else line_end + 1]
+    if SENTENCE_RE.match(rest + "\n" if final else rest):
+        return True
+    return False if line_end != -1 or final else None
+
+def scan_sql(text: str, final: bool = False) -> SqlSpan:
+    """Locate the SQL statement in the text of a response received so far.
+
+    final tells that the response is complete, so a sentence may end with it.
+    """
+    start = _find_start(text)
+    if start is None:
+        return SqlSpan(None, 0)
+    fenced = "```" in text[:start]
+    i = start
+    while i < len(text):
+        char = text[i]
+        if char in "'\"":
+            close = text.find(char, i + 1)
+            # Doubled quotes escape themselves
+            while close != -1 and text.startswith(char, close + 1):
+                close = text.find(char, close + 2)
+            if close == -1:
+                return SqlSpan(start, len(text))
+            i = close + 1
+        elif text.startswith("--", i):
+            newline = text.find("\n", i)
+            if newline == -1:
+                return SqlSpan(start, len(text))
+            i = newline
+        elif text.startswith("/*", i):
+            close = text.find("*/", i + 2)
+            if close == -1:
+                return SqlSpan(start, len(text))
+            i = close + 2
+        elif char == ";":
+            prose = bool(text[i + 1:].strip())
+            return SqlSpan(start, i + 1, complete=True, prose=prose)
+        elif char == "`":
+            if text.startswith("```", i):
+                prose = bool(text[i + 3:].strip())
+                return SqlSpan(start, i, complete=True, prose=prose)
+            if len(text) - i < 3 and text[i:] == "`" * (len(text) - i):
+                # Maybe the start of a closing fence
+                return SqlSpan(start, i)
+            i += 1
+        elif char == "\n" and not fenced:
+            blank = BLANK_LINE_RE.match(text, i)
+            prose = False
+            if blank and blank.end() < len(text):
+                prose = _is_prose(text, blank.end(), final)
+            if prose is None:
+                # Hold the line back until it can be told apart from SQL
+                return SqlSpan(start, i)
+            if prose:
+                return SqlSpan(start, i, prose=True)
+            i += 1
+        else:
+            i += 1
+    return SqlSpan(start, len(text))
+
+class SqlStream:
+    """Iterate the SQL text of a streamed LLM response as it arrives.
+
+    deltas are the text chunks of the response. Iterating yields the parts of
+    them that belong to the SQL statement. Once the statement is complete the
+    source is closed, which cancels the rest of the generation. Afterwards sql
+    holds the cleaned statement (see struct_llm.repair.clean_sql), and
+    first_chunk_seconds how long the first SQL text took to arrive.
+    A trace, if passed, gets the llm, first_token and repair stages.
+    """
+
+    def __init__(self, deltas: Iterable[str], trace=None, cached: bool = False):
+        self._deltas = deltas
+        self.trace = trace
+        self.cached = cached
+        self.text = ""
+        self.sql: Optional[str] = None
+        self.cancelled = False
+        self.first_chunk_seconds: Optional[float] = None
+
+    @classmethod
+    def of(cls, sql: str, trace=None, cached: bool = False) -> "SqlStream":
+        """A stream of SQL that is known already, e.g. from the translation cache."""
+        return cls([sql], trace, cached)
+
+    def __iter__(self) -> Iterator[str]:
+        started = time.perf_counter()
+        emitted = 0
+        span = SqlSpan(None, 0)
+        deltas = iter(self._deltas)
+        try:
+            for delta in deltas:
+                self.text += delta
+                span = scan_sql(self.text)
+                if span.start is not None and span.end > span.start + emitted:
+                    if self.first_chunk_seconds is None:
+                        self.first_chunk_seconds = time.perf_counter() - started
+                        if self.trace is not None:
+                            self.trace.stages["first_token"] = self.first_chunk_seconds
+                    yield self.text[span.start + emitted:span.end]
+                    emitted = span.end - span.start
+                if span.done:
+                    self.cancelled = True
+                    break
+        finally:
+            close = getattr(deltas, "close", None)
+            if close is not None:
+                close()
+        if span.start is None:
+            # No statement was recognized while streaming; clean_sql gets the most
+            # out of the text
+            self._finish(self.text)
+            if self.sql:
+                yield self.sql
+            return
+        if not self.cancelled:
+            # The response ended: a last line may be a sentence ending with it, and
+            # backticks held back in case they became a fence are SQL after all
+            span = scan_sql(self.text, final=True)
+            if not span.prose:
+                span.end = len(self.text)
+            if span.end > span.start + emitted:
+                yield self.text[span.start + emitted:span.end]
+        self._finish(self.text[span.start:span.end])
+
+    def _finish(self, text: str):
+        if self.cached:
+            self.sql = text
+        elif self.trace is not None:
+            with self.trace.stage("repair"):
+                self.sql = self.trace.sql = clean_sql(text)
+        else:
+            self.sql = clean_sql(text)
+
+    def read(self) -> str:
+        """Consume the whole stream and return the cleaned SQL."""
+        for _ in self:
+            pass
+        return self.sql
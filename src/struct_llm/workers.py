@@ -0,0 +1,284 @@
+"""
+Run queries in a pool of worker processes.
+
+Each worker opens data/database.db read-only, with a DuckDB memory limit and
+thread count of its own, and runs one query at a time. CPU-heavy queries are
+thereby spread across cores away from the process serving users, and a query
+that runs out of memory or crashes DuckDB takes down only its worker, which
+is replaced.
+
+Results come back as Arrow IPC files written to shared memory (/dev/shm,
+where it is large enough) and memory-mapped by the caller, so they are not
+copied through a pipe. Queries are cancelled with DuckDB's interrupt() in the
+worker; a worker that doesn't stop within a grace period is killed.
+"""
+
+import atexit
+import itertools
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import pyarrow as pa
+
+from struct_llm.database import DB_PATH
+from struct_llm.errors import QueryError, QueryTimeoutError
+
+# Rows per record batch written to the result file
+BATCH_SIZE = 100_000
+SHARED_MEMORY_DIR = Path("/dev/shm")
+# /dev/shm is often small in containers; below this size results go to the temp
+# directory
+MIN_SHARED_MEMORY_BYTES = 1 << 30
+
+class QueryCancelled(Exception):
+    """The query was cancelled before it finished."""
+
+def default_spill_dir() -> Path:
+    """Where workers write result files: /dev/shm if large enough, else the temp dir."""
+    try:
+        if shutil.disk_usage(SHARED_MEMORY_DIR).total >= MIN_SHARED_MEMORY_BYTES:
+            return SHARED_MEMORY_DIR
+    except OSError:
+        pass
+    return Path(tempfile.gettempdir())
+
+def _worker_main(db_path: str, config: Dict[str, str], pipe, spill_dir: str):
+    """Serve ("query", id, sql) requests from the pipe until it closes.
+
+    Replies ("ok", id, path) with the path of an Arrow IPC file holding the
+    result, ("cancelled", id) or ("error", id, DuckDB exception name, message).
+    A listener thread receives the requests, so that ("cancel", id) can
+    interrupt the query running meanwhile.
+    """
+    import duckdb
+
+    requests: "queue.Queue" = queue.Queue()
+    cancelled = set()
+    running = [None]
+    lock = threading.Lock()
+    db = None
+
+    def listen():
+        while True:
+            try:
+                message = pipe.recv()
+            except (EOFError, OSError):
+                requests.put(None)
+                return
+            if message[0] == "cancel":
+                with lock:
+                    cancelled.add(message[1])
+                    if running[0] == message[1] and db is not None:
+                        db.interrupt()
+            else:
+                requests.put(message)
+
+    threading.Thread(target=listen, name="query-worker-listener", daemon=True).start()
+    while True:
+        message = requests.get()
+        if message is None:
+            return
+        _, query_id, sql = message
+        path = os.path.join(spill_dir, f"struct-llm-{os.getpid()}-{query_id}.arrow")
+        try:
+            if db is None:
+                db = duckdb.connect(db_path, read_only=True, config=config)
+            with lock:
+                if query_id in cancelled:
+                    raise QueryCancelled()
+                running[0] = query_id
+            reader = db.execute(sql).fetch_record_batch(BATCH_SIZE)
+            sink = pa.OSFile(path, "wb")
+            with sink, pa.ipc.new_file(sink, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+            reply = ("ok", query_id, path)
+        except Exception as e:
+            if os.path.exists(path):
+                os.unlink(path)
+            with lock:
+                was_cancelled = query_id in cancelled
+            if was_cancelled:
+                reply = ("cancelled", query_id)
+            else:
+                reply = ("error", query_id, type(e).__name__, str(e))
+        finally:
+            with lock:
+                running[0] = None
+                cancelled.discard(query_id)
+        pipe.send(reply)
+
+def _query_error(name: str, message: str) -> QueryError:
+    """A QueryError caused by the DuckDB exception a worker reported.
+
+    Callers can tell the kind of error from its cause.
+    """
+    import duckdb
+
+    error_type = getattr(duckdb, name, None)
+    if not (isinstance(error_type, type) and issubclass(error_type, Exception)):
+        error_type = duckdb.Error
+    error = QueryError(f"Error executing query: {message}")
+    error.__cause__ = error_type(message)
+    return error
+
+class _Worker:
+    """A worker process and the pipe to it."""
+
+    def __init__(self, context, db_path: Path, config: Dict[str, str], spill_dir: Path):
+        self._args = (context, db_path, config, spill_dir)
+        self.start()
+
+    def start(self):
+        context, db_path, config, spill_dir = self._args
+        self.pipe, child_pipe = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(str(db_path), config, child_pipe, str(spill_dir)),
+            name="struct-llm-query-worker", daemon=True,
+        )
+        self.process.start()
+        child_pipe.close()
+
+    def stop(self, timeout: float = 1.0):
+        self.pipe.close()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def restart(self):
+        self.stop(timeout=0)
+        self.start()
+
+class QueryProcessPool:
+    """A fixed number of worker processes, each with a read-only connection of its own.
+
+    memory_limit (e.g. "2GB") and threads are DuckDB settings of each worker;
+    threads defaults to an even share of the CPUs. Workers are started with
+    the spawn method, which is safe in a threaded server.
+    """
+
+    def __init__(self, db_path: Path = DB_PATH, processes: Optional[int] = None,
+                 memory_limit: Optional[str] = None, threads: Optional[int] = None,
+                 temp_directory: Optional[str] = None, spill_dir: Optional[Path] = None,
+                 cancel_grace: float = 5.0, poll_interval: float = 0.1):
+        self.db_path = Path(db_path).resolve()
+        self.processes = processes or os.cpu_count() or 1
+        self.config: Dict[str, str] = {
+            'threads': str(threads or max(1, (os.cpu_count() or 1) // self.processes)),
+        }
+        if memory_limit:
+            self.config['memory_limit'] = memory_limit
+        if temp_directory:
+            self.config['temp_directory'] = temp_directory
+        self.spill_dir = (
+            Path(spill_dir) if spill_dir is not None else default_spill_dir()
+        )
+        self.cancel_grace = cancel_grace
+        self.poll_interval = poll_interval
+        # Workers restarted after crashing or failing to stop
+        self.restarts = 0
+        context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(context, self.db_path, self.config, self.spill_dir)
+                         for _ in range(self.processes)]
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        self._ids = itertools.count()
+        self._closed = False
+        atexit.register(self.close)
+
+    def run(self, sql: str, timeout: Optional[float] = None,
+            on_wait: Optional[Callable[[], None]] = None) -> pa.Table:
+        """Run a query on an idle worker and return its result.
+
+        Waits for a worker if all are busy. The query is cancelled if it runs
+        longer than timeout seconds, raising QueryTimeoutError, or if on_wait,
+        which is called every poll interval while the query runs, raises;
+        its exception is then re-raised. DuckDB errors raise QueryError with
+        the DuckDB exception as its cause, as in-process execution does.
+        """
+        if self._closed:
+            raise QueryError("Error executing query: the query worker pool is closed")
+        worker = self._idle.get()
+        try:
+            return self._run_on(worker, sql, timeout, on_wait)
+        finally:
+            self._idle.put(worker)
+
+    def _run_on(self, worker: _Worker, sql: str, timeout: Optional[float],
+                on_wait: Optional[Callable[[], None]]) -> pa.Table:
+        query_id = next(self._ids)
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            worker.pipe.send(("query", query_id, sql))
+            while not worker.pipe.poll(self.poll_interval):
+                if not worker.process.is_alive():
+                    raise EOFError
+                if deadline is not None and time.monotonic() > deadline:
+                    self._cancel(worker, query_id)
+                    raise QueryTimeoutError(
+                        f"Error executing query: timed out after {timeout:g} seconds"
+                    )
+                if on_wait is not None:
+                    try:
+                        on_wait()
+                    except BaseException:
+                        self._cancel(worker, query_id)
+                        raise
+            reply = worker.pipe.recv()
+        except (EOFError, OSError):
+            worker.process.join(1.0)
+            code = worker.process.exitcode
+            self._restart(worker)
+            raise QueryError(
+                f"Error executing query: the query worker process exited "
+                f"(code {code}), possibly out of memory"
+            )
+        if reply[0] == "error":
+            raise _query_error(reply[2], reply[3])
+        if reply[0] == "cancelled":
+            raise QueryError("Error executing query: cancelled")
+        return self._read(reply[2])
+
+    @staticmethod
+    def _read(path: str) -> pa.Table:
+        """Memory-map a result file; the mapping outlives the file, removed at once."""
+        try:
+            return pa.ipc.open_file(pa.memory_map(path)).read_all()
+        finally:
+            os.unlink(path)
+
+    def _cancel(self, worker: _Worker, query_id: int):
+        """Interrupt the worker's query, restarting the worker if it doesn't stop."""
+        try:
+            worker.pipe.send(("cancel", query_id))
+            if worker.pipe.poll(self.cancel_grace):
+                reply = worker.pipe.recv()
+                if reply[0] == "ok":
+                    # Finished just before the cancellation
+                    os.unlink(reply[2])
+                return
+        except (EOFError, OSError):
+            pass
+        self._restart(worker)
+
+    def _restart(self, worker: _Worker):
+        worker.restart()
+        self.restarts += 1
+
+    def close(self):
+        """Stop the workers. Queries still running are abandoned."""
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self._workers:
+            worker.stop()
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import pytest
+
+from struct_llm.batch import SingleFlight, TokenBucket, is_retryable, retry_with_backoff
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+def test_token_bucket_allows_a_burst_then_the_rate():
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=2)
+        started = time.monotonic()
+        await bucket.acquire()
+        await bucket.acquire()
+        burst = time.monotonic() - started
+        for _ in range(5):
+            await bucket.acquire()
+        return burst, time.monotonic() - started
+
+    burst, total = asyncio.run(run())
+    assert burst < 0.02
+    # Five tokens past the burst at 50 per second
+    assert total >= 0.09
+
+def test_token_bucket_rejects_a_non_positive_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+@pytest.mark.parametrize("error, retryable", [
+    (StatusError(429), True),
+    (StatusError(503), True),
+    (StatusError(400), False),
+    (ConnectionError(), True),
+    (TimeoutError(), True),
+    (ValueError(), False),
+])
+def test_is_retryable(error, retryable):
+    assert is_retryable(error) is retryable
+
+def test_retry_with_backoff_retries_until_success():
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise StatusError(503)
+        return "ok"
+
+    assert asyncio.run(retry_with_backoff(flaky, retries=4, base_delay=0)) == "ok"
+    assert len(calls) == 3
+
+def test_retry_with_backoff_gives_up_after_the_retries():
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        raise StatusError(429)
+
+    with pytest.raises(StatusError):
+        asyncio.run(retry_with_backoff(failing, retries=2, base_delay=0))
+    assert len(calls) == 3
+
+def test_retry_with_backoff_raises_other_errors_at_once():
+    calls = []
+
+    async def invalid():
+        calls.append(1)
+        raise StatusError(400)
+
+    with pytest.raises(StatusError):
+        asyncio.run(retry_with_backoff(invalid, retries=4, base_delay=0))
+    assert len(calls) == 1
+
+def test_single_flight_shares_a_call_between_concurrent_callers():
+    calls = []
+
+    async def run():
+        flight = SingleFlight()
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "sql"
+
+        results = await asyncio.gather(
+            *(flight.do("question", fetch) for _ in range(5))
+        )
+        # The call is over, so the next one runs again
+        results.append(await flight.do("question", fetch))
+        return results
+
+    assert asyncio.run(run()) == ["sql"] * 6
+    assert len(calls) == 2
+
+def test_single_flight_gives_every_caller_the_error():
+    async def run():
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise StatusError(500)
+
+        return await asyncio.gather(
+            *(flight.do("question", fail) for _ in range(3)), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, StatusError) for result in results)
+
+def test_single_flight_keeps_keys_apart():
+    async def run():
+        flight = SingleFlight()
+
+        async def echo(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        return await asyncio.gather(
+            flight.do("a", lambda: echo("a")), flight.do("b", lambda: echo("b"))
+        )
+
+    assert asyncio.run(run()) == ["a", "b"]
@@ -0,0 +1,109 @@
+import os
+import threading
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from struct_llm.errors import QueryError
+from struct_llm.export import ExportOptions, ExportStream, export_file
+
+ROWS = 200_000
+SQL = "SELECT order_id, amount FROM orders ORDER BY order_id"
+# Far more than a pipe buffer holds
+SLOW_SQL = "SELECT a.range AS x, b.range AS y FROM range(100000) a, range(100000) b"
+
+
+@pytest.fixture
+def conn():
+    conn = duckdb.connect()
+    conn.execute(f"""
+    CREATE TABLE orders AS
+    SELECT range AS order_id, range / 4 AS amount FROM range({ROWS})
+    """)
+    yield conn
+    conn.close()
+
+def copy_threads():
+    return [thread for thread in threading.enumerate() if thread.name == "duckdb-copy"]
+
+@pytest.mark.parametrize("format", ["csv", "parquet", "arrow"])
+def test_export_file_writes_every_row(conn, tmp_path, format):
+    path = tmp_path / f"result.{format}"
+    reports = []
+    rows = export_file(conn.cursor(), SQL, path, ExportOptions(format), reports.append)
+    assert rows == ROWS
+    if format == "csv":
+        assert path.read_text().count("\n") == ROWS + 1
+    elif format == "parquet":
+        assert pq.read_metadata(path).num_rows == ROWS
+    else:
+        assert pa.ipc.open_file(pa.memory_map(str(path))).read_all().num_rows == ROWS
+    assert reports[-1].done and reports[-1].rows == ROWS
+    assert reports[-1].bytes_written == path.stat().st_size
+
+def read_all(stream):
+    chunks = list(stream)
+    return chunks, b"".join(chunks)
+
+@pytest.mark.parametrize("format", ["csv", "parquet", "arrow"])
+def test_stream_yields_every_row(conn, format):
+    stream = ExportStream(conn.cursor(), SQL, ExportOptions(format), chunk_size=1 << 16)
+    chunks, data = read_all(stream)
+    assert stream.rows == ROWS
+    assert stream.bytes_written == len(data)
+    if format == "csv":
+        # Read from the pipe in chunks as COPY writes them
+        assert len(chunks) > 1
+        lines = data.decode().splitlines()
+        assert lines[:2] == ["order_id,amount", "0,0.0"]
+        assert len(lines) == ROWS + 1
+    elif format == "parquet":
+        assert pq.read_table(pa.BufferReader(data)).num_rows == ROWS
+    else:
+        assert pa.ipc.open_stream(data).read_all().num_rows == ROWS
+
+def test_stream_through_a_temporary_file_without_named_pipes(conn, monkeypatch):
+    monkeypatch.delattr(os, "mkfifo")
+    stream = ExportStream(conn.cursor(), SQL, ExportOptions("csv"))
+    _, data = read_all(stream)
+    assert stream.rows == ROWS
+    assert data.count(b"\n") == ROWS + 1
+
+def test_stream_reports_the_progress(conn):
+    reports = []
+    stream = ExportStream(conn.cursor(), SQL, progress=reports.append)
+    _, data = read_all(stream)
+    assert reports[-1].done
+    assert (reports[-1].rows, reports[-1].bytes_written) == (ROWS, len(data))
+
+def test_closing_the_stream_cancels_the_export(conn):
+    stream = ExportStream(conn.cursor(), SLOW_SQL, chunk_size=1 << 16)
+    assert next(stream).startswith(b"x,y\n")
+    stream.close()
+    assert copy_threads() == []
+    assert stream.rows is None
+    # The connection is still usable
+    assert conn.execute("SELECT count(*) FROM orders").fetchone() == (ROWS,)
+
+def test_progress_errors_cancel_the_export(conn):
+    def progress(report):
+        raise RuntimeError("client went away")
+
+    stream = ExportStream(conn.cursor(), SLOW_SQL, progress=progress)
+    with pytest.raises(RuntimeError, match="client went away"):
+        read_all(stream)
+    assert copy_threads() == []
+
+def test_query_errors_surface_while_iterating(conn):
+    stream = ExportStream(conn.cursor(), "SELECT missing_column FROM orders")
+    with pytest.raises(QueryError) as raised:
+        read_all(stream)
+    assert isinstance(raised.value.__cause__, duckdb.BinderException)
+
+def test_options_are_validated():
+    with pytest.raises(ValueError, match="Unknown export format"):
+        ExportOptions("xml")
+    with pytest.raises(ValueError, match="Unknown Parquet compression"):
+        ExportOptions("parquet", compression="zip")
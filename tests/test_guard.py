@@ -0,0 +1,80 @@
+import duckdb
+import pytest
+
+from struct_llm.errors import QueryRejectedError, QueryTimeoutError
+from struct_llm.guard import QueryGuard, estimate_plan, outer_limit
+
+
+@pytest.fixture
+def conn():
+    conn = duckdb.connect()
+    conn.execute(
+        "CREATE TABLE t AS SELECT range AS id, range % 10 AS k FROM range(10000)"
+    )
+    yield conn
+    conn.close()
+
+def test_estimate_plan_reads_the_output_and_peak_rows(conn):
+    estimate = estimate_plan(conn, "SELECT * FROM t a, t b")
+    assert estimate.output_rows == estimate.peak_rows == 100_000_000
+    assert estimate.peak_operator == "CROSS_PRODUCT"
+
+def test_outer_limit_ignores_subquery_limits(conn):
+    assert outer_limit(conn, "SELECT * FROM t LIMIT 5") == 5
+    assert outer_limit(conn, "SELECT * FROM (SELECT * FROM t LIMIT 5)") is None
+
+def test_rejects_a_plan_over_the_row_budget(conn):
+    guard = QueryGuard(max_estimated_rows=1_000_000)
+    with pytest.raises(QueryRejectedError, match="CROSS_PRODUCT"):
+        guard.check(conn, "SELECT count(*) FROM t a, t b")
+
+def test_accepts_a_plan_within_the_row_budget(conn):
+    guard = QueryGuard(max_estimated_rows=1_000_000)
+    sql = "SELECT count(*) FROM t a JOIN t b ON a.id = b.id"
+    assert guard.check(conn, sql)[0] == sql
+
+def test_limits_a_large_result(conn):
+    guard = QueryGuard(max_result_rows=100)
+    sql, estimate = guard.check(conn, "SELECT * FROM t;")
+    assert estimate.output_rows == 10000
+    assert sql == "SELECT * FROM (SELECT * FROM t) LIMIT 100"
+    assert len(conn.execute(sql).fetchall()) == 100
+
+def test_keeps_a_smaller_limit_of_the_query(conn):
+    guard = QueryGuard(max_result_rows=100)
+    sql = "SELECT * FROM t LIMIT 10"
+    assert guard.check(conn, sql)[0] == sql
+
+def test_lowers_a_larger_limit_of_the_query(conn):
+    guard = QueryGuard(max_result_rows=100)
+    assert guard.check(conn, "SELECT * FROM t LIMIT 5000")[0].endswith("LIMIT 100")
+
+def test_keeps_a_small_result(conn):
+    guard = QueryGuard(max_result_rows=100)
+    sql = "SELECT k, count(*) FROM t GROUP BY k"
+    assert guard.check(conn, sql)[0] == sql
+
+def test_auto_limit_off_only_rejects(conn):
+    guard = QueryGuard(max_estimated_rows=1_000_000, max_result_rows=100)
+    sql = "SELECT * FROM t"
+    assert guard.check(conn, sql, auto_limit=False)[0] == sql
+    with pytest.raises(QueryRejectedError):
+        guard.check(conn, "SELECT * FROM t a, t b", auto_limit=False)
+
+def test_disabled_limits_skip_the_plan(conn):
+    sql = "SELECT * FROM t a, t b"
+    assert QueryGuard().check(conn, sql) == (sql, None)
+
+def test_unplannable_sql_is_left_to_fail_when_run(conn):
+    guard = QueryGuard(max_estimated_rows=1_000_000, max_result_rows=100)
+    assert guard.check(conn, "SELECT nope FROM t") == ("SELECT nope FROM t", None)
+
+def test_watchdog_interrupts_a_query_past_the_timeout(conn):
+    watchdog = QueryGuard(timeout=0.2).watchdog(conn)
+    try:
+        with pytest.raises(QueryTimeoutError), watchdog:
+            conn.execute(
+                "SELECT count(*) FROM range(100000000000) a WHERE a.range % 7 = 3"
+            ).fetchall()
+    finally:
+        watchdog.cancel()
@@ -0,0 +1,115 @@
+import pytest
+
+from struct_llm.history import HistoryIndex, QueryHistory
+from struct_llm.metrics import Trace
+
+
+def answered(question, sql, fingerprint="v1", rows=3, error=None):
+    trace = Trace(question, sql=sql, schema_fingerprint=fingerprint, rows=rows)
+    trace.error = error
+    trace.stages["total"] = 0.25
+    return trace
+
+@pytest.fixture
+def history(tmp_path):
+    history = QueryHistory(tmp_path / "history.db", flush_interval=0.05)
+    yield history
+    history.close()
+
+def test_search_finds_similar_questions_through_the_lsh_bands():
+    index = HistoryIndex()
+    index.add("total premium of active policies by coverage type", "SELECT 1")
+    index.add("number of customers per state", "SELECT 2")
+    index.add("average age of customers", "SELECT 3")
+    matches = index.search("total premium of active policies grouped by coverage type")
+    assert [match.sql for match in matches] == ["SELECT 1"]
+    assert 0.8 < matches[0].similarity < 1.0
+    assert index.search("weather in paris") == []
+
+def test_search_ranks_by_similarity_after_reindexing():
+    index = HistoryIndex()
+    # Enough entries to move the band keys into the sorted arrays
+    index.add_many(
+        (f"orders of customer {i} in state {i % 50}", f"SELECT {i}")
+        for i in range(3000)
+    )
+    assert index._sorted_ids.shape[1] > 0
+    index.add("orders of customer 7 in state 7 last month", "SELECT 'recent'")
+    matches = index.search("orders of customer 7 in state 7", k=2)
+    assert [match.sql for match in matches] == ["SELECT 7", "SELECT 'recent'"]
+    assert matches[0].similarity == pytest.approx(1.0)
+
+def test_add_replaces_the_sql_of_the_same_normalized_question():
+    index = HistoryIndex()
+    index.add("How many orders?", "SELECT count(*) FROM orders")
+    index.add("how many   ORDERS", "SELECT count(order_id) FROM orders")
+    assert len(index) == 1
+    assert index.exact("How many orders").sql == "SELECT count(order_id) FROM orders"
+    assert index.exact("How many customers?") is None
+
+def test_only_successful_answers_for_the_current_schema_are_indexed(history):
+    history.use_fingerprint("v1")
+    history.record(answered("How many orders?", "SELECT 1"))
+    # Failed, not run or answered against another schema
+    history.record(answered("How many customers?", "SELECT 2", error="no table"))
+    history.record(answered("How many products?", "SELECT 3", rows=None))
+    history.record(answered("How many agents?", "SELECT 4", fingerprint="v0"))
+    assert len(history.index) == 1
+    assert history.lookup("how many orders", "v1")[0].sql == "SELECT 1"
+    # Another schema has nothing indexed
+    assert history.lookup("how many orders", "v2") == []
+
+def test_the_index_is_reloaded_from_the_log_per_fingerprint(tmp_path):
+    history = QueryHistory(tmp_path / "history.db", flush_interval=0.05)
+    history.use_fingerprint("v1")
+    history.record(answered("How many orders?", "SELECT 1"))
+    history.record(answered("How many orders?", "SELECT 2"))
+    history.record(answered("How many customers?", "SELECT 3", fingerprint="v2"))
+    history.close()
+
+    reopened = QueryHistory(tmp_path / "history.db")
+    try:
+        reopened.use_fingerprint("v1")
+        reopened._loaders[-1].join()
+        # The latest SQL of the question
+        matches = reopened.lookup("How many orders?", "v1")
+        assert [match.sql for match in matches] == ["SELECT 2"]
+        reopened.use_fingerprint("v2")
+        reopened._loaders[-1].join()
+        matches = reopened.lookup("How many customers?", "v2")
+        assert [match.sql for match in matches] == ["SELECT 3"]
+    finally:
+        reopened.close()
+
+def test_flush_writes_every_queued_entry(history):
+    for i in range(600):
+        history.record(answered(f"question {i}", f"SELECT {i}"))
+    history.flush()
+    assert history._queue.unfinished_tasks == 0
+    recent = history.recent(limit=2)
+    assert [entry["question"] for entry in recent] == ["question 599", "question 598"]
+    assert recent[0]["total_ms"] == pytest.approx(250.0)
+
+def test_close_writes_the_queue_and_stops_the_writer(tmp_path):
+    history = QueryHistory(tmp_path / "history.db", flush_interval=10)
+    history.record(answered("How many orders?", "SELECT 1"))
+    writer = history._writer
+    history.close()
+    assert not writer.is_alive()
+    reopened = QueryHistory(tmp_path / "history.db")
+    try:
+        recent = reopened.recent()
+        assert [entry["question"] for entry in recent] == ["How many orders?"]
+    finally:
+        reopened.close()
+
+def test_memory_only_history_queues_nothing():
+    history = QueryHistory(db_path=None)
+    history.use_fingerprint("v1")
+    for i in range(10):
+        history.record(answered(f"question {i}", f"SELECT {i}"))
+    assert history._queue.qsize() == 0
+    assert history._writer is None
+    assert history.lookup("question 3", "v1")[0].sql == "SELECT 3"
+    assert history.recent() == []
+    history.close()
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+import nl_to_sql
+from nl_to_sql import Engine, Settings
+from struct_llm.cache import TranslationCache
+from struct_llm.llm import APIStatusError, HTTPBackend, LLMBackend, RoutingBackend
+from struct_llm.metrics import Trace
+
+MESSAGES = [{"role": "user", "content": "How many orders?"}]
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            status, headers, body = (
+                server.script.pop(0) if server.script else server.default
+            )
+        if isinstance(body, list):
+            # Server-sent events
+            body = b"".join(
+                b"data: " + json.dumps(event).encode() + b"\n\n" for event in body
+            ) + b"data: [DONE]\n\n"
+        elif not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def completion(content, model="small-model"):
+    return {
+        "model": model,
+        "choices": [{"message": {"content": content}}],
+        "usage": {"prompt_tokens": 12, "completion_tokens": 4},
+    }
+
+def error(message):
+    return {"error": {"message": message}}
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = 0
+    # (status, headers, body) of the next responses, then the default one
+    server.script = []
+    server.default = (200, {}, completion("SELECT count(*) FROM orders"))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def backend(server):
+    host, port = server.server_address[:2]
+    backend = HTTPBackend(
+        "key", "default-model", f"http://{host}:{port}/v1", retries=2, backoff=0
+    )
+    yield backend
+    backend.close()
+
+def test_complete_records_the_usage_and_the_model(server, backend):
+    trace = Trace("How many orders?")
+    assert backend.complete(MESSAGES, trace) == "SELECT count(*) FROM orders"
+    assert (trace.model, trace.prompt_tokens, trace.completion_tokens) == (
+        "small-model", 12, 4,
+    )
+    assert server.requests == 1
+
+def test_server_errors_are_retried(server, backend):
+    server.script = [
+        (503, {}, error("overloaded")),
+        (429, {"Retry-After": "0"}, error("slow down")),
+    ]
+    assert backend.complete(MESSAGES) == "SELECT count(*) FROM orders"
+    assert server.requests == 3
+
+def test_the_last_error_is_raised_when_the_retries_run_out(server, backend):
+    server.default = (429, {"Retry-After": "0"}, error("rate limited"))
+    with pytest.raises(APIStatusError) as raised:
+        backend.complete(MESSAGES)
+    assert raised.value.status_code == 429
+    assert raised.value.retry_after == 0
+    assert "rate limited" in str(raised.value)
+    # The first attempt and two retries
+    assert server.requests == 3
+
+def test_client_errors_are_not_retried(server, backend):
+    server.script = [(400, {}, error("unknown model"))]
+    with pytest.raises(APIStatusError, match="400 Bad Request: unknown model"):
+        backend.complete(MESSAGES)
+    assert server.requests == 1
+
+def test_stream_yields_the_content_and_records_the_usage(server, backend):
+    server.script = [(200, {"Content-Type": "text/event-stream"}, [
+        {"choices": [{"delta": {"role": "assistant"}}]},
+        {"choices": [{"delta": {"content": "SELECT "}}]},
+        {"choices": [{"delta": {"content": "1"}}]},
+        {"model": "small-model", "choices": [],
+         "usage": {"prompt_tokens": 12, "completion_tokens": 2}},
+    ])]
+    trace = Trace("How many orders?")
+    assert list(backend.stream(MESSAGES, trace)) == ["SELECT ", "1"]
+    assert (trace.model, trace.completion_tokens) == ("small-model", 2)
+
+def test_complete_async_runs_in_a_thread(backend):
+    answer = asyncio.run(backend.complete_async(MESSAGES))
+    assert answer == "SELECT count(*) FROM orders"
+
+class NamedBackend(LLMBackend):
+    def __init__(self, model):
+        self.model = model
+
+    def complete(self, messages, trace=None):
+        return self.model
+
+def prompt(question, tables=1):
+    schema = "".join(f"Table: t{i}\n  - id: key\n" for i in range(tables))
+    return [{"role": "user", "content": f"{schema}\nUser Question: {question}"}]
+
+def test_routing_sends_simple_prompts_to_the_small_backend():
+    small, default = NamedBackend("small"), NamedBackend("default")
+    router = RoutingBackend(small, default, max_tokens=200, max_tables=2)
+    assert router.route(prompt("How many orders?", tables=2)) is small
+    assert router.complete(prompt("How many orders?")) == "small"
+    assert router.model == "default"
+    # Too many tables, a comparison or too long
+    assert router.route(prompt("How many orders?", tables=3)) is default
+    assert router.route(prompt("Compare sales by region")) is default
+    assert router.route(prompt("How many orders? " * 50)) is default
+
+def test_batch_leaves_the_retries_to_the_backend(monkeypatch):
+    calls = []
+
+    async def failing(prompt, trace=None):
+        calls.append(prompt)
+        raise APIStatusError("503 Service Unavailable: overloaded", 503)
+
+    engine = Engine(
+        settings=Settings(openai_api_key="key", query_history=False),
+        catalog=SimpleNamespace(refresh=lambda: None, fingerprint="v1"),
+        translation_cache=TranslationCache(db_path=None),
+    )
+    monkeypatch.setattr(nl_to_sql, "_engine", engine)
+    monkeypatch.setattr(
+        nl_to_sql, "prepare_prompt", lambda question, examples: (question, [])
+    )
+    monkeypatch.setattr(nl_to_sql, "get_sql_from_openai_async", failing)
+    results = nl_to_sql.run_questions_batch(["How many orders?"], retries=4)
+    assert [result.error for result in results] == [
+        "Error from OpenAI API: 503 Service Unavailable: overloaded",
+    ]
+    assert len(calls) == 1
@@ -0,0 +1,41 @@
+import asyncio
+from types import SimpleNamespace
+
+import openai
+
+from nl_to_sql import Engine, Settings
+from struct_llm.llm import OpenAIClientBackend
+
+
+class FakeAsyncOpenAI:
+    """AsyncOpenAI answering every prompt with the same SQL."""
+
+    def __init__(self, **options):
+        self.options = options
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **request):
+        message = SimpleNamespace(content="SELECT 1")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+def _no_threads(*args, **kwargs):
+    raise AssertionError("complete_async ran the blocking client in a thread")
+
+def test_default_backend_completes_async_on_the_async_client(monkeypatch):
+    monkeypatch.setattr(openai, "AsyncOpenAI", FakeAsyncOpenAI)
+    monkeypatch.setattr(asyncio, "to_thread", _no_threads)
+    engine = Engine(settings=Settings(openai_api_key="key", llm_timeout=7.0))
+    messages = [{"role": "user", "content": "How many orders?"}]
+
+    assert asyncio.run(engine.llm.complete_async(messages)) == "SELECT 1"
+    # Created lazily with the engine's options
+    assert isinstance(engine.async_client, FakeAsyncOpenAI)
+    assert engine.async_client.options["api_key"] == "key"
+
+def test_injected_client_without_an_async_one_uses_a_thread():
+    client = SimpleNamespace()
+    engine = Engine(settings=Settings(openai_api_key="key"), client=client)
+    backend = engine.llm
+    assert isinstance(backend, OpenAIClientBackend)
+    assert backend.client is client
+    assert backend.async_client is None and backend.async_client_factory is None
@@ -0,0 +1,130 @@
+import duckdb
+import pytest
+
+from struct_llm.partitions import (
+    ORDERS,
+    PartitionPruner,
+    is_partitioned,
+    store_partitioned,
+)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = duckdb.connect()
+    # Six months of orders, 2023-11 to 2024-04
+    conn.execute("""
+    CREATE TABLE source AS
+    SELECT 'O' || range AS order_id,
+           'C' || (range % 40) AS customer_id,
+           DATE '2023-11-01' + CAST(range % 180 AS INTEGER) AS order_date,
+           round(100 + (range * 37) % 900 / 3, 2) AS premium_amount
+    FROM range(1000)
+    """)
+    conn.execute(
+        "CREATE TABLE customers AS "
+        "SELECT 'C' || range AS customer_id, 'Name ' || range AS name FROM range(40)"
+    )
+    store_partitioned(
+        conn, ORDERS, "source", "order_id", tmp_path / "orders", rebuild=True
+    )
+    yield conn
+    conn.close()
+
+PRUNED_QUERIES = [
+    ("SELECT count(*) FROM orders WHERE order_date >= DATE '2024-03-10'",
+     ['(orders.order_year, orders.order_month) >= (2024, 3)']),
+    ("SELECT count(*) FROM orders WHERE order_date > '2024-03-31'",
+     ['(orders.order_year, orders.order_month) >= (2024, 3)']),
+    ("SELECT count(*) FROM orders WHERE order_date < DATE '2024-01-01'",
+     ['(orders.order_year, orders.order_month) <= (2024, 1)']),
+    ("SELECT count(*) FROM orders WHERE DATE '2024-02-01' > order_date",
+     ['(orders.order_year, orders.order_month) <= (2024, 2)']),
+    ("SELECT count(*) FROM orders WHERE order_date = DATE '2024-02-14'",
+     ['(orders.order_year, orders.order_month) = (2024, 2)']),
+    ("SELECT sum(o.premium_amount) FROM orders o "
+     "WHERE o.order_date BETWEEN '2024-01-01' AND '2024-01-31'",
+     ['(o.order_year, o.order_month) >= (2024, 1)',
+      '(o.order_year, o.order_month) <= (2024, 1)']),
+    ("SELECT count(*) FROM orders "
+     "WHERE year(order_date) = 2023 AND premium_amount > 200",
+     ['orders.order_year = 2023']),
+    ("SELECT count(*) FROM orders WHERE date_part('year', order_date) >= 2024",
+     ['orders.order_year >= 2024']),
+    ("SELECT c.name, count(*) FROM orders o "
+     "JOIN customers c ON o.customer_id = c.customer_id "
+     "WHERE o.order_date >= DATE '2024-04-01' GROUP BY c.name ORDER BY c.name",
+     ['(o.order_year, o.order_month) >= (2024, 4)']),
+    ("SELECT count(*) FROM "
+     "(SELECT * FROM orders WHERE order_date < DATE '2023-12-15') recent",
+     ['(orders.order_year, orders.order_month) <= (2023, 12)']),
+]
+
+@pytest.mark.parametrize("sql, filters", PRUNED_QUERIES)
+def test_prune_adds_partition_filters(conn, sql, filters):
+    pruned = PartitionPruner().prune(conn, sql)
+    assert pruned is not None
+    normalized = pruned.replace('main."row"', "").replace("((", "(").replace("))", ")")
+    for partition_filter in filters:
+        assert partition_filter in normalized
+
+@pytest.mark.parametrize("sql", [sql for sql, _ in PRUNED_QUERIES])
+def test_pruned_query_returns_the_same_rows(conn, sql):
+    pruned = PartitionPruner().prune(conn, sql)
+    assert conn.execute(pruned).fetchall() == conn.execute(sql).fetchall()
+
+def test_prune_relative_dates(conn):
+    sql = (
+        "SELECT count(*) FROM orders "
+        "WHERE order_date >= current_date - INTERVAL 30 DAY"
+    )
+    pruned = PartitionPruner().prune(conn, sql)
+    assert pruned is not None and "order_month" in pruned
+    assert conn.execute(pruned).fetchall() == conn.execute(sql).fetchall()
+
+@pytest.mark.parametrize("sql", [
+    # No date filter
+    "SELECT count(*) FROM orders WHERE premium_amount > 100",
+    # Not a conjunct of the WHERE clause
+    "SELECT count(*) FROM orders "
+    "WHERE order_date >= DATE '2024-03-01' OR premium_amount > 100",
+    # Not compared with a constant
+    "SELECT count(*) FROM orders "
+    "WHERE order_date > (SELECT min(order_date) FROM orders)",
+    "SELECT count(*) FROM orders o JOIN orders p ON o.customer_id = p.customer_id "
+    "WHERE o.order_date > p.order_date",
+    # A function of the date other than its year
+    "SELECT count(*) FROM orders WHERE month(order_date) = 3",
+    # A CTE of the same name hides the view
+    "WITH orders AS (SELECT * FROM source) "
+    "SELECT count(*) FROM orders WHERE order_date >= DATE '2024-03-01'",
+    # Not a query over the partitioned view
+    "SELECT count(*) FROM source WHERE order_date >= DATE '2024-03-01'",
+    # Not valid SQL: left for the database to report
+    "SELECT count(*) FROM orders WHERE order_date >=",
+])
+def test_prune_leaves_other_queries_alone(conn, sql):
+    assert PartitionPruner().prune(conn, sql) is None
+
+def test_prune_needs_a_partitioned_view():
+    conn = duckdb.connect()
+    conn.execute("CREATE TABLE orders AS SELECT DATE '2024-03-01' AS order_date")
+    assert not is_partitioned(conn, ORDERS)
+    sql = "SELECT * FROM orders WHERE order_date >= DATE '2024-03-01'"
+    assert PartitionPruner().prune(conn, sql) is None
+
+def test_prune_disabled(conn):
+    sql = "SELECT * FROM orders WHERE order_date >= DATE '2024-03-01'"
+    assert PartitionPruner([]).prune(conn, sql) is None
+
+def test_pruned_query_skips_other_partitions(conn, tmp_path):
+    sql = "SELECT count(*) FROM orders WHERE order_date >= DATE '2024-03-10'"
+    expected = conn.execute(sql).fetchone()
+    # A month the query doesn't need can't be read any more (not the first,
+    # which gives the schema)
+    month = tmp_path / "orders" / "order_year=2024" / "order_month=1"
+    for path in month.glob("*.parquet"):
+        path.write_bytes(b"not parquet")
+    with pytest.raises(duckdb.Error):
+        conn.execute(sql).fetchone()
+    assert conn.execute(PartitionPruner().prune(conn, sql)).fetchone() == expected
@@ -0,0 +1,111 @@
+import duckdb
+import pytest
+
+from struct_llm.repair import clean_sql, repair_sql, schema_columns
+
+SCHEMA = {
+    "orders": {"order_id", "customer_id", "status", "amount"},
+    "customers": {"customer_id", "status", "name"},
+    "payments": {"customer_id", "status"},
+}
+JOINED = "FROM orders o JOIN customers c ON o.customer_id = c.customer_id"
+
+@pytest.fixture
+def conn():
+    conn = duckdb.connect()
+    yield conn
+    conn.close()
+
+@pytest.mark.parametrize("text, sql", [
+    ("```sql\nSELECT 1\n```", "SELECT 1"),
+    ("Here it is:\n```\nSELECT 1;\n```\nThis selects 1.", "SELECT 1;"),
+    ("SELECT TOP 5 name FROM customers ORDER BY name",
+     "SELECT name FROM customers ORDER BY name LIMIT 5"),
+    ("SELECT DISTINCT TOP (3) name FROM customers;",
+     "SELECT DISTINCT name FROM customers LIMIT 3"),
+    ("SELECT `name` FROM `customers`", 'SELECT "name" FROM "customers"'),
+    ("SELECT * FROM orders LIMIT 20, 10", "SELECT * FROM orders LIMIT 10 OFFSET 20"),
+    ("SELECT NVL(amount, 0), GETDATE() FROM orders",
+     "SELECT coalesce(amount, 0), current_timestamp FROM orders"),
+])
+def test_clean_sql(text, sql):
+    assert clean_sql(text) == sql
+
+def test_clean_sql_leaves_literals_and_comments_alone():
+    sql = "SELECT 'NVL(a)', \"GETDATE()\" FROM t -- LIMIT 1, 2"
+    assert clean_sql(sql) == sql
+
+def test_top_is_kept_when_the_query_has_a_limit():
+    sql = "SELECT TOP 5 * FROM (SELECT * FROM t LIMIT 10) s"
+    assert clean_sql(sql) == sql
+
+def ambiguous(column):
+    return (
+        f'Binder Error: Ambiguous reference to column name "{column}" '
+        f'(use: "o.{column}" or "c.{column}")'
+    )
+
+def test_qualifies_a_column_the_tables_are_joined_on(conn):
+    sql = f"SELECT customer_id, sum(amount) {JOINED} GROUP BY customer_id"
+    assert repair_sql(conn, sql, ambiguous("customer_id"), SCHEMA) == (
+        f"SELECT o.customer_id, sum(amount) {JOINED} GROUP BY o.customer_id"
+    )
+
+def test_qualifies_a_column_equated_across_every_table(conn):
+    sql = ("SELECT customer_id FROM orders o "
+           "JOIN customers c ON c.customer_id = o.customer_id "
+           "JOIN payments p ON p.customer_id = c.customer_id")
+    repaired = repair_sql(conn, sql, ambiguous("customer_id"), SCHEMA)
+    assert repaired.startswith("SELECT o.customer_id FROM")
+
+@pytest.mark.parametrize("sql, column", [
+    # Different values in each table: which one was meant is for the LLM to say
+    (f"SELECT status {JOINED}", "status"),
+    # An outer join's column can be NULL on one side only
+    ("SELECT customer_id FROM orders o "
+     "LEFT JOIN customers c ON o.customer_id = c.customer_id", "customer_id"),
+    # Not every table with the column is joined on it
+    (f"SELECT customer_id {JOINED} JOIN payments p ON p.status = c.status",
+     "customer_id"),
+    (f"SELECT customer_id {JOINED} OR o.status = c.status", "customer_id"),
+])
+def test_leaves_other_ambiguous_columns_to_the_llm(conn, sql, column):
+    assert repair_sql(conn, sql, ambiguous(column), SCHEMA) is None
+
+def test_moves_a_column_to_the_table_that_has_it(conn):
+    sql = f"SELECT c.amount, c.name {JOINED}"
+    error = 'Binder Error: Table "c" does not have a column named "amount"'
+    assert repair_sql(conn, sql, error, SCHEMA) == f"SELECT o.amount, c.name {JOINED}"
+
+def test_turns_a_quoted_value_into_a_literal(conn):
+    sql = 'SELECT * FROM orders WHERE status = "paid"'
+    error = 'Binder Error: Referenced column "paid" not found in FROM clause!'
+    assert (repair_sql(conn, sql, error, SCHEMA)
+            == "SELECT * FROM orders WHERE status = 'paid'")
+
+def test_keeps_quoted_column_names(conn):
+    sql = 'SELECT "status" FROM customers'
+    error = 'Binder Error: Referenced column "status" not found in FROM clause!'
+    assert repair_sql(conn, sql, error, SCHEMA) is None
+
+def test_repairs_are_checked_against_duckdb(conn):
+    conn.execute(
+        "CREATE TABLE orders "
+        "(order_id INT, customer_id INT, status VARCHAR, amount DOUBLE)"
+    )
+    conn.execute(
+        "CREATE TABLE customers (customer_id INT, status VARCHAR, name VARCHAR)"
+    )
+    sql = f"SELECT customer_id {JOINED}"
+    with pytest.raises(duckdb.BinderException) as error:
+        conn.execute(sql)
+    fixed = repair_sql(conn, sql, str(error.value), SCHEMA)
+    assert conn.execute(fixed).fetchall() == []
+
+def test_unparsable_sql_is_not_repaired(conn):
+    sql = "SELEC customer_id FROM orders"
+    assert repair_sql(conn, sql, ambiguous("customer_id"), SCHEMA) is None
+
+def test_schema_columns_lowercases_the_catalog():
+    tables = {"Orders": {"columns": [("Order_ID", "Primary key"), ("Amount", "")]}}
+    assert schema_columns(tables) == {"orders": {"order_id", "amount"}}
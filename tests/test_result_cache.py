@@ -0,0 +1,97 @@
+import duckdb
+import pyarrow as pa
+import pytest
+
+from struct_llm.database import bump_table_versions, track_table_versions
+from struct_llm.result_cache import ResultCache
+
+
+@pytest.fixture
+def conn():
+    conn = duckdb.connect()
+    conn.execute("CREATE TABLE orders AS SELECT range AS id FROM range(100)")
+    conn.execute("CREATE TABLE customers AS SELECT range AS id FROM range(10)")
+    conn.execute("CREATE TABLE untracked AS SELECT range AS id FROM range(10)")
+    track_table_versions(conn, ["orders", "customers"])
+    yield conn
+    conn.close()
+
+def cache_result(cache, conn, sql):
+    key = cache.key(conn, sql)
+    cache.put(key, conn.execute(sql).pl().to_arrow())
+    return key
+
+def test_hit_until_a_table_of_the_query_changes(conn):
+    cache = ResultCache(directory=None)
+    key = cache_result(cache, conn, "SELECT count(*) FROM orders")
+    assert cache.get(cache.key(conn, "SELECT count(*) FROM orders")) is not None
+
+    bump_table_versions(conn, ["orders"])
+    new_key = cache.key(conn, "SELECT count(*) FROM orders")
+    assert new_key.digest != key.digest
+    assert cache.get(new_key) is None
+    # The stale entry was dropped, not just made unreachable
+    assert cache.stats()["memory_entries"] == 0
+
+def test_other_tables_changing_keep_the_entry(conn):
+    cache = ResultCache(directory=None)
+    key = cache_result(cache, conn, "SELECT count(*) FROM orders")
+    bump_table_versions(conn, ["customers"])
+    assert cache.key(conn, "SELECT count(*) FROM orders") == key
+    assert cache.get(key) is not None
+
+def test_joins_depend_on_every_table(conn):
+    cache = ResultCache(directory=None)
+    sql = "SELECT count(*) FROM orders o JOIN customers c ON o.id = c.id"
+    key = cache_result(cache, conn, sql)
+    assert key.versions == {"customers": 1, "orders": 1}
+    bump_table_versions(conn, ["customers"])
+    assert cache.get(cache.key(conn, sql)) is None
+
+def test_spilled_entries_are_invalidated_on_disk(conn, tmp_path):
+    # Too small for any result in memory, so entries go straight to disk
+    cache = ResultCache(memory_bytes=1, directory=tmp_path)
+    cache_result(cache, conn, "SELECT * FROM orders")
+    assert cache.stats()["disk_entries"] == 1
+    assert cache.get(cache.key(conn, "SELECT * FROM orders")).num_rows == 100
+
+    bump_table_versions(conn, ["orders"])
+    cache.key(conn, "SELECT * FROM orders")
+    assert cache.stats()["disk_entries"] == 0
+    assert list(tmp_path.glob("*.parquet")) == []
+
+def test_entries_on_disk_outlive_the_cache_until_their_tables_change(conn, tmp_path):
+    cache = ResultCache(memory_bytes=1, directory=tmp_path)
+    cache_result(cache, conn, "SELECT * FROM orders")
+
+    restarted = ResultCache(memory_bytes=1, directory=tmp_path)
+    assert restarted.get(restarted.key(conn, "SELECT * FROM orders")).num_rows == 100
+    bump_table_versions(conn, ["orders"])
+    assert restarted.get(restarted.key(conn, "SELECT * FROM orders")) is None
+    assert list(tmp_path.glob("*.parquet")) == []
+
+def test_formatting_does_not_change_the_key(conn):
+    cache = ResultCache(directory=None)
+    assert (cache.key(conn, "SELECT count(*)\n  FROM orders;")
+            == cache.key(conn, "SELECT count(*) FROM orders"))
+
+@pytest.mark.parametrize("sql", [
+    "SELECT count(*) FROM untracked",
+    "SELECT random() FROM orders",
+    "SELECT 1",
+])
+def test_uncacheable_queries(conn, sql):
+    assert ResultCache(directory=None).key(conn, sql) is None
+
+def test_disabled_tiers_cache_nothing(conn):
+    cache = ResultCache(memory_bytes=0, disk_bytes=0, directory=None)
+    assert cache.key(conn, "SELECT * FROM orders") is None
+
+def test_memory_tier_evicts_least_recently_used(conn):
+    first = conn.execute("SELECT * FROM orders").pl().to_arrow()
+    cache = ResultCache(memory_bytes=int(first.nbytes * 1.5), directory=None)
+    first_key = cache_result(cache, conn, "SELECT * FROM orders")
+    cache_result(cache, conn, "SELECT * FROM orders WHERE id >= 0")
+    assert cache.get(first_key) is None
+    second_key = cache.key(conn, "SELECT * FROM orders WHERE id >= 0")
+    assert isinstance(cache.get(second_key), pa.Table)
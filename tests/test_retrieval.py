@@ -0,0 +1,54 @@
+from struct_llm.retrieval import SchemaIndex, count_tokens, find_relations, tokenize
+
+
+def _table(description: str, *columns: str) -> dict:
+    return {
+        'description': description,
+        'columns': [(column, column.replace("_", " ")) for column in columns],
+    }
+
+# A star schema: orders joins customers, products and agents; the other tables
+# are unrelated
+TABLES = {
+    'customers': _table("Customer information", "customer_id", "first_name", "city"),
+    'products': _table("Insurance products", "product_id", "product_name"),
+    'agents': _table("Sales agents", "agent_id", "agent_name", "region"),
+    'orders': _table(
+        "Insurance policy orders", "order_id", "customer_id", "product_id",
+        "agent_id", "order_date", "premium_amount",
+    ),
+    'audit_log': _table("Changes made by administrators", "entry", "changed_at"),
+    'settings': _table("Application configuration", "key", "value", "updated_at"),
+    'holidays': _table("Public holidays", "day", "name"),
+}
+
+def test_tokenize_drops_stopwords_and_plurals():
+    assert tokenize("How many Orders were placed by customers?") == [
+        "order", "placed", "customer",
+    ]
+
+def test_count_tokens():
+    assert count_tokens("") == 0
+    assert count_tokens("SELECT count(*) FROM orders;") == 11
+
+def test_find_relations_from_shared_id_columns():
+    assert find_relations(TABLES) == {
+        ("customers", "orders"), ("orders", "products"), ("agents", "orders"),
+    }
+
+def test_select_everything_from_a_small_schema():
+    index = SchemaIndex(TABLES, find_relations(TABLES))
+    assert index.select("anything", top_k=len(TABLES)) == list(TABLES)
+
+def test_select_matches_and_their_neighbours():
+    index = SchemaIndex(TABLES, find_relations(TABLES))
+    assert index.select("premium of each policy order", top_k=1, max_neighbours=2) == [
+        "customers", "agents", "orders",
+    ]
+    assert index.select("holidays this year", top_k=1, max_neighbours=2) == ["holidays"]
+
+def test_select_bounds_the_tables_for_an_unmatched_question():
+    index = SchemaIndex(TABLES, find_relations(TABLES))
+    # The tables with the most related tables, then the most columns, in catalog order
+    assert index.select("what is going on", top_k=2) == ["agents", "orders"]
+    assert index.select("", top_k=3) == ["customers", "agents", "orders"]
@@ -0,0 +1,125 @@
+import duckdb
+import pytest
+
+from struct_llm.database import bump_table_versions, track_table_versions
+from struct_llm.rollup import DAILY_SALES, RollupRewriter, refresh_rollups
+
+
+@pytest.fixture
+def conn():
+    conn = duckdb.connect()
+    conn.execute("""
+    CREATE TABLE products AS
+    SELECT 'P' || range AS product_id, 'Product ' || range AS product_name,
+           ['Health', 'Auto', 'Home'][range % 3 + 1] AS coverage_type
+    FROM range(6)
+    """)
+    conn.execute("""
+    CREATE TABLE orders AS
+    SELECT 'O' || range AS order_id,
+           'C' || (range % 50) AS customer_id,
+           'P' || (range % 6) AS product_id,
+           DATE '2024-01-01' + CAST(range % 90 AS INTEGER) AS order_date,
+           -- Some NULL amounts, which count(x) and avg(x) must skip
+           CASE WHEN range % 17 = 0 THEN NULL
+                ELSE round(100 + (range * 37) % 900 / 3, 2) END AS premium_amount,
+           (range * 13) % 5000 + 1000.0 AS coverage_amount,
+           ['paid', 'pending', 'failed'][range % 3 + 1] AS payment_status,
+           ['active', 'lapsed'][range % 2 + 1] AS policy_status
+    FROM range(2000)
+    """)
+    track_table_versions(conn, ["products", "orders"])
+    refresh_rollups(conn)
+    yield conn
+    conn.close()
+
+EQUIVALENT_QUERIES = [
+    "SELECT count(*) FROM orders",
+    "SELECT payment_status, count(*), sum(premium_amount), avg(premium_amount) "
+    "FROM orders GROUP BY 1 ORDER BY 1",
+    "SELECT order_date, min(coverage_amount), max(coverage_amount), "
+    "count(premium_amount) FROM orders WHERE policy_status = 'active' "
+    "GROUP BY order_date ORDER BY order_date",
+    "SELECT p.coverage_type, sum(o.premium_amount) AS total "
+    "FROM orders o JOIN products p ON o.product_id = p.product_id "
+    "GROUP BY p.coverage_type ORDER BY total DESC",
+    "SELECT date_trunc('month', order_date) AS month, count(order_id) FROM orders "
+    "WHERE order_date >= DATE '2024-02-01' GROUP BY 1 ORDER BY 1",
+    "SELECT product_id, sum(premium_amount) FILTER (WHERE payment_status = 'paid') "
+    "FROM orders GROUP BY product_id HAVING count(*) > 100 ORDER BY product_id",
+    "SELECT count(DISTINCT payment_status), min(order_date), max(order_date) "
+    "FROM orders",
+    # The pagination wrapper of the UI
+    "SELECT * FROM (SELECT policy_status, count(*) AS n FROM orders GROUP BY 1) "
+    "ORDER BY 1 LIMIT 10 OFFSET 0",
+]
+
+def assert_same_rows(conn, sql, rewritten):
+    expected = conn.execute(sql).fetchall()
+    actual = conn.execute(rewritten).fetchall()
+    assert len(actual) == len(expected)
+    for actual_row, expected_row in zip(actual, expected):
+        # Sums of partial sums may differ from a single sum in the last bits
+        assert [
+            pytest.approx(value) if isinstance(value, float) else value
+            for value in actual_row
+        ] == list(expected_row)
+
+@pytest.mark.parametrize("sql", EQUIVALENT_QUERIES)
+def test_rewrite_returns_the_same_result(conn, sql):
+    rewritten, used = RollupRewriter().rewrite(conn, sql)
+    assert used == [DAILY_SALES.name]
+    assert "rollup_daily_sales" in rewritten
+    assert_same_rows(conn, sql, rewritten)
+
+@pytest.mark.parametrize("sql", [
+    # Grouped or filtered by a column that isn't a dimension
+    "SELECT customer_id, count(*) FROM orders GROUP BY 1",
+    "SELECT count(*) FROM orders WHERE premium_amount > 200",
+    # Aggregates that can't be combined from the stored ones
+    "SELECT count(DISTINCT customer_id) FROM orders",
+    "SELECT median(premium_amount) FROM orders",
+    # Not an aggregate
+    "SELECT order_id FROM orders",
+    "SELECT * FROM products",
+])
+def test_queries_the_rollup_cannot_answer_are_left_alone(conn, sql):
+    assert RollupRewriter().rewrite(conn, sql) is None
+
+def test_a_stale_rollup_is_not_used(conn):
+    conn.execute(
+        "UPDATE orders SET premium_amount = premium_amount + 1 WHERE order_id = 'O1'"
+    )
+    bump_table_versions(conn, ["orders"])
+    sql = "SELECT sum(premium_amount) FROM orders"
+    assert RollupRewriter().rewrite(conn, sql) is None
+
+def test_an_incremental_refresh_keeps_the_rewrite_equivalent(conn):
+    conn.execute(
+        "UPDATE orders SET premium_amount = premium_amount + 1 WHERE order_id = 'O1'"
+    )
+    conn.execute("""
+    INSERT INTO orders VALUES
+        ('O9999', 'C1', 'P1', DATE '2024-06-01', 10.0, 1000.0, 'paid', 'active')
+    """)
+    bump_table_versions(conn, ["orders"])
+    assert refresh_rollups(conn) == {DAILY_SALES.name: "refreshed 2 partition(s)"}
+
+    sql = (
+        "SELECT order_date, sum(premium_amount), count(*) FROM orders "
+        "GROUP BY 1 ORDER BY 1"
+    )
+    rewritten, _ = RollupRewriter().rewrite(conn, sql)
+    assert_same_rows(conn, sql, rewritten)
+
+def test_a_changed_dimension_table_rebuilds_the_rollup(conn):
+    conn.execute("UPDATE products SET coverage_type = 'Life' WHERE product_id = 'P0'")
+    bump_table_versions(conn, ["products"])
+    assert refresh_rollups(conn) == {DAILY_SALES.name: "rebuilt"}
+
+    sql = (
+        "SELECT p.coverage_type, count(*) FROM orders o "
+        "JOIN products p ON o.product_id = p.product_id GROUP BY 1 ORDER BY 1"
+    )
+    rewritten, _ = RollupRewriter().rewrite(conn, sql)
+    assert_same_rows(conn, sql, rewritten)
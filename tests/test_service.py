@@ -0,0 +1,216 @@
+import asyncio
+import json
+import re
+
+import duckdb
+import pytest
+
+import nl_to_sql
+from nl_to_sql import Engine, Settings
+from service import NLSQLService
+from struct_llm.cache import TranslationCache
+from struct_llm.database import ConnectionManager
+from struct_llm.llm import LLMBackend
+from struct_llm.result_cache import ResultCache
+
+ANSWERS = {
+    "How many orders?": "SELECT count(*) AS orders FROM orders",
+    "List the orders": "SELECT order_id, amount FROM orders ORDER BY order_id",
+    "Which column?": "SELECT missing_column FROM orders",
+}
+
+
+class ScriptedBackend(LLMBackend):
+    """Answers the question at the end of the prompt from ANSWERS.
+
+    If `gate` is an event, calls wait until it is set.
+    """
+    model = "scripted"
+
+    def __init__(self):
+        self.calls = 0
+        self.gate = None
+
+    async def complete_async(self, messages, trace=None):
+        self.calls += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        question = re.search(r"User Question: (.*)", messages[-1]["content"]).group(1)
+        if question not in ANSWERS:
+            raise ConnectionError("model unavailable")
+        return ANSWERS[question]
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    db_path = tmp_path / "test.db"
+    conn = duckdb.connect(str(db_path))
+    conn.execute("""
+    CREATE TABLE orders AS
+    SELECT 'O' || range AS order_id, range * 10.0::DOUBLE AS amount FROM range(5)
+    """)
+    conn.execute(
+        "CREATE TABLE schema_metadata (table_name VARCHAR, column_name VARCHAR, "
+        "description VARCHAR)"
+    )
+    conn.execute("""
+    INSERT INTO schema_metadata VALUES
+        ('orders', NULL, 'Orders'),
+        ('orders', 'order_id', 'Order key'),
+        ('orders', 'amount', 'Order amount')
+    """)
+    conn.close()
+
+    engine = Engine(
+        settings=Settings(openai_api_key="key", query_history=False),
+        conn=ConnectionManager(db_path),
+        translation_cache=TranslationCache(db_path=None),
+        result_cache=ResultCache(0, 0),
+        llm=ScriptedBackend(),
+    )
+    monkeypatch.setattr(nl_to_sql, "_engine", engine)
+    yield engine
+    engine.conn.close()
+
+@pytest.fixture
+def service(engine):
+    service = NLSQLService(engine, query_workers=2, request_timeout=5)
+    yield service
+    service.close()
+
+def call(service, method, target, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else b""
+    return service.dispatch(method, target, {}, body)
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def decode(response):
+    return response.status, json.loads(response.body)
+
+def test_ask_returns_the_rows(service):
+    status, body = decode(run(call(service, "POST", "/ask", {
+        "question": "How many orders?",
+    })))
+    assert status == 200
+    assert (body["sql"], body["rows"], body["cached"]) == (
+        "SELECT count(*) AS orders FROM orders", [[5]], False,
+    )
+    # The translation is cached once it ran
+    status, body = decode(run(call(service, "POST", "/ask", {
+        "question": "How many orders?",
+    })))
+    assert body["cached"] is True
+    assert service.engine.llm.calls == 1
+
+def test_ask_truncates_to_max_rows(service):
+    status, body = decode(run(call(service, "POST", "/ask", {
+        "question": "List the orders", "max_rows": 3,
+    })))
+    assert status == 200
+    assert body["columns"] == ["order_id", "amount"]
+    assert body["rows"] == [["O0", 0.0], ["O1", 10.0], ["O2", 20.0]]
+    assert (body["row_count"], body["truncated"]) == (3, True)
+
+@pytest.mark.parametrize("target, payload, status", [
+    ("/ask", {}, 400),
+    ("/ask", {"question": "   "}, 400),
+    ("/ask", {"question": "How many orders?", "max_rows": -1}, 400),
+    ("/ask", {"question": "How many orders?", "max_rows": True}, 400),
+    ("/ask", ["How many orders?"], 400),
+    ("/export", {"question": "How many orders?", "format": "xml"}, 400),
+    ("/nowhere", {}, 404),
+    ("/health", {}, 405),
+    # The LLM fails, then the SQL does
+    ("/ask", {"question": "Unknown question"}, 502),
+    ("/ask", {"question": "Which column?"}, 422),
+])
+def test_error_statuses(service, target, payload, status):
+    response = run(call(service, "POST", target, payload))
+    assert response.status == status
+    assert "error" in json.loads(response.body)
+
+def test_invalid_json_is_a_bad_request(service):
+    response = run(service.dispatch("POST", "/sql", {}, b"{not json"))
+    assert response.status == 400
+
+def test_requests_past_max_pending_are_refused(engine):
+    service = NLSQLService(engine, query_workers=2, max_pending=2)
+    engine.llm.gate = asyncio.Event()
+
+    async def saturate():
+        first = [
+            asyncio.ensure_future(call(service, "POST", "/sql", {
+                "question": "How many orders?",
+            }))
+            for _ in range(2)
+        ]
+        while engine.llm.calls < 2:
+            await asyncio.sleep(0.01)
+        refused = await call(service, "POST", "/ask", {"question": "How many orders?"})
+        # Not admission controlled
+        health = await call(service, "GET", "/health")
+        engine.llm.gate.set()
+        return refused, health, await asyncio.gather(*first)
+
+    try:
+        refused, health, answered = run(saturate())
+    finally:
+        service.close()
+    assert refused.status == 503
+    assert refused.headers["Retry-After"] == "1"
+    assert decode(health) == (200, {"status": "ok", "pending": 2})
+    assert [response.status for response in answered] == [200, 200]
+    assert service.pending == 0
+
+def test_slow_requests_time_out(engine):
+    service = NLSQLService(engine, query_workers=2, request_timeout=0.1)
+    engine.llm.gate = asyncio.Event()
+    try:
+        response = run(call(service, "POST", "/sql", {"question": "How many orders?"}))
+    finally:
+        service.close()
+    assert response.status == 504
+    assert service.pending == 0
+
+def test_schema_and_metrics(service):
+    run(call(service, "POST", "/sql", {"question": "How many orders?"}))
+    status, body = decode(run(call(service, "GET", "/schema")))
+    assert status == 200
+    assert body["tables"]["orders"]["columns"] == [
+        {"name": "amount", "description": "Order amount"},
+        {"name": "order_id", "description": "Order key"},
+    ]
+    metrics = run(call(service, "GET", "/metrics"))
+    assert metrics.status == 200 and metrics.content_type.startswith("text/plain")
+
+def test_connections_are_kept_alive(service):
+    async def session():
+        server = await service.serve("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        responses = []
+        try:
+            for body in (b'{"question": "How many orders?"}', b"{}"):
+                writer.write(
+                    b"POST /ask HTTP/1.1\r\nHost: test\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = int(re.search(rb"Content-Length: (\d+)", head).group(1))
+                responses.append((head, json.loads(await reader.readexactly(length))))
+            writer.write(b"GET /health HTTP/1.1\r\nConnection: close\r\n\r\n")
+            head = await reader.readuntil(b"\r\n\r\n")
+            await reader.read()
+            responses.append((head, None))
+        finally:
+            writer.close()
+            server.close()
+            await server.wait_closed()
+        return responses
+
+    (first, answer), (second, error), (last, _) = run(session())
+    assert first.startswith(b"HTTP/1.1 200 OK") and b"Connection: keep-alive" in first
+    assert answer["rows"] == [[5]]
+    assert second.startswith(b"HTTP/1.1 400")
+    assert error == {"error": 'Missing "question"'}
+    assert last.startswith(b"HTTP/1.1 200") and b"Connection: close" in last
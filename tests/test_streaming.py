@@ -0,0 +1,131 @@
+import pytest
+
+from struct_llm.metrics import Trace
+from struct_llm.streaming import SqlStream, scan_sql
+
+
+def chunks(text, size=3):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+class Source:
+    """LLM deltas that record how far they were read and whether they were closed."""
+
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            for delta in self.deltas:
+                self.read += 1
+                yield delta
+        finally:
+            self.closed = True
+
+@pytest.mark.parametrize("response, sql", [
+    ("SELECT 1", "SELECT 1"),
+    ("```sql\nSELECT 1\n```", "SELECT 1"),
+    ("Here is the query:\n```sql\nSELECT *\nFROM orders\n```\nIt lists every order.",
+     "SELECT *\nFROM orders"),
+    ("SELECT count(*) FROM orders;\nThis counts the orders.",
+     "SELECT count(*) FROM orders;"),
+    ("WITH t AS (SELECT 1 AS x)\nSELECT x FROM t",
+     "WITH t AS (SELECT 1 AS x)\nSELECT x FROM t"),
+    # Lines that read like prose are part of an unterminated statement
+    ("SELECT o.order_id\nFROM\nOrders as o\nWhere o.premium_amount > 10",
+     "SELECT o.order_id\nFROM\nOrders as o\nWhere o.premium_amount > 10"),
+    ("```sql\nSELECT c.name\nFROM orders o\nJOIN\n"
+     "Customers c ON c.customer_id = o.customer_id\n```",
+     "SELECT c.name\nFROM orders o\nJOIN\n"
+     "Customers c ON c.customer_id = o.customer_id"),
+    # A sentence after a blank line ends an unterminated statement
+    ("SELECT count(*)\nFROM orders\n\nThis query counts the orders. It reads orders.",
+     "SELECT count(*)\nFROM orders"),
+    ("SELECT 1\n\nExplanation:\n- selects one", "SELECT 1"),
+    ("SELECT *\nFROM orders\n\nThis lists every order.", "SELECT *\nFROM orders"),
+    # Lines after a blank line that aren't sentences stay in the statement
+    ("SELECT a,\n\n  b\nFROM t\n\nOrders o", "SELECT a,\n\n  b\nFROM t\n\nOrders o"),
+    ("SELECT *\nFROM customers\n\nWHERE name = 'Mr. X'",
+     "SELECT *\nFROM customers\n\nWHERE name = 'Mr. X'"),
+    ("SELECT *\nFROM customers c\n\nWhere c.name = 'Mr. X'",
+     "SELECT *\nFROM customers c\n\nWhere c.name = 'Mr. X'"),
+    ("```sql\nSELECT 1\n\nThis is. in a fence\n```", "SELECT 1\n\nThis is. in a fence"),
+    # Statement ends aren't looked for in literals, quoted names and comments
+    ("SELECT 'a;b' AS \"x;y\" -- done;\nFROM t",
+     "SELECT 'a;b' AS \"x;y\" -- done;\nFROM t"),
+    ("SELECT /* ``` */ 1;", "SELECT /* ``` */ 1;"),
+    ("SELECT 'it''s;' AS s;", "SELECT 'it''s;' AS s;"),
+    # A single backtick is a (MySQL) identifier, not a fence
+    ("SELECT `name` FROM `customers`", 'SELECT "name" FROM "customers"'),
+])
+@pytest.mark.parametrize("size", [1, 4, 1000])
+def test_stream_yields_the_statement(response, sql, size):
+    stream = SqlStream(chunks(response, size))
+    streamed = "".join(stream)
+    assert stream.sql == sql
+    # What was shown while streaming is the statement before cleaning
+    assert streamed in response
+
+def test_streamed_text_never_includes_what_follows_the_statement():
+    response = "```sql\nSELECT 1\n```\nExplanation: it selects 1."
+    streamed = "".join(SqlStream(chunks(response, 1)))
+    assert streamed == "SELECT 1\n"
+
+def test_the_source_is_closed_once_the_statement_is_complete():
+    response = (
+        "SELECT 1;\n"
+        "This query selects the number one and then explains itself at length."
+    )
+    source = Source(chunks(response, 4))
+    stream = SqlStream(source)
+    assert stream.read() == "SELECT 1;"
+    assert stream.cancelled
+    assert source.closed
+    assert source.read < len(source.deltas)
+
+def test_an_unterminated_statement_is_read_to_the_end():
+    source = Source(chunks("SELECT 1\nFROM t", 2))
+    stream = SqlStream(source)
+    assert stream.read() == "SELECT 1\nFROM t"
+    assert not stream.cancelled
+    assert source.read == len(source.deltas)
+
+def test_the_source_is_closed_once_prose_follows_the_statement():
+    response = "SELECT 1\nFROM t\n\nThis query selects one. " + "More text. " * 20
+    source = Source(chunks(response, 4))
+    stream = SqlStream(source)
+    assert stream.read() == "SELECT 1\nFROM t"
+    assert stream.cancelled
+    assert source.closed
+    assert source.read < len(source.deltas)
+
+def test_a_line_that_may_be_prose_is_held_back():
+    text = "SELECT 1\nFROM t\n\nThis query"
+    span = scan_sql(text)
+    assert text[span.start:span.end] == "SELECT 1\nFROM t"
+    assert not span.done
+    assert scan_sql(text + " selects one.", final=True).prose
+    assert not scan_sql(text + " selects one", final=True).prose
+
+def test_prose_before_an_unclosed_fence_waits_for_the_fence():
+    assert scan_sql("Sure, here").start is None
+    span = scan_sql("Sure, here:\n```sql\nSELECT 1")
+    assert span.start is not None and not span.complete
+
+def test_a_possible_fence_is_held_back():
+    text = "```sql\nSELECT 1\n``"
+    span = scan_sql(text)
+    assert text[span.start:span.end] == "SELECT 1\n"
+    assert not span.complete
+
+def test_reused_sql_is_a_single_chunk():
+    stream = SqlStream.of("SELECT 1", cached=True)
+    assert list(stream) == ["SELECT 1"]
+    assert stream.sql == "SELECT 1" and stream.cached
+
+def test_trace_gets_the_first_token_and_cleaned_sql():
+    trace = Trace("question")
+    SqlStream(chunks("```sql\nSELECT TOP 3 * FROM t\n```"), trace).read()
+    assert trace.sql == "SELECT * FROM t LIMIT 3"
+    assert "first_token" in trace.stages and "repair" in trace.stages
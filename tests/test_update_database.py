@@ -0,0 +1,94 @@
+import os
+
+import duckdb
+import pytest
+from update_database import load_sources, load_table
+
+PRODUCTS = "product_id,name\nP1,Basic\nP2,Premium\n"
+CUSTOMERS = "customer_id,name\nC1,Ann\nC2,Bob\n"
+ORDERS = (
+    "order_id,customer_id,product_id,amount\n"
+    "O1,C1,P1,10.0\n"
+    "O2,C2,P2,20.0\n"
+    # No customer C9
+    "O3,C9,P1,30.0\n"
+)
+
+def write_sources(data_dir, products=PRODUCTS, customers=CUSTOMERS, orders=ORDERS):
+    sources = (("products", products), ("customers", customers), ("orders", orders))
+    for name, text in sources:
+        path = data_dir / f"{name}.csv"
+        path.write_text(text)
+        # Load state compares mtimes, which can be equal for writes in quick
+        # succession
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+@pytest.fixture
+def conn():
+    conn = duckdb.connect()
+    yield conn
+    conn.close()
+
+def order_rows(conn):
+    return conn.execute(
+        "SELECT order_id, customer_id, amount FROM orders ORDER BY order_id"
+    ).fetchall()
+
+def test_first_load_rejects_orphans(conn, tmp_path):
+    write_sources(tmp_path)
+    assert load_sources(conn, data_dir=tmp_path) == ["products", "customers", "orders"]
+    assert order_rows(conn) == [("O1", "C1", 10.0), ("O2", "C2", 20.0)]
+
+def test_unchanged_sources_are_skipped(conn, tmp_path):
+    write_sources(tmp_path)
+    load_sources(conn, data_dir=tmp_path)
+    assert load_sources(conn, data_dir=tmp_path) == []
+
+def test_upsert_writes_only_new_and_changed_rows(conn, tmp_path):
+    write_sources(tmp_path)
+    load_sources(conn, data_dir=tmp_path)
+    (tmp_path / "orders.csv").write_text(
+        "order_id,customer_id,product_id,amount\n"
+        "O1,C1,P1,10.0\n"
+        "O2,C2,P2,25.0\n"
+        "O3,C9,P1,30.0\n"
+        "O4,C1,P2,40.0\n"
+        "O5,C7,P2,50.0\n"
+    )
+    upserted, rejected, rebuilt = load_table(
+        conn, "orders", str(tmp_path / "orders.csv"), "order_id"
+    )
+    assert (upserted, rejected, rebuilt) == (2, 2, False)
+    assert order_rows(conn) == [
+        ("O1", "C1", 10.0), ("O2", "C2", 25.0), ("O4", "C1", 40.0),
+    ]
+
+def test_rejected_rows_load_once_their_parent_exists(conn, tmp_path):
+    write_sources(tmp_path)
+    load_sources(conn, data_dir=tmp_path)
+    # Only the parent file changes; the orders are reloaded because of it
+    write_sources(tmp_path, customers=CUSTOMERS + "C9,Cy\n")
+    assert load_sources(conn, data_dir=tmp_path) == ["customers", "orders"]
+    assert ("O3", "C9", 30.0) in order_rows(conn)
+
+def test_changed_columns_rebuild_the_table(conn, tmp_path):
+    write_sources(tmp_path)
+    load_sources(conn, data_dir=tmp_path)
+    (tmp_path / "orders.csv").write_text(
+        "order_id,customer_id,product_id,amount,channel\n"
+        "O1,C1,P1,10.0,web\n"
+    )
+    upserted, rejected, rebuilt = load_table(
+        conn, "orders", str(tmp_path / "orders.csv"), "order_id"
+    )
+    assert (upserted, rejected, rebuilt) == (1, 0, True)
+    assert conn.execute("SELECT channel FROM orders").fetchall() == [("web",)]
+
+def test_a_failed_load_leaves_the_table_alone(conn, tmp_path):
+    write_sources(tmp_path)
+    load_sources(conn, data_dir=tmp_path)
+    before = order_rows(conn)
+    with pytest.raises(duckdb.Error):
+        load_table(conn, "orders", str(tmp_path / "missing.csv"), "order_id")
+    assert order_rows(conn) == before
@@ -0,0 +1,96 @@
+import os
+import signal
+import threading
+import time
+
+import duckdb
+import pytest
+
+from struct_llm.errors import QueryError, QueryTimeoutError
+from struct_llm.workers import QueryProcessPool
+
+# Runs for minutes unless interrupted
+SLOW_SQL = "SELECT sum(a.range * b.range) FROM range(1000000) a, range(1000000) b"
+
+
+@pytest.fixture(scope="module")
+def db_path(tmp_path_factory):
+    db_path = tmp_path_factory.mktemp("workers") / "test.db"
+    conn = duckdb.connect(str(db_path))
+    conn.execute("CREATE TABLE orders AS SELECT range AS order_id FROM range(250000)")
+    conn.close()
+    return db_path
+
+@pytest.fixture(scope="module")
+def pool(db_path, tmp_path_factory):
+    pool = QueryProcessPool(
+        db_path, processes=1, spill_dir=tmp_path_factory.mktemp("spill"),
+        poll_interval=0.02,
+    )
+    yield pool
+    pool.close()
+
+def test_run_returns_the_result(pool):
+    table = pool.run("SELECT order_id FROM orders WHERE order_id % 1000 = 0")
+    assert table.num_rows == 250
+    assert table.column("order_id").to_pylist()[:3] == [0, 1000, 2000]
+    # Result files are removed once they are read
+    assert list(pool.spill_dir.iterdir()) == []
+
+def test_errors_keep_the_duckdb_exception(pool):
+    with pytest.raises(QueryError) as raised:
+        pool.run("SELECT missing_column FROM orders")
+    assert isinstance(raised.value.__cause__, duckdb.BinderException)
+    assert pool.run("SELECT count(*) AS n FROM orders").to_pylist() == [{"n": 250000}]
+
+def test_timeout_interrupts_the_query(pool):
+    restarts = pool.restarts
+    with pytest.raises(QueryTimeoutError):
+        pool.run(SLOW_SQL, timeout=0.2)
+    # Interrupted, not restarted
+    assert pool.restarts == restarts
+    assert pool.run("SELECT 1 AS one").to_pylist() == [{"one": 1}]
+
+def test_on_wait_cancels_the_query(pool):
+    def on_wait():
+        raise RuntimeError("request cancelled")
+
+    with pytest.raises(RuntimeError, match="request cancelled"):
+        pool.run(SLOW_SQL, on_wait=on_wait)
+    assert pool.run("SELECT 1 AS one").to_pylist() == [{"one": 1}]
+
+def test_a_crashed_worker_is_replaced(db_path, tmp_path):
+    pool = QueryProcessPool(
+        db_path, processes=1, spill_dir=tmp_path, poll_interval=0.02
+    )
+    try:
+        worker = pool._workers[0]
+        errors = []
+
+        def run():
+            try:
+                pool.run(SLOW_SQL)
+            except QueryError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        time.sleep(0.5)
+        # As the kernel's OOM killer would
+        os.kill(worker.process.pid, signal.SIGKILL)
+        thread.join(10)
+        assert not thread.is_alive()
+        assert "exited (code -9)" in str(errors[0])
+        assert pool.restarts == 1
+        assert worker.process.is_alive()
+        assert pool.run("SELECT count(*) AS n FROM orders").to_pylist() == [
+            {"n": 250000},
+        ]
+    finally:
+        pool.close()
+
+def test_closed_pool_refuses_queries(db_path, tmp_path):
+    pool = QueryProcessPool(db_path, processes=1, spill_dir=tmp_path)
+    pool.close()
+    with pytest.raises(QueryError, match="closed"):
+        pool.run("SELECT 1")